@@ -0,0 +1,246 @@
+"""
+Micro-benchmarks for parts of the pretraining hot path, e.g.
+    python benchmarks.py --benchmark=masking --d_batch=8
+Runs on the first GPU in --device_idxs if there is one, on CPU otherwise.
+"""
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+import torch
+from absl import app
+
+from config import FLAGS, get_my_tokenizer, process_flags
+from objectives import BERT_MLM_objective, get_token_tables, t5_denoise_spans_objective, t5_span_MLM_objective
+from model import MultiHeadAttention, get_additive_attention_mask
+from my_utils.model_utils import apply_sequence_mask, autocast, contrastive_loss, masked_cosine_critic, \
+    masked_MSE_loss
+from wrappers import MLMModelWrapper, MODEL_MAPPING
+import logging as log
+
+log.basicConfig(
+    format="%(asctime)s: %(message)s", datefmt="%m/%d %I:%M:%S %p", level=log.INFO
+)  # noqa
+
+
+def get_device():
+    if torch.cuda.is_available() and FLAGS.device_idxs and FLAGS.device_idxs[0] >= 0:
+        return torch.device(f'cuda:{FLAGS.device_idxs[0]}')
+    return torch.device('cpu')
+
+
+def ms_per_call(function, device):
+    """Average wall-clock time of calling :function: in ms, over FLAGS.nb_benchmark_calls calls after a warm-up"""
+    function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(FLAGS.nb_benchmark_calls):
+        function()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start) / FLAGS.nb_benchmark_calls * 1000
+
+
+def log_timings(name, timings):
+    log.info(f"{name} ({FLAGS.nb_benchmark_calls} calls per variant):")
+    for variant, ms in timings.items():
+        log.info(f"    {variant}: {ms:.3f} ms")
+
+
+def get_random_batch(device):
+    token_indexer = get_my_tokenizer()
+    return torch.randint(token_indexer.vocab_size, (FLAGS.d_batch, FLAGS.max_seq_length), device=device)
+
+
+def get_train_step(device):
+    """Returns a function doing a forward and backward pass of the pretraining model (with the current flags)"""
+    model = MLMModelWrapper(MODEL_MAPPING[FLAGS.model]).to(device)
+    model.train()
+    input_ids = get_random_batch(device)
+
+    def train_step():
+        model.zero_grad()
+        model(input_ids)['loss'].backward()
+
+    return train_step
+
+
+def legacy_special_token_mask(target_ids, token_indexer):
+    """How BERT_MLM_objective used to find special tokens: element by element in Python, on the CPU"""
+    return deepcopy(target_ids).cpu().apply_(lambda x: x in token_indexer.all_special_ids).to(
+        target_ids.device).to(torch.bool)
+
+
+def benchmark_masking(device):
+    token_indexer = get_my_tokenizer()
+    ids = get_random_batch(device)
+    timings = OrderedDict()
+    timings['special tokens: per-element lookup on CPU'] = ms_per_call(
+        lambda: legacy_special_token_mask(ids, token_indexer), device)
+    timings['special tokens: lookup table on device'] = ms_per_call(
+        lambda: get_token_tables(token_indexer, device)[0][ids], device)
+    original_flags = FLAGS.whole_word_masking, FLAGS.mask_replacement_80_10_10
+    for whole_word_masking in [False, True]:
+        for mask_replacement_80_10_10 in [False, True]:
+            FLAGS.whole_word_masking, FLAGS.mask_replacement_80_10_10 = whole_word_masking, mask_replacement_80_10_10
+            timings[f'BERT_MLM_objective, whole_word_masking={whole_word_masking}, '
+                    f'mask_replacement_80_10_10={mask_replacement_80_10_10}'] = ms_per_call(
+                lambda: BERT_MLM_objective(ids, token_indexer), device)
+    FLAGS.whole_word_masking, FLAGS.mask_replacement_80_10_10 = original_flags
+    timings[f't5_span_MLM_objective, mean_span_length={FLAGS.mean_span_length}'] = ms_per_call(
+        lambda: t5_span_MLM_objective(ids, token_indexer), device)
+    timings[f't5_denoise_spans_objective, mean_span_length={FLAGS.mean_span_length}'] = ms_per_call(
+        lambda: t5_denoise_spans_objective(ids, token_indexer), device)
+    log_timings(f'Masking a [{FLAGS.d_batch}, {FLAGS.max_seq_length}] batch on {device}', timings)
+
+
+def legacy_position_bias(attention_module, query_length, value_length):
+    """How MultiHeadAttention used to get its relative position bias: from a nested list, in every layer"""
+    rel_pos_indices = torch.tensor([[q_idx - k_idx for k_idx in range(value_length)] for q_idx in range(query_length)])
+    bucket_idxs = MultiHeadAttention._relative_position_bucket(rel_pos_indices).to(
+        attention_module.relative_attention_bias.weight.device)
+    return attention_module.relative_attention_bias(bucket_idxs).permute(2, 0, 1)
+
+
+def benchmark_position_bias(device):
+    if FLAGS.pos_embeddings != 'relative':
+        log.info("Skipping the position bias benchmark: it needs --pos_embeddings=relative")
+        return
+    attention_module = MultiHeadAttention().to(device)
+    length = FLAGS.max_seq_length
+
+    timings = OrderedDict()
+    timings['position bias rebuilt in every layer'] = ms_per_call(
+        lambda: [legacy_position_bias(attention_module, length, length) for _ in range(FLAGS.nb_encoder_layers)],
+        device)
+    timings['position bias computed once per forward pass'] = ms_per_call(
+        lambda: attention_module.select_pos_embeddings(length, length), device)
+    timings['train step'] = ms_per_call(get_train_step(device), device)
+    log_timings(f'Position bias for {FLAGS.nb_encoder_layers} layers at length {length} on {device}', timings)
+
+
+def run_attention(attention_module, replacees, attention_mask, backend):
+    """Does a forward and backward pass of :attention_module: with the given backend"""
+    original_backend = FLAGS.attention_backend
+    FLAGS.attention_backend = backend
+    replacees = replacees.detach().requires_grad_()
+    attention_module(replacees, replacees, attention_mask)['activations'].sum().backward()
+    FLAGS.attention_backend = original_backend
+
+
+def benchmark_attention(device):
+    """
+    Times a forward and backward pass of one attention layer with the explicit and sdpa attention backends, for rows
+    padded to different lengths. That both give the same results is tested in tests/test_attention.py.
+    """
+    attention_module = MultiHeadAttention().to(device)
+    attention_module.eval()
+    length = FLAGS.max_seq_length
+    replacees = torch.randn(FLAGS.d_batch, length, FLAGS.d_hidden, device=device)
+    row_lengths = torch.linspace(length, length // 2, FLAGS.d_batch, device=device).long()
+    padding_mask = torch.arange(length, device=device)[None, :] < row_lengths[:, None]
+    attention_mask = get_additive_attention_mask(padding_mask, replacees.dtype)
+
+    timings = OrderedDict()
+    for backend in ['explicit', 'sdpa']:
+        timings[f'attention_backend={backend}'] = ms_per_call(
+            lambda: run_attention(attention_module, replacees, attention_mask, backend), device)
+    log_timings(f'Forward and backward pass of one attention layer at length {length}, '
+                f'pos_embeddings={FLAGS.pos_embeddings} on {device}', timings)
+
+
+def legacy_contrastive_loss(in_state, predicted_in_state, mask):
+    """How contrastive_loss used to compute negatives: with a rolled copy of in_state per shift"""
+    d_batch = in_state.shape[0]
+    if FLAGS.contrastive_loss == 'MSE':
+        negative_loss = sum([masked_MSE_loss(in_state.roll(shifts=i, dims=0), predicted_in_state, mask)
+                             for i in range(d_batch)]) / d_batch
+        return masked_MSE_loss(in_state, predicted_in_state, mask) / negative_loss
+    positive_similarity = torch.log(masked_cosine_critic(in_state, predicted_in_state, mask))
+    negatives_dissimilarity = sum([torch.log(1 - masked_cosine_critic(in_state.roll(shifts=i, dims=0),
+                                                                      predicted_in_state, mask))
+                                   for i in range(d_batch - 1)])
+    return - (positive_similarity + negatives_dissimilarity)
+
+
+def benchmark_contrastive_loss(device):
+    """Checks the batched contrastive loss against the shift-by-shift version, and times forward and backward of both"""
+    in_state = torch.randn(FLAGS.d_batch, FLAGS.max_seq_length, FLAGS.d_hidden, device=device)
+    predicted_in_state = torch.randn_like(in_state, requires_grad=True)
+    _, mask = apply_sequence_mask(in_state)
+    original_loss_type = FLAGS.contrastive_loss
+    timings = OrderedDict()
+    for loss_type in ['MSE', 'CE']:
+        FLAGS.contrastive_loss = loss_type
+        legacy, batched = legacy_contrastive_loss(in_state, predicted_in_state, mask), contrastive_loss(
+            in_state, predicted_in_state, mask)
+        log.info(f"{loss_type} contrastive loss: shift by shift {legacy.item():.6f}, batched {batched.item():.6f}")
+        assert torch.allclose(legacy, batched, rtol=1e-4), f'Batched {loss_type} contrastive loss disagrees'
+        for name, function in [('shift by shift', legacy_contrastive_loss), ('batched', contrastive_loss)]:
+            timings[f'{loss_type}, {name}'] = ms_per_call(
+                lambda: function(in_state, predicted_in_state, mask).backward(), device)
+    FLAGS.contrastive_loss = original_loss_type
+    log_timings(f'Contrastive loss forward and backward for d_batch {FLAGS.d_batch} on {device}', timings)
+
+
+PRECISION_LOSS_RTOL = {'bf16': 5e-2, 'fp16': 1e-2}
+
+
+def benchmark_precision(device):
+    """
+    Checks that the pretraining loss under autocast stays close to the fp32 loss on the same seeded weights and batch,
+    and times a train step in each precision. fp16 is only checked on GPU.
+    """
+    original_precision = FLAGS.precision
+    precisions = ['fp32', 'bf16'] + (['fp16'] if device.type == 'cuda' else [])
+    seed = FLAGS.manual_seed or 0  # manual_seed is None unless set
+    torch.manual_seed(seed)
+    model = MLMModelWrapper(MODEL_MAPPING[FLAGS.model]).to(device)
+    model.train()
+    input_ids = get_random_batch(device)
+    losses, timings = OrderedDict(), OrderedDict()
+    for precision in precisions:
+        FLAGS.precision = precision
+
+        def train_step():
+            model.zero_grad()
+            with autocast(device):
+                loss = model(input_ids)['loss']
+            loss.backward()
+            return loss
+
+        # Same masking for every precision
+        torch.manual_seed(seed)
+        losses[precision] = train_step().item()
+        timings[precision] = ms_per_call(train_step, device)
+    FLAGS.precision = original_precision
+    for precision, loss in losses.items():
+        log.info(f"{precision} loss: {loss:.6f}")
+        if precision != 'fp32':
+            assert abs(loss - losses['fp32']) <= PRECISION_LOSS_RTOL[precision] * abs(losses['fp32']), \
+                f'{precision} loss strays too far from the fp32 loss'
+    log_timings(f'Train step per precision for d_batch {FLAGS.d_batch} on {device}', timings)
+
+
+BENCHMARK_MAPPING = OrderedDict(
+    [
+        ("masking", benchmark_masking,),
+        ("position_bias", benchmark_position_bias,),
+        ("attention", benchmark_attention,),
+        ("contrastive_loss", benchmark_contrastive_loss,),
+        ("precision", benchmark_precision,),
+    ]
+)
+
+
+def main(_):
+    process_flags()
+    device = get_device()
+    benchmarks = [FLAGS.benchmark] if FLAGS.benchmark else list(BENCHMARK_MAPPING.keys())
+    for name in benchmarks:
+        BENCHMARK_MAPPING[name](device)
+
+
+if __name__ == '__main__':
+    app.run(main)
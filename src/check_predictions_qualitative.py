@@ -14,6 +14,7 @@ from pathlib import Path
 
 from text_input_pipeline import GutenbergReader
 from my_utils.util import get_gpus_with_enough_memory
+from my_utils.sharded_checkpoint import load_state
 
 FIXED_DEVICE_IDXS = None #[0]
 # CHOSEN_RUN_DIR = Path('output','constant','same')
@@ -37,7 +38,7 @@ def main(_):
 
     for trained_model_path in (best_val_run_path, latest_run_path):
         print(f'Testing {trained_model_path}')
-        model.load_state_dict(torch.load(trained_model_path,map_location=torch.device(model_device)))
+        model.load_state_dict(load_state(trained_model_path,map_location=torch.device(model_device)))
         model = model.cuda(model_device)
         model.eval()  # Set to eval mode
         for name, dataset in zip(('Train', 'Test', 'Val'), (train_dataset, test_dataset, val_dataset)):
@@ -28,12 +28,27 @@ MODEL_RELEVANT_FLAGS = ["model",
                         "hf_model_handle",
                         "DIR_size"]
 FLAGS = flags.FLAGS
-flags.DEFINE_integer("d_batch", 2, "Batch size. If DIR is not none, this is also the number of negative samples + 1")
+flags.DEFINE_integer("d_batch", 2, "Batch size. If DIR is not none, this is also the number of negative samples + 1, "
+                                    "plus nb_memory_bank_negatives")
+flags.DEFINE_integer("nb_accumulation_steps", 1,
+                     "Number of batches of d_batch rows whose gradients are accumulated before each optimizer step, "
+                     "for an effective batch size larger than what fits in memory")
+flags.DEFINE_integer("nb_memory_bank_negatives", 0,
+                     "Only for combo DIR: number of (detached) activations from earlier batches that are kept per "
+                     "layer and used as extra contrastive negatives, so that the number of negatives is not limited "
+                     "by d_batch")
 flags.DEFINE_float("DIR_loss_fraction", 0.95,
                    "Fraction of the total loss that the distributed regression loss accounts for")
 flags.DEFINE_integer("model_save_interval", 300,
                      "Number of seconds after which a model will be checkpointed, even within an epoch")
 flags.DEFINE_integer("num_serialized_models_to_keep", 1, "Number of serialized trained models to store.")
+flags.DEFINE_bool("sharded_checkpoints", False,
+                  "If True, checkpoints are directories with a file per tensor. Tensors that didn't change since the "
+                  "previous checkpoint (e.g. with freeze_main_model) are hard-linked instead of written again, as is "
+                  "best.th. Load them with my_utils.sharded_checkpoint.load_state")
+flags.DEFINE_bool("async_checkpointing", True,
+                  "If True, checkpoints are copied to CPU memory and written to disk on a background thread, so that "
+                  "training only stalls for the copy")
 flags.DEFINE_float("dropout_rate", .1, "Dropout rate")
 flags.DEFINE_string("mode", "", "Flag to allow python console command line argument")
 flags.DEFINE_string("pretrain_data_folder", Path(READ_ONLY_ROOT, "data/pretraining").as_posix(),
@@ -71,6 +86,19 @@ flags.DEFINE_float("learning_rate", 10e-8, "Initial learning rate")
 
 flags.DEFINE_string("blob_folder", Path(READ_ONLY_ROOT, "blobs").as_posix(),
                     "Path to store pickled versions of the pretraining data")
+flags.DEFINE_integer("nb_tokenization_workers", 1,
+                     "Number of processes to tokenize the pretraining corpora with when creating the id tensors. "
+                     "1 tokenizes serially in the main process.")
+flags.DEFINE_integer("nb_loader_workers", 0,
+                     "Number of DataLoader worker processes per GPU that prefetch pretraining batches. "
+                     "0 loads batches in the training process.")
+flags.DEFINE_bool("pack_sequences", False,
+                  "If True, pretraining rows are filled with consecutive texts separated by [SEP] tokens, instead of "
+                  "holding (a piece of) one padded text each. Attention is restricted to tokens of the same text.")
+flags.DEFINE_integer("max_tokens_per_batch", 0,
+                     "If positive, pretraining batches group rows of similar length, with as many rows as fit in this "
+                     "many tokens when padded to the longest row of the batch. If 0, batches are d_batch rows padded "
+                     "to max_seq_length.")
 flags.DEFINE_bool("old_pretrain_data", False,
                   "Whether to do pretraining on an old version of the pretraining data: only the train split of the Gutenberg corpus.")
 
@@ -78,6 +106,13 @@ flags.DEFINE_bool("old_pretrain_data", False,
 flags.DEFINE_string("objective", "simple_mlm",
                     "Name of the denoising objective to use (see OBJECTIVE_MAPPING)")
 flags.DEFINE_float("masking_fraction", .15, "Fraction of tokens to be masked during MLM pretraining")
+flags.DEFINE_bool("mask_replacement_80_10_10", False,
+                  "If True, as in BERT, 80% of the tokens selected for MLM are replaced by a mask token, 10% by a "
+                  "random token and 10% are kept. If False, all of them are replaced by a mask token.")
+flags.DEFINE_float("mean_span_length", 1.,
+                   "For the t5_mlm objective: length of the spans of tokens that are masked together. With 1, tokens "
+                   "are selected independently, and only adjacent selected tokens form a span.")
+flags.DEFINE_bool("whole_word_masking", False, "If True, all tokens of a word are masked together during MLM")
 
 # Flags that determine what the model looks like
 flags.DEFINE_string("model", "my_model", "Name of the model to use (see MODEL_MAPPING)")
@@ -96,13 +131,35 @@ flags.DEFINE_integer("nb_feedforward_layers", 2,
                      "Number of layers in the feedforward subcomponents of the transformer.")
 flags.DEFINE_string("activation", "gelu", "Type of nonlinearity to use.")
 flags.DEFINE_string("pos_embeddings", "absolute", "Type of positional encoding to use.")
+flags.DEFINE_string("attention_backend", "explicit",
+                    "How to compute attention: \"explicit\" with separate matrix multiplications and softmax, or "
+                    "\"sdpa\" with torch's fused scaled_dot_product_attention (needs torch >= 2.0)")
 flags.DEFINE_integer("relative_attention_num_buckets", 32,
                      "Number of different position embeddings if the flag pos_embeddings is 'relative' .")
 flags.DEFINE_float("layernorm_eps", 10e-12,
                    "Epsilon to use for Layernorm. Different than default to be in sync with HF Albert")
+flags.DEFINE_integer("checkpoint_every_k_layers", 0,
+                     "If positive, the encoder layers are run in segments of this many layers with activation "
+                     "checkpointing: only the input of each segment is kept for the backward pass, the rest (including "
+                     "the DIR contextualizer passes) is recomputed. Saves memory at the cost of an extra forward pass.")
 flags.DEFINE_integer("top_down_distance", 2,
                      "For internal prediction: number of layers to feed masked internal activations through before using result to predict masked activation")
 
+# Benchmarks
+flags.DEFINE_string("benchmark", "", "Name of the benchmark for benchmarks.py to run (see BENCHMARK_MAPPING there). "
+                                     "Runs all of them if empty.")
+flags.DEFINE_integer("nb_benchmark_calls", 100, "Number of timed calls per benchmarked variant")
+
+flags.DEFINE_string("precision", "fp32",
+                    "Precision to train in: \"fp32\", or mixed precision with autocast in \"bf16\" or \"fp16\" "
+                    "(GPU only, with loss scaling)")
+flags.DEFINE_bool("sparse_prediction", False,
+                  "If True, the LM head only predicts the masked positions during pretraining, instead of computing "
+                  "[d_batch, seq_length, vocab_size] scores of which only the masked ones count for the loss. "
+                  "Outside of training, scores are still computed for every position.")
+flags.DEFINE_bool("compile_model", False, "If True, the forward pass of the pretraining model is compiled with "
+                                           "torch.compile (needs torch >= 2.0)")
+
 # Distributed training stuff
 flags.DEFINE_list("device_idxs", get_gpus_with_enough_memory(),
                   "List of GPU indices. -1 for CPU. Defaults to the GPUs with at least 8000 MiB memory")
@@ -147,6 +204,10 @@ FLAGS(sys.argv)
 
 def process_flags():
     assert (not FLAGS.manual_seed == 0), "Set a strictly positive manual seed. Zero is counted as not setting a seed."
+    assert FLAGS.precision in ['fp32', 'fp16', 'bf16'], f"Unknown precision {FLAGS.precision}"
+    assert FLAGS.nb_accumulation_steps >= 1, "Set nb_accumulation_steps to at least 1"
+    assert FLAGS.nb_memory_bank_negatives == 0 or FLAGS.DIR == 'combo', \
+        "A memory bank of negatives is only supported for combo DIR"
     FLAGS.device_idxs = [int(idx) for idx in FLAGS.device_idxs][:FLAGS.max_GPUs]
     assert not (FLAGS.pretrained_model and FLAGS.saved_pretrained_model_path), \
         "You should specify only one of \"saved_pretrained_model_path\" and \"saved_pretrained_model_path\""
@@ -161,7 +222,7 @@ from objectives import *
 
 OBJECTIVE_MAPPING = OrderedDict(
     [
-        ("t5_mlm", t5_denoise_spans_objective,),
+        ("t5_mlm", t5_span_MLM_objective,),
         ("simple_mlm", BERT_MLM_objective,),
     ]
 )
@@ -1,5 +1,4 @@
 """ Helper functions to evaluate a model on a dataset """
-import itertools
 import json
 import logging as log
 import os
@@ -26,6 +25,7 @@ from jiant.tasks.tasks import (
 )
 from jiant.tasks.qa import MultiRCTask, ReCoRDTask, QASRLTask
 from jiant.tasks.edge_probing import EdgeProbingTask
+from jiant.utils.serialize import slice_records
 from jiant.utils.utils import get_output_attribute
 
 
@@ -100,7 +100,7 @@ def evaluate(
         assert split in ["train", "val", "test"]
         dataset = getattr(task, "%s_data" % split)
         if FLAGS.SG_max_data_size >= 0:
-            generator = iterator(list(itertools.islice(dataset,FLAGS.SG_max_data_size)), num_epochs=1, shuffle=False)
+            generator = iterator(slice_records(dataset, 0, FLAGS.SG_max_data_size), num_epochs=1, shuffle=False)
         else:
             generator = iterator(dataset, num_epochs=1, shuffle=False)
         for batch_idx, batch in enumerate(generator):
@@ -14,8 +14,9 @@ import _pickle as pkl  # :(
 import io
 import itertools
 import logging as log
+import multiprocessing
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
 from typing import List, Dict, Union, Any
 
 import numpy as np
@@ -51,9 +52,16 @@ from jiant.tasks import (
     ALL_SEQ2SEQ_TASKS,
 )
 from jiant.tasks import REGISTRY as TASKS_REGISTRY
+from jiant.tasks.edge_probing import EdgeProbingTask
 from jiant.tasks.seq2seq import Seq2SeqTask
 from jiant.tasks.tasks import SequenceGenerationTask, Task
 from jiant.utils import config, serialize, utils
+from jiant.utils.preproc_cache import (
+    PreprocCache,
+    get_files_fingerprint,
+    get_indexers_config,
+    get_vocab_hash,
+)
 from jiant.utils.options import parse_task_list_arg
 from allennlp.data.token_indexers.token_indexer import TokenIndexer
 
@@ -97,7 +105,7 @@ def _get_instance_generator(task_name, split, preproc_dir, fraction=None,indexer
 def _indexed_instance_generator(instance_iter, vocab):
     """Yield indexed instances. Instances are modified in-place.
 
-    TODO(iftenney): multiprocess the $%^& out of this.
+    See _parallel_indexed_instance_generator for a multiprocess version.
 
     Args:
         instance_iter: iterable(Instance) of examples
@@ -113,6 +121,54 @@ def _indexed_instance_generator(instance_iter, vocab):
         yield instance
 
 
+# Number of instances sent to an indexing worker at once.
+INDEXING_CHUNK_SIZE = 512
+
+# Vocabulary of an indexing worker process, set once when the worker starts.
+_worker_vocab = None
+
+
+def _init_indexing_worker(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _index_chunk(instances):
+    return list(_indexed_instance_generator(instances, _worker_vocab))
+
+
+def _parallel_indexed_instance_generator(instance_iter, vocab, num_workers):
+    """Yield indexed instances, indexed in num_workers processes.
+
+    Instances are sent to the workers in chunks, and yielded in the order they came in. At most
+    2 * num_workers chunks are in flight at any time, so memory use doesn't grow with the
+    number of instances, and the caller can serialize earlier chunks while later ones are
+    being indexed.
+
+    Args:
+        instance_iter: iterable(Instance) of examples
+        vocab: Vocabulary for use in indexing, sent to every worker once
+
+    Yields:
+        Instance with indexed fields. These are copies of the input instances, not the input
+        instances modified in-place.
+    """
+    pending = deque()
+    with multiprocessing.Pool(
+        num_workers, initializer=_init_indexing_worker, initargs=(vocab,)
+    ) as pool:
+        instance_iter = iter(instance_iter)
+        while True:
+            chunk = list(itertools.islice(instance_iter, INDEXING_CHUNK_SIZE))
+            if not chunk:
+                break
+            pending.append(pool.apply_async(_index_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
 def del_field_tokens(instance):
     """ Save memory by deleting the tokens that will no longer be used.
     Only works if Instances have fields 'input1' and 'input2'.
@@ -129,7 +185,9 @@ def del_field_tokens(instance):
         del field.tokens
 
 
-def _index_split(task, split, indexers, vocab, record_file, model_preprocessing_interface):
+def _index_split(
+    task, split, indexers, vocab, record_file, model_preprocessing_interface, num_workers=0
+):
     """Index instances and stream to disk.
     Args:
         task: Task instance
@@ -139,6 +197,8 @@ def _index_split(task, split, indexers, vocab, record_file, model_preprocessing_
         record_file: (string) file to write serialized Instances to
         model_preprocessing_interface: packed information from model that effects the task data,
             including whether to concatenate sentence pair, and how to mark the sentence boundary
+        num_workers: (int) if positive, index in this many processes, while this process
+            serializes the indexed instances
     """
     log_prefix = "\tTask %s (%s)" % (task.name, split)
     log.info("%s: Indexing from scratch.", log_prefix)
@@ -168,7 +228,11 @@ def _index_split(task, split, indexers, vocab, record_file, model_preprocessing_
     instance_iter = _counter_iter(instance_iter)
 
     # Actually call generators and stream to disk.
-    serialize.write_records(_indexed_instance_generator(instance_iter, vocab), record_file)
+    if num_workers > 0:
+        indexed_instance_iter = _parallel_indexed_instance_generator(instance_iter, vocab, num_workers)
+    else:
+        indexed_instance_iter = _indexed_instance_generator(instance_iter, vocab)
+    serialize.write_records(indexed_instance_iter, record_file)
     log.info("%s: Saved %d instances to %s", log_prefix, _instance_counter, record_file)
 
 
@@ -280,6 +344,16 @@ class DIRTIndexerWrapper:
     def __init__(self, tokenizer_name):
         self.tokenizer_name = tokenizer_name
 
+    def cache_key(self):
+        """What the indices depend on, for the preprocessing cache"""
+        tokenizer = get_my_tokenizer()
+        return {
+            "tokenizer_name": self.tokenizer_name,
+            "tokenizer_class": type(tokenizer).__name__,
+            "hf_model_handle": FLAGS.hf_model_handle,
+            "vocab_size": len(tokenizer),
+        }
+
     def count_vocab_items(self, token: Token, counter: Dict[str, Dict[str, int]]):
         # If `text_id` is set on the token (e.g., if we're using some kind of hash-based word
         # encoding), we will not be using the vocab for this token.
@@ -427,12 +501,58 @@ def build_tasks(
         ' = "task1,task2,..."")',
     )
 
+    preproc_cache = None
+    if args.preproc_cache_dir:
+        preproc_cache = PreprocCache(args.preproc_cache_dir, max_size_gb=args.preproc_cache_max_gb)
+        # What the records of every task and split depend on
+        cache_description = {
+            "input_module": args.input_module,
+            "tokenizer": args.tokenizer,
+            "max_seq_len": args.max_seq_len,
+            "vocab": get_vocab_hash(vocab),
+            "indexers": get_indexers_config(indexers),
+        }
+
     for task in tasks:
         force_reindex = args.reload_indexing and task.name in reindex_tasks
         for split in ALL_SPLITS:
             log_prefix = "\tTask '%s', split '%s'" % (task.name, split)
             # To store preprocessed data for models that use different indexers in the same exp directory
             indexer = input_module_tokenizer_name(args.input_module)
+            data_fingerprint = None
+            if preproc_cache is not None:
+                data_fingerprint = get_files_fingerprint(getattr(task, "path", None))
+                if data_fingerprint is None:
+                    # Without it, records of changed data would be reused
+                    log.info("%s: Not cached, as the task has no data path to fingerprint", log_prefix)
+            if data_fingerprint is not None:
+                record_file = _get_serialized_record_path(task.name, split, preproc_dir, indexer)
+                description = dict(
+                    cache_description,
+                    task=task.name,
+                    task_class=type(task).__qualname__,
+                    task_max_seq_len=getattr(task, "max_seq_len", None),
+                    split=split,
+                    data=data_fingerprint,
+                )
+                key = preproc_cache.get_key(description)
+                if force_reindex or not preproc_cache.fetch(key, record_file, log_prefix):
+                    # Writing through a link would overwrite the records of the cache entry
+                    if os.path.lexists(record_file):
+                        os.remove(record_file)
+                    _index_split(
+                        task,
+                        split,
+                        indexers,
+                        vocab,
+                        record_file,
+                        model_preprocessing_interface,
+                        num_workers=args.preprocess_workers,
+                    )
+                    preproc_cache.store(
+                        key, record_file, description, log_prefix, replace=force_reindex
+                    )
+                continue
             relative_path = _get_serialized_record_path(task.name, split, "preproc",indexer)
             cache_found =_find_cached_file(
                 args.exp_dir, args.global_ro_exp_dir, relative_path, log_prefix=log_prefix #TODO change global one to point to arwen, and local one to be in one exp folder with diff runs
@@ -444,7 +564,13 @@ def build_tasks(
                     os.remove(record_file)
 
                 _index_split(
-                    task, split, indexers, vocab, record_file, model_preprocessing_interface
+                    task,
+                    split,
+                    indexers,
+                    vocab,
+                    record_file,
+                    model_preprocessing_interface,
+                    num_workers=args.preprocess_workers,
                 )
 
         # Delete in-memory data - we'll lazy-load from disk later.
@@ -521,6 +647,8 @@ def _get_task(name: str, args: config.Params, data_path: str, scratch_path: str)
             task_kw["probe_path"] = args["nli-prob"].probe_path
         if name in ALL_SEQ2SEQ_TASKS:
             task_kw["max_targ_v_size"] = args.max_targ_word_v_size
+        if issubclass(task_cls, EdgeProbingTask):
+            task_kw["records_in_memory"] = bool(args.edges_records_in_memory)
         task_src_path = os.path.join(data_path, rel_path)
         task = task_cls(
             task_src_path,
@@ -1,6 +1,7 @@
 """Task definitions for edge probing."""
 import collections
 import itertools
+import json
 import logging as log
 import os
 from typing import Dict, Iterable, List, Sequence, Type
@@ -20,6 +21,50 @@ from jiant.tasks.tasks import Task, sentence_to_text_field
 # Class definitions for edge probing. See below for actual task registration.
 
 
+class EdgeProbingRecords(object):
+    """ Repeatable iterable over the records of an edge probing data file.
+
+    Records with empty targets are skipped. The file is read once on construction, to count the
+    records, and parsed again on every pass: parsed records take several times the memory of the
+    file. With in_memory, the lines of the records are kept as bytes, so passes don't read the
+    file again.
+    """
+
+    def __init__(self, filename: str, in_memory: bool = False):
+        self.filename = filename
+        self._lines = [] if in_memory else None
+        skip_ctr = 0
+        total_ctr = 0
+        with open(filename, "rb") as fd:
+            for line in fd:
+                total_ctr += 1
+                # TODO(ian): don't do this if generating negatives!
+                if not self._has_targets(json.loads(line)):
+                    skip_ctr += 1
+                elif self._lines is not None:
+                    self._lines.append(line)
+        self._length = total_ctr - skip_ctr
+        log.info("Read=%d, Skip=%d, Total=%d from %s", self._length, skip_ctr, total_ctr, filename)
+
+    @staticmethod
+    def _has_targets(record):
+        return bool(record.get("targets", None))
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self._lines is not None:
+            for line in self._lines:
+                yield json.loads(line)
+            return
+        with open(self.filename, "rb") as fd:
+            for line in fd:
+                record = json.loads(line)
+                if self._has_targets(record):
+                    yield record
+
+
 class EdgeProbingTask(Task):
     """ Generic class for fine-grained edge probing.
 
@@ -56,6 +101,7 @@ class EdgeProbingTask(Task):
         label_file: str = None,
         files_by_split: Dict[str, str] = None,
         single_sided: bool = False,
+        records_in_memory: bool = False,
         **kw,
     ):
         """Construct an edge probing task.
@@ -72,6 +118,8 @@ class EdgeProbingTask(Task):
             files_by_split: split name ('train', 'val', 'test') mapped to
                 relative filenames (e.g. 'train': 'train.json')
             single_sided: if true, only use span1.
+            records_in_memory: if true, keep the raw records of each split in memory, instead of
+                reading them from disk on every pass.
         """
         super().__init__(name, **kw)
 
@@ -85,6 +133,7 @@ class EdgeProbingTask(Task):
         self.label_file = os.path.join(self.path, label_file)
         self.max_seq_len = max_seq_len
         self.single_sided = single_sided
+        self.records_in_memory = records_in_memory
 
         # Placeholders; see self.load_data()
         self._iters_by_split = None
@@ -104,26 +153,6 @@ class EdgeProbingTask(Task):
     def get_all_labels(self) -> List[str]:
         return self.all_labels
 
-    @classmethod
-    def _stream_records(cls, filename):
-        skip_ctr = 0
-        total_ctr = 0
-        for record in utils.load_json_data(filename):
-            total_ctr += 1
-            # Skip records with empty targets.
-            # TODO(ian): don't do this if generating negatives!
-            if not record.get("targets", None):
-                skip_ctr += 1
-                continue
-            yield record
-        log.info(
-            "Read=%d, Skip=%d, Total=%d from %s",
-            total_ctr - skip_ctr,
-            skip_ctr,
-            total_ctr,
-            filename,
-        )
-
     @staticmethod
     def merge_preds(record: Dict, preds: Dict) -> Dict:
         """ Merge predictions into record, in-place.
@@ -151,12 +180,7 @@ class EdgeProbingTask(Task):
         self.n_classes = len(self.all_labels)
         iters_by_split = collections.OrderedDict()
         for split, filename in self._files_by_split.items():
-            #  # Lazy-load using RepeatableIterator.
-            #  loader = functools.partial(utils.load_json_data,
-            #                             filename=filename)
-            #  iter = serialize.RepeatableIterator(loader)
-            iter = list(self._stream_records(filename))
-            iters_by_split[split] = iter
+            iters_by_split[split] = EdgeProbingRecords(filename, in_memory=self.records_in_memory)
         self._iters_by_split = iters_by_split
 
     def get_split_text(self, split: str):
@@ -20,7 +20,7 @@ from allennlp.training.learning_rate_schedulers import (  # pylint: disable=impo
     LearningRateScheduler,
 )
 from allennlp.training.optimizers import Optimizer  # pylint: disable=import-error
-from jiant.utils.serialize import RepeatableIterator
+from jiant.utils.serialize import slice_records
 from tensorboardX import SummaryWriter  # pylint: disable=import-error
 from torch.nn.utils.clip_grad import clip_grad_norm_
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -346,7 +346,7 @@ class SamplingMultiTaskTrainer:
             # repeatable_iterable(task.train_data, nb_held_out_samples, data_end)
             # task_info["tr_generator"] = iterator(RepeatableIterator(lambda : (yield from itertools.islice(task.train_data, nb_held_out_samples, data_end))),
             #                                      num_epochs=None)
-            task_info["tr_generator"] = iterator(RepeatableIterator(lambda : (itertools.islice(task.train_data, nb_held_out_samples, data_end))),
+            task_info["tr_generator"] = iterator(slice_records(task.train_data, nb_held_out_samples, data_end),
                                                  num_epochs=None)
             n_training_examples = data_end - nb_held_out_samples
 
@@ -846,7 +846,7 @@ class SamplingMultiTaskTrainer:
         log.info("Validating on held-out part of train set ...")
         nb_held_out_samples = task.n_train_examples // 10
         val_generator = BasicIterator(batch_size, instances_per_epoch=max_data_points)(
-            RepeatableIterator(lambda: (yield from itertools.islice(task.train_data, nb_held_out_samples))),
+            slice_records(task.train_data, 0, nb_held_out_samples),
             num_epochs=1, shuffle=False)
         # val_generator = BasicIterator(batch_size, instances_per_epoch=max_data_points)(task.val_data, num_epochs=1, shuffle=False)
         n_val_batches = math.ceil(max_data_points / batch_size)
@@ -0,0 +1,211 @@
+"""Content-addressed cache of indexed task data.
+
+Entries are keyed by a hash of everything that the indexed records depend on: the task's raw
+data files, the tokenizer, max_seq_len, the vocabulary and the indexers. A changed input gives a
+different key, so stale records are never reused, and an unchanged one is found again by any run
+that shares the cache directory.
+
+Layout of the cache directory:
+    <cache_dir>/<key>/records: the record file
+    <cache_dir>/<key>/records.idx: its index sidecar, if it has one
+    <cache_dir>/<key>/manifest.json: what the key was computed from, and the size of the records.
+        Its modification time is the last time the entry was used, for LRU eviction.
+Entries are built in a temporary directory and renamed into place, so readers only ever see
+complete entries. Runs use an entry through a hard link in their own preproc dir, so evicting it
+from the cache doesn't pull the data from under a run that is reading it.
+"""
+
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import tempfile
+import time
+
+from jiant.utils.serialize import INDEX_SUFFIX
+
+# Bump when the way records are built changes, to invalidate all existing entries
+CACHE_VERSION = 1
+RECORDS_NAME = "records"
+MANIFEST_NAME = "manifest.json"
+
+
+def _hash_json(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_files_fingerprint(path):
+    """Fingerprint of the files at path (a file or a directory): their relative paths, sizes and
+    modification times. Cheap even for large datasets, as no file is read. None if there is no
+    such path: callers must not cache anything then, as changes can't be detected."""
+    if path is None or not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [[os.path.basename(path), stat.st_size, int(stat.st_mtime)]]
+    fingerprint = []
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            stat = os.stat(file_path)
+            fingerprint.append(
+                [os.path.relpath(file_path, path), stat.st_size, int(stat.st_mtime)]
+            )
+    return fingerprint
+
+
+def get_vocab_hash(vocab):
+    """Hash of the token of every index, in every namespace of an AllenNLP Vocabulary."""
+    sha = hashlib.sha1()
+    for namespace in sorted(vocab._index_to_token.keys()):
+        index_to_token = vocab.get_index_to_token_vocabulary(namespace)
+        tokens = [index_to_token[i] for i in range(len(index_to_token))]
+        sha.update(json.dumps([namespace, tokens]).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_indexers_config(indexers):
+    """Configuration of every indexer: its cache_key() if it has one, else its simple attributes."""
+    config = {}
+    for name, indexer in sorted(indexers.items()):
+        if hasattr(indexer, "cache_key"):
+            attributes = indexer.cache_key()
+        else:
+            attributes = {
+                k: v
+                for k, v in vars(indexer).items()
+                if v is None or isinstance(v, (bool, int, float, str))
+            }
+        config[name] = [type(indexer).__module__ + "." + type(indexer).__qualname__, attributes]
+    return config
+
+
+class PreprocCache(object):
+    """Content-addressed cache of record files, with LRU eviction.
+
+    Args:
+        cache_dir: (string) directory of the cache, can be shared by several runs at once
+        max_size_gb: (float) if positive, least recently used entries are evicted when the records
+            in the cache take more than this
+    """
+
+    def __init__(self, cache_dir, max_size_gb=0):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(description):
+        """Key of an entry, from a json-serializable description of all its records depend on."""
+        return _hash_json({"cache_version": CACHE_VERSION, **description})
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, record_file, log_prefix=""):
+        """If key has an entry, makes record_file a link to its records and returns True."""
+        entry_dir = self._entry_dir(key)
+        try:
+            _link(os.path.join(entry_dir, RECORDS_NAME), record_file)
+            _link_index(os.path.join(entry_dir, RECORDS_NAME), record_file)
+            # Marks the entry as recently used
+            os.utime(os.path.join(entry_dir, MANIFEST_NAME))
+        except FileNotFoundError:  # Not in the cache, or evicted just now
+            return False
+        log.info("%s: Found cached copy %s in %s", log_prefix, key, self.cache_dir)
+        return True
+
+    def store(self, key, record_file, description, log_prefix="", replace=False):
+        """Adds record_file to the cache under key, without copying it. If replace, an existing
+        entry for key is replaced (e.g. when reindexing on purpose), else the existing one is kept."""
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        _link(record_file, os.path.join(tmp_dir, RECORDS_NAME))
+        _link_index(record_file, os.path.join(tmp_dir, RECORDS_NAME))
+        manifest = {
+            "key": key,
+            "description": description,
+            "size": os.path.getsize(record_file),
+            "created": time.time(),
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        if replace and self._remove_entry(key):
+            log.info("%s: Replacing %s in %s", log_prefix, key, self.cache_dir)
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+            log.info("%s: Stored as %s in %s", log_prefix, key, self.cache_dir)
+        except OSError:  # Another run stored the same entry first
+            log.info("%s: %s was already stored in %s", log_prefix, key, self.cache_dir)
+            shutil.rmtree(tmp_dir)
+        self.evict(keep=key)
+
+    def _remove_entry(self, key):
+        """Removes the entry for key, returns False if there was none. The entry is renamed away
+        first, so no run can find it half-deleted."""
+        doomed_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        try:
+            os.rename(self._entry_dir(key), os.path.join(doomed_dir, key))
+            return True
+        except OSError:  # Not in the cache, or already removed by another run
+            return False
+        finally:
+            shutil.rmtree(doomed_dir)
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits in max_size_gb. The entry
+        keep, if given, is never evicted, even if it doesn't fit on its own."""
+        if self.max_size_gb <= 0:
+            return
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self._entry_dir(key), MANIFEST_NAME)
+            try:
+                with open(manifest_path) as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(manifest_path), size, key))
+            except (OSError, ValueError, KeyError):  # Temporary, half-evicted or foreign dirs
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        max_size = self.max_size_gb * 2 ** 30
+        for _, size, key in sorted(entries):
+            if total_size <= max_size:
+                break
+            if key == keep:
+                continue
+            if self._remove_entry(key):
+                log.info("Evicted %s from preprocessing cache %s", key, self.cache_dir)
+                total_size -= size
+
+
+def _link_index(source, destination):
+    """Links the index sidecar of record file source to that of destination, if there is one.
+    Without it, the index is rebuilt when destination is first read."""
+    try:
+        _link(source + INDEX_SUFFIX, destination + INDEX_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def _link(source, destination):
+    """Points destination to the data of source, replacing whatever is at destination.
+
+    Uses a hard link where possible, so the data stays available to destination if source is
+    removed. Falls back to a symlink across file systems.
+    """
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    tmp_destination = destination + ".linking"
+    if os.path.lexists(tmp_destination):
+        os.remove(tmp_destination)
+    try:
+        os.link(source, tmp_destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        log.warning(
+            "Can't hard link %s, using a symlink: evicting it will break %s", source, destination
+        )
+        os.symlink(os.path.abspath(source), tmp_destination)
+    os.replace(tmp_destination, destination)
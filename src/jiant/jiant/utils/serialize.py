@@ -1,32 +1,442 @@
 # Serialization and deserialization helpers.
-# Write arbitrary pickle-able Python objects to a record file, with one object
-# per line as a base64-encoded pickle.
+# Write arbitrary pickle-able Python objects to a record file. Two formats are supported:
+#   - binary (the default): length-prefixed records in a compact binary encoding, with a
+#     random-access index. See _RecordEncoder for the encoding.
+#   - legacy: one object per line as a base64-encoded pickle.
+# read_records detects which format a file is in.
+# Both formats get an index sidecar (<record file>.idx) with the offset and hash of every record,
+# so subsets of records are read by seeking to them, without reading the records in between.
 
 import _pickle as pkl
 import base64
+import collections
+import importlib
+import itertools
+import logging as log
+import mmap
+import os
+import struct
+import tempfile
 from zlib import crc32
 
+import numpy as np
+
+# Binary record files are laid out as
+#   MAGIC | (uint32 length, payload) per record | pickled footer | TRAILER(footer offset, MAGIC)
+# The footer holds what is shared by all records, stored once: the classes of the encoded
+# objects, the templates with their attributes that couldn't be encoded per record (e.g. token
+# indexers), and the offset of every record.
+MAGIC = b"JNTREC01"
+_LENGTH = struct.Struct("<I")
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_OBJECT = struct.Struct("<II")
+_TRAILER = struct.Struct("<Q8s")
+# Index sidecars are INDEX_MAGIC followed by a pickled dict with the size and modification time
+# of the record file they index, and the offset and crc32 hash of every record in it
+INDEX_MAGIC = b"JNTIDX01"
+INDEX_SUFFIX = ".idx"
+_INT32_MIN, _INT32_MAX = -(2 ** 31), 2 ** 31 - 1
+_INT64_MIN, _INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+# Tags as bytes objects by their value, to compare tags read from a memoryview without slicing it
+_TAGS = [bytes((i,)) for i in range(256)]
+# Number of template values whose pickle the encoder remembers across records
+_MAX_MEMOIZED_VALUES = 16
+
+
+class _RecordEncoder(object):
+    """Encodes records without pickle.
+
+    Values are encoded as a one-byte tag followed by their contents: None, bools, ints, floats,
+    strings and bytes directly, lists of ints as packed int32 or int64 arrays, other lists,
+    tuples and dicts element by element, numpy arrays as raw buffers. AllenNLP Instances, Fields
+    and Tokens are encoded as their class, a template, and their encodable attributes. The
+    template holds the attributes that aren't encodable, and is shared by all objects that have
+    the same such attributes. Objects that occur more than once in a record (e.g. the TextField a
+    SpanField points to) are encoded once and referred to afterwards.
+    """
+
+    def __init__(self):
+        from allennlp.data import Instance, Token
+        from allennlp.data.fields import Field
+
+        self._object_types = (Instance, Field, Token)
+        self.classes = []
+        self._class_indices = {}
+        self.templates = []
+        self._template_indices = {}
+        # Pickles of the most recently seen template values, by id. The values are kept alive with
+        # their pickle, so their id can't be reused by another object while they are in here.
+        self._value_keys = collections.OrderedDict()
+        # Unpicklable template values, by id. They are kept alive by self.templates anyway.
+        self._unpicklable_values = {}
+
+    def encode(self, example):
+        if not self._is_encodable(example):
+            raise ValueError(
+                "%s can't be stored as a binary record, write with binary=False" % type(example).__name__
+            )
+        out = []
+        self._encode(example, out, {})
+        return b"".join(out)
+
+    def _is_record_object(self, value):
+        # Objects that customize pickling can't simply be rebuilt from their __dict__
+        return (
+            isinstance(value, self._object_types)
+            and hasattr(value, "__dict__")
+            and getattr(type(value), "__setstate__", None) is None
+        )
+
+    def _is_encodable(self, value):
+        value_type = type(value)
+        if value is None or value_type in (bool, float, str, bytes):
+            return True
+        if value_type is int:
+            return _INT64_MIN <= value <= _INT64_MAX
+        if value_type in (list, tuple):
+            return all(self._is_encodable(element) for element in value)
+        if value_type is dict:
+            return all(self._is_encodable(k) and self._is_encodable(v) for k, v in value.items())
+        if value_type is np.ndarray or isinstance(value, np.generic):
+            return value.dtype != object
+        return self._is_record_object(value)
+
+    def _get_class_index(self, cls):
+        key = (cls.__module__, cls.__qualname__)
+        if key not in self._class_indices:
+            self._class_indices[key] = len(self.classes)
+            self.classes.append(key)
+        return self._class_indices[key]
+
+    def _get_value_key(self, value):
+        """Key for a template value that is the same for equal values, also if they are different objects.
+
+        Objects are compared by their pickle. Indexed instances that come from other processes each
+        bring their own copy of e.g. the token indexers, which should still share one template.
+        Objects shared by many records, as indexers are within one process, are only pickled once:
+        the pickles of the last _MAX_MEMOIZED_VALUES objects are remembered, so memory doesn't grow
+        with the number of records.
+        """
+        if value is None or type(value) in (bool, int, float, str):
+            return value
+        memoized = self._value_keys.get(id(value))
+        if memoized is not None:
+            self._value_keys.move_to_end(id(value))
+            return memoized[1]
+        try:
+            key = pkl.dumps(value, protocol=4)
+        except Exception:  # Unpicklable values are only equal to themselves
+            self._unpicklable_values.setdefault(id(value), value)
+            key = ("id", id(value))
+        self._value_keys[id(value)] = (value, key)
+        if len(self._value_keys) > _MAX_MEMOIZED_VALUES:
+            self._value_keys.popitem(last=False)
+        return key
+
+    def _get_template_index(self, class_index, template):
+        key = (class_index,) + tuple(
+            sorted((k, self._get_value_key(v)) for k, v in template.items())
+        )
+        if key not in self._template_indices:
+            self._template_indices[key] = len(self.templates)
+            self.templates.append(template)
+        return self._template_indices[key]
+
+    def _encode(self, value, out, memo):
+        value_type = type(value)
+        if value is None:
+            out.append(b"N")
+        elif value_type is bool:
+            out.append(b"T" if value else b"F")
+        elif value_type is int:
+            out.append(b"i" + _INT64.pack(value))
+        elif value_type is float:
+            out.append(b"f" + _FLOAT64.pack(value))
+        elif value_type is str:
+            encoded = value.encode("utf-8")
+            out.append(b"s" + _LENGTH.pack(len(encoded)) + encoded)
+        elif value_type is bytes:
+            out.append(b"y" + _LENGTH.pack(len(value)) + value)
+        elif value_type is list and value and all(type(element) is int for element in value):
+            is_int32 = _INT32_MIN <= min(value) and max(value) <= _INT32_MAX
+            array = np.asarray(value, dtype=np.int32 if is_int32 else np.int64)
+            out.append((b"a" if is_int32 else b"A") + _LENGTH.pack(len(array)) + array.tobytes())
+        elif value_type in (list, tuple):
+            out.append((b"l" if value_type is list else b"u") + _LENGTH.pack(len(value)))
+            for element in value:
+                self._encode(element, out, memo)
+        elif value_type is dict:
+            out.append(b"d" + _LENGTH.pack(len(value)))
+            for k, v in value.items():
+                self._encode(k, out, memo)
+                self._encode(v, out, memo)
+        elif value_type is np.ndarray or isinstance(value, np.generic):
+            array = np.ascontiguousarray(value)
+            dtype = array.dtype.str.encode("ascii")
+            out.append(
+                (b"n" if value_type is np.ndarray else b"g")
+                + _LENGTH.pack(len(dtype))
+                + dtype
+                + _LENGTH.pack(array.ndim)
+                + b"".join(_LENGTH.pack(dim) for dim in array.shape)
+                + array.tobytes()
+            )
+        elif id(value) in memo:
+            out.append(b"r" + _LENGTH.pack(memo[id(value)]))
+        else:
+            memo[id(value)] = len(memo)
+            attributes, template = {}, {}
+            for k, v in value.__dict__.items():
+                (attributes if self._is_encodable(v) else template)[k] = v
+            class_index = self._get_class_index(type(value))
+            out.append(b"o" + _OBJECT.pack(class_index, self._get_template_index(class_index, template)))
+            self._encode(attributes, out, memo)
+
+
+def _import_class(module_name, qualname):
+    cls = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    return cls
+
+
+class _RecordDecoder(object):
+    """Decodes records encoded by _RecordEncoder."""
+
+    def __init__(self, classes, templates):
+        self._classes = [_import_class(module_name, qualname) for module_name, qualname in classes]
+        self._templates = templates
+
+    def decode(self, payload):
+        value, _ = self._decode(payload, 0, [])
+        return value
+
+    def _decode_length(self, buf, pos):
+        return _LENGTH.unpack_from(buf, pos)[0], pos + _LENGTH.size
+
+    def _decode_array(self, buf, pos):
+        dtype_length, pos = self._decode_length(buf, pos)
+        dtype = np.dtype(bytes(buf[pos : pos + dtype_length]).decode("ascii"))
+        pos += dtype_length
+        ndim, pos = self._decode_length(buf, pos)
+        shape = struct.unpack_from("<%dI" % ndim, buf, pos)
+        pos += ndim * _LENGTH.size
+        count = int(np.prod(shape))
+        array = np.frombuffer(buf, dtype=dtype, count=count, offset=pos).reshape(shape).copy()
+        return array, pos + count * dtype.itemsize
+
+    def _decode(self, buf, pos, memo):
+        tag = _TAGS[buf[pos]]
+        pos += 1
+        if tag == b"d":
+            length, pos = self._decode_length(buf, pos)
+            result = {}
+            for _ in range(length):
+                k, pos = self._decode(buf, pos, memo)
+                result[k], pos = self._decode(buf, pos, memo)
+            return result, pos
+        if tag == b"s":
+            length, pos = self._decode_length(buf, pos)
+            return str(buf[pos : pos + length], "utf-8"), pos + length
+        if tag == b"i":
+            return _INT64.unpack_from(buf, pos)[0], pos + _INT64.size
+        if tag == b"a" or tag == b"A":
+            dtype = np.int32 if tag == b"a" else np.int64
+            length, pos = self._decode_length(buf, pos)
+            array = np.frombuffer(buf, dtype=dtype, count=length, offset=pos)
+            return array.tolist(), pos + length * array.itemsize
+        if tag == b"o":
+            class_index, template_index = _OBJECT.unpack_from(buf, pos)
+            cls = self._classes[class_index]
+            obj = cls.__new__(cls)
+            memo.append(obj)
+            attributes, pos = self._decode(buf, pos + _OBJECT.size, memo)
+            obj.__dict__.update(self._templates[template_index])
+            obj.__dict__.update(attributes)
+            return obj, pos
+        if tag == b"r":
+            index, pos = self._decode_length(buf, pos)
+            return memo[index], pos
+        if tag == b"l" or tag == b"u":
+            length, pos = self._decode_length(buf, pos)
+            result = []
+            for _ in range(length):
+                element, pos = self._decode(buf, pos, memo)
+                result.append(element)
+            return (result if tag == b"l" else tuple(result)), pos
+        if tag == b"N":
+            return None, pos
+        if tag == b"T":
+            return True, pos
+        if tag == b"F":
+            return False, pos
+        if tag == b"f":
+            return _FLOAT64.unpack_from(buf, pos)[0], pos + _FLOAT64.size
+        if tag == b"y":
+            length, pos = self._decode_length(buf, pos)
+            return bytes(buf[pos : pos + length]), pos + length
+        if tag == b"n":
+            return self._decode_array(buf, pos)
+        if tag == b"g":
+            array, pos = self._decode_array(buf, pos)
+            return array[()], pos
+        raise ValueError("Unknown tag %r in record" % tag)
+
+
+class RecordFile(object):
+    """Random access to the records of a binary record file.
+
+    Records are read from a memory map of the file, so opening it only reads the footer.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fd:
+            self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        footer_offset, magic = _TRAILER.unpack_from(self._data, len(self._data) - _TRAILER.size)
+        assert magic == MAGIC, "'%s' is not a binary record file" % filename
+        footer = pkl.loads(self._data[footer_offset : len(self._data) - _TRAILER.size])
+        self._offsets = footer["offsets"]
+        self._decoder = _RecordDecoder(footer["classes"], footer["templates"])
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def get_payload(self, index):
+        """Returns the encoded record at index, as a zero-copy memoryview."""
+        start = int(self._offsets[index])
+        length = _LENGTH.unpack_from(self._data, start)[0]
+        start += _LENGTH.size
+        return memoryview(self._data)[start : start + length]
+
+    def decode(self, payload):
+        return self._decoder.decode(payload)
+
+    def __getitem__(self, index):
+        return self.decode(self.get_payload(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
 
 def _serialize(examples, fd, flush_every):
+    offsets, hashes, position = [], [], 0
     for i, example in enumerate(examples):
         blob = pkl.dumps(example)
         encoded = base64.b64encode(blob)
         fd.write(encoded)
         fd.write(b"\n")
+        offsets.append(position)
+        hashes.append(crc32(blob))
+        position += len(encoded) + 1
         if (i + 1) % flush_every == 0 and hasattr(fd, "flush"):
             fd.flush()
+    return offsets, hashes
 
 
-def write_records(examples, filename, flush_every=10000):
-    """Streaming read records from file.
+def _serialize_binary(examples, fd, flush_every):
+    encoder = _RecordEncoder()
+    fd.write(MAGIC)
+    offsets, hashes, position = [], [], len(MAGIC)
+    for i, example in enumerate(examples):
+        payload = encoder.encode(example)
+        fd.write(_LENGTH.pack(len(payload)))
+        fd.write(payload)
+        offsets.append(position)
+        hashes.append(crc32(payload))
+        position += _LENGTH.size + len(payload)
+        if (i + 1) % flush_every == 0 and hasattr(fd, "flush"):
+            fd.flush()
+    footer = {
+        "classes": encoder.classes,
+        "templates": encoder.templates,
+        "offsets": np.asarray(offsets, dtype=np.int64),
+    }
+    fd.write(pkl.dumps(footer, protocol=4))
+    fd.write(_TRAILER.pack(position, MAGIC))
+    return offsets, hashes
+
+
+def write_records(examples, filename, flush_every=10000, binary=True):
+    """Streaming write records to file.
 
     Args:
       examples: iterable(object), iterable of examples to write
       filename: path to file to write
       flush_every: (int), flush to disk after this many examples consumed
+      binary: if true, write the binary record format, else the legacy one of
+        base64-encoded pickles
     """
     with open(filename, "wb") as fd:
-        _serialize(examples, fd, flush_every)
+        if binary:
+            offsets, hashes = _serialize_binary(examples, fd, flush_every)
+        else:
+            offsets, hashes = _serialize(examples, fd, flush_every)
+    _write_index(filename, offsets, hashes)
+
+
+def _write_index(filename, offsets, hashes):
+    """Writes the index sidecar of filename. Only warns if it can't be written, as the index
+    can always be rebuilt from the record file."""
+    stat = os.stat(filename)
+    index = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "offsets": np.asarray(offsets, dtype=np.int64),
+        "hashes": np.asarray(hashes, dtype=np.uint32),
+    }
+    tmp_filename = None
+    try:
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp_"
+        )
+        with os.fdopen(fd, "wb") as index_fd:
+            index_fd.write(INDEX_MAGIC)
+            index_fd.write(pkl.dumps(index, protocol=4))
+        os.replace(tmp_filename, filename + INDEX_SUFFIX)
+    except OSError as e:
+        log.warning("Can't write record index of %s: %s", filename, e)
+        if tmp_filename is not None and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def _scan_records(filename):
+    """Reads the offset and hash of every record in filename."""
+    offsets, hashes = [], []
+    if is_binary_record_file(filename):
+        records = RecordFile(filename)
+        offsets = records._offsets
+        hashes = [crc32(records.get_payload(index)) for index in range(len(records))]
+    else:
+        with open(filename, "rb") as fd:
+            position = 0
+            for line in fd:
+                offsets.append(position)
+                hashes.append(crc32(base64.b64decode(line)))
+                position += len(line)
+    return offsets, hashes
+
+
+def load_record_index(filename):
+    """Returns the offsets and crc32 hashes of the records in filename, as numpy arrays.
+
+    They are read from the index sidecar of the file. If it is missing or out of date (the record
+    file was rewritten since), the record file is scanned once and the sidecar rewritten.
+    """
+    stat = os.stat(filename)
+    try:
+        with open(filename + INDEX_SUFFIX, "rb") as fd:
+            if fd.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                index = pkl.load(fd)
+                if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                    return index["offsets"], index["hashes"]
+    except (OSError, EOFError, pkl.UnpicklingError, KeyError):
+        pass
+    log.info("Indexing record file %s", filename)
+    offsets, hashes = _scan_records(filename)
+    _write_index(filename, offsets, hashes)
+    return np.asarray(offsets, dtype=np.int64), np.asarray(hashes, dtype=np.uint32)
 
 
 class RepeatableIterator(object):
@@ -49,6 +459,55 @@ class RepeatableIterator(object):
         return self._iter_fn().__iter__()
 
 
+class IndexedRecords(RepeatableIterator):
+    """Repeatable iterator over a selection of the records of a record file.
+
+    Records are read by seeking to them, so records outside the selection are never read.
+    Slicing gives the IndexedRecords of part of the selection, without reading anything.
+
+    Args:
+      filename: path to a record file, of either format
+      offsets: offsets of all records in the file, see load_record_index
+      indices: indices of the selected records, in order
+    """
+
+    def __init__(self, filename, offsets, indices):
+        super().__init__(self._iter_records)
+        self.filename = filename
+        self._offsets = offsets
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("IndexedRecords can only be sliced, got %s" % type(key).__name__)
+        return IndexedRecords(self.filename, self._offsets, self._indices[key])
+
+    def _iter_records(self):
+        if is_binary_record_file(self.filename):
+            records = RecordFile(self.filename)
+            for index in self._indices:
+                yield records[int(index)]
+        else:
+            with open(self.filename, "rb") as fd:
+                for index in self._indices:
+                    fd.seek(int(self._offsets[index]))
+                    yield pkl.loads(base64.b64decode(fd.readline()))
+
+
+def slice_records(records, start, stop=None):
+    """Repeatable iterator over records[start:stop].
+
+    IndexedRecords are sliced without reading the records before start, other iterables are
+    iterated from their beginning.
+    """
+    if isinstance(records, IndexedRecords):
+        return records[start:stop]
+    return RepeatableIterator(lambda: itertools.islice(records, start, stop))
+
+
 def bytes_to_float(b):
     """ Maps a byte string to a float in [0, 1].
 
@@ -57,30 +516,50 @@ def bytes_to_float(b):
     return float(crc32(b) & 0xFFFFFFFF) / 2 ** 32
 
 
+def is_binary_record_file(filename):
+    with open(filename, "rb") as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+
 def read_records(filename, repeatable=False, fraction=None):
     """Streaming read records from file.
 
     Args:
-      filename: path to file of b64-encoded pickles, one per line
+      filename: path to a binary record file, or a file of b64-encoded pickles, one per line
       repeatable: if true, returns a RepeatableIterator that can read the file
         multiple times.
       fraction: if set to a float between 0 and 1, load only the specified percentage
         of examples. Hashing is used to ensure that the same examples are loaded each
-        epoch.
+        epoch. The hash is of the stored record, so a converted file selects different
+        examples than the original. The hashes are kept in the file's index, so examples
+        that aren't selected are never read.
 
     Returns:
-      iterable, possible repeatable, yielding deserialized Python objects
+      iterable, possible repeatable (an IndexedRecords), yielding deserialized Python objects
     """
+    offsets, hashes = load_record_index(filename)
+    if fraction and fraction < 1:
+        # Same selection as bytes_to_float(record) <= fraction
+        indices = np.flatnonzero(hashes.astype(np.float64) / 2 ** 32 <= fraction)
+    else:
+        indices = np.arange(len(offsets))
+    records = IndexedRecords(filename, offsets, indices)
+    return records if repeatable else iter(records)
 
-    def _iter_fn():
-        with open(filename, "rb") as fd:
-            for line in fd:
-                blob = base64.b64decode(line)
-                if fraction and fraction < 1:
-                    hash_float = bytes_to_float(blob)
-                    if hash_float > fraction:
-                        continue
-                example = pkl.loads(blob)
-                yield example
-
-    return RepeatableIterator(_iter_fn) if repeatable else _iter_fn()
+
+def convert_records(filename):
+    """Rewrites a legacy record file in the binary format, in place.
+
+    Symlinks (e.g. to a global preprocessing cache) are followed, so the file they point to is
+    converted. Returns False if the file already was a binary record file.
+    """
+    filename = os.path.realpath(filename)
+    if is_binary_record_file(filename):
+        return False
+    tmp_filename = filename + ".converting"
+    write_records(read_records(filename), tmp_filename)
+    # Renaming keeps the modification time, so the index written with the file stays valid
+    if os.path.exists(tmp_filename + INDEX_SUFFIX):
+        os.replace(tmp_filename + INDEX_SUFFIX, filename + INDEX_SUFFIX)
+    os.replace(tmp_filename, filename)
+    return True
@@ -0,0 +1,27 @@
+"""
+Convert preprocessed record files from base64-encoded pickles to the binary record format.
+Arguments: record files, or directories (e.g. an experiment's preproc dir) in which all
+*__*_data_*tokenized files are converted.
+"""
+
+import glob
+import logging as log
+import os
+import sys
+
+from jiant.utils import serialize
+
+log.basicConfig(format="%(asctime)s: %(message)s", level=log.INFO)
+
+paths = []
+for arg in sys.argv[1:]:
+    if os.path.isdir(arg):
+        paths += sorted(glob.glob(os.path.join(arg, "*__*_data_*tokenized")))
+    else:
+        paths.append(arg)
+
+for path in paths:
+    if serialize.convert_records(path):
+        log.info("Converted %s", path)
+    else:
+        log.info("%s already is a binary record file", path)
@@ -0,0 +1,37 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from jiant.tasks.edge_probing import EdgeProbingRecords
+
+
+class TestEdgeProbingRecords(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, "train.json")
+        self.records = [
+            {"text": "The cat sat .", "targets": [{"span1": [0, 2], "label": "NP"}]},
+            {"text": "Hi .", "targets": []},
+            {"text": "Dogs bark .", "targets": [{"span1": [0, 1], "label": "NNS"}]},
+        ]
+        with open(self.filename, "w") as fd:
+            for record in self.records:
+                fd.write(json.dumps(record) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_skips_records_without_targets(self):
+        for in_memory in (False, True):
+            records = EdgeProbingRecords(self.filename, in_memory=in_memory)
+            self.assertEqual(len(records), 2)
+            self.assertEqual(list(records), [self.records[0], self.records[2]])
+            # Repeatable
+            self.assertEqual(list(records), [self.records[0], self.records[2]])
+
+    def test_in_memory_does_not_reread_file(self):
+        records = EdgeProbingRecords(self.filename, in_memory=True)
+        os.remove(self.filename)
+        self.assertEqual([r["text"] for r in records], ["The cat sat .", "Dogs bark ."])
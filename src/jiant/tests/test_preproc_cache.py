@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from jiant.utils.preproc_cache import PreprocCache, get_files_fingerprint
+
+
+class TestPreprocCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = PreprocCache(os.path.join(self.temp_dir, "cache"))
+        self.description = {"task": "rte", "split": "train", "vocab": "abc"}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_records(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_store_and_fetch(self):
+        key = self.cache.get_key(self.description)
+        record_file = os.path.join(self.temp_dir, "records")
+        self.assertFalse(self.cache.fetch(key, record_file))
+        self.cache.store(key, self.write_records("indexed", "records of run 1"), self.description)
+        self.assertTrue(self.cache.fetch(key, record_file))
+        self.assertEqual(self.read(record_file), "records of run 1")
+
+    def test_store_replaces_existing_entry(self):
+        key = self.cache.get_key(self.description)
+        self.cache.store(key, self.write_records("indexed", "stale records"), self.description)
+        # Without replace, the entry that is there is kept
+        self.cache.store(key, self.write_records("other", "other records"), self.description)
+        record_file = os.path.join(self.temp_dir, "records")
+        self.assertTrue(self.cache.fetch(key, record_file))
+        self.assertEqual(self.read(record_file), "stale records")
+        self.cache.store(
+            key, self.write_records("reindexed", "fresh records"), self.description, replace=True
+        )
+        fetched_file = os.path.join(self.temp_dir, "fetched")
+        self.assertTrue(self.cache.fetch(key, fetched_file))
+        self.assertEqual(self.read(fetched_file), "fresh records")
+        # Runs that fetched the old entry keep their records
+        self.assertEqual(self.read(record_file), "stale records")
+        self.assertEqual([d for d in os.listdir(self.cache.cache_dir) if d.startswith(".")], [])
+
+    def test_key_changes_with_description(self):
+        other_description = dict(self.description, vocab="abd")
+        self.assertNotEqual(
+            self.cache.get_key(self.description), self.cache.get_key(other_description)
+        )
+
+    def test_fingerprint_changes_with_data(self):
+        data_dir = os.path.join(self.temp_dir, "data")
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, "train.tsv"), "w") as f:
+            f.write("a\tb\n")
+        fingerprint = get_files_fingerprint(data_dir)
+        self.assertEqual(fingerprint, get_files_fingerprint(data_dir))
+        with open(os.path.join(data_dir, "train.tsv"), "a") as f:
+            f.write("c\td\n")
+        self.assertNotEqual(fingerprint, get_files_fingerprint(data_dir))
+
+    def test_eviction_keeps_fetched_records(self):
+        cache = PreprocCache(os.path.join(self.temp_dir, "small_cache"), max_size_gb=1e-9)
+        old_key = cache.get_key(self.description)
+        cache.store(old_key, self.write_records("old", "old records"), self.description)
+        record_file = os.path.join(self.temp_dir, "records")
+        self.assertTrue(cache.fetch(old_key, record_file))
+        new_description = dict(self.description, split="val")
+        new_key = cache.get_key(new_description)
+        cache.store(new_key, self.write_records("new", "new records"), new_description)
+        # Only the most recently used entry fits
+        self.assertFalse(cache.fetch(old_key, os.path.join(self.temp_dir, "other")))
+        # A run that fetched the evicted entry can still read it
+        self.assertEqual(self.read(record_file), "old records")
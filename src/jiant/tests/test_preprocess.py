@@ -7,6 +7,11 @@ import tempfile
 import unittest
 from unittest import mock
 
+from allennlp.data import Instance, Token, Vocabulary
+from allennlp.data.fields import LabelField, TextField
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+
+import jiant.preprocess as preprocess
 import jiant.tasks.tasks as tasks
 from jiant.utils.config import params_from_file
 from jiant.preprocess import get_task_without_loading_data, build_indexers, get_vocab
@@ -75,3 +80,32 @@ class TestProprocess(unittest.TestCase):
         assert set(vocab.get_index_to_token_vocabulary("chars").values()) == set(
             ["@@PADDING@@", "@@UNKNOWN@@", "a", "b", "c"]
         )
+
+
+class TestParallelIndexing(unittest.TestCase):
+    def make_instances(self):
+        indexers = {"words": SingleIdTokenIndexer()}
+        return [
+            Instance(
+                {
+                    "input1": TextField([Token(w) for w in ["word%d" % (i % 7), "end"]], indexers),
+                    "labels": LabelField(str(i % 3)),
+                }
+            )
+            for i in range(50)
+        ]
+
+    @mock.patch.object(preprocess, "INDEXING_CHUNK_SIZE", 4)
+    def test_matches_serial_order(self):
+        vocab = Vocabulary.from_instances(self.make_instances())
+        serial = list(preprocess._indexed_instance_generator(self.make_instances(), vocab))
+        parallel = list(
+            preprocess._parallel_indexed_instance_generator(self.make_instances(), vocab, 2)
+        )
+        self.assertEqual(len(serial), len(parallel))
+        for expected, actual in zip(serial, parallel):
+            expected_tensors, actual_tensors = expected.as_tensor_dict(), actual.as_tensor_dict()
+            self.assertEqual(
+                expected_tensors["input1"]["words"].tolist(), actual_tensors["input1"]["words"].tolist()
+            )
+            self.assertEqual(expected_tensors["labels"].tolist(), actual_tensors["labels"].tolist())
@@ -0,0 +1,168 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from allennlp.data import Instance, Token, Vocabulary
+from allennlp.data.fields import LabelField, ListField, MetadataField, SpanField, TextField
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+
+from jiant.allennlp_mods.numeric_field import NumericField
+from jiant.utils import serialize
+
+
+class TestBinaryRecords(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.indexers = {"words": SingleIdTokenIndexer()}
+        sentences = [["the", "cat", "sat"], ["a", "dog", "barked", "loudly"], ["hi"]]
+        labels = ["yes", "no", "yes"]
+        vocab = Vocabulary.from_instances(self.make_instances(sentences, labels))
+        self.instances = self.make_instances(sentences, labels)
+        for instance in self.instances:
+            instance.index_fields(vocab)
+        self.vocab = vocab
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_instances(self, sentences, labels):
+        instances = []
+        for idx, (sentence, label) in enumerate(zip(sentences, labels)):
+            text = TextField([Token(t) for t in sentence], token_indexers=self.indexers)
+            fields = {
+                "input1": text,
+                "labels": LabelField(label),
+                "score": NumericField(0.5 * idx),
+                "spans": ListField([SpanField(0, len(sentence) - 1, text)]),
+                "idx": MetadataField({"idx": idx, "words": sentence}),
+            }
+            instances.append(Instance(fields))
+        return instances
+
+    def assert_same_tensors(self, expected, actual):
+        expected_tensors = expected.as_tensor_dict()
+        actual_tensors = actual.as_tensor_dict()
+        self.assertEqual(
+            expected_tensors["input1"]["words"].tolist(), actual_tensors["input1"]["words"].tolist()
+        )
+        self.assertEqual(expected_tensors["labels"].tolist(), actual_tensors["labels"].tolist())
+        self.assertEqual(expected_tensors["spans"].tolist(), actual_tensors["spans"].tolist())
+        self.assertEqual(expected_tensors["idx"], actual_tensors["idx"])
+        np.testing.assert_allclose(
+            expected_tensors["score"].numpy(), actual_tensors["score"].numpy()
+        )
+
+    def test_round_trip(self):
+        path = os.path.join(self.temp_dir, "records")
+        serialize.write_records(self.instances, path)
+        self.assertTrue(serialize.is_binary_record_file(path))
+        read = list(serialize.read_records(path))
+        self.assertEqual(len(read), len(self.instances))
+        for expected, actual in zip(self.instances, read):
+            self.assert_same_tensors(expected, actual)
+            # The span still points to the TextField of its own instance
+            self.assertIs(actual.fields["spans"].field_list[0].sequence_field, actual.fields["input1"])
+
+    def test_random_access(self):
+        path = os.path.join(self.temp_dir, "records")
+        serialize.write_records(self.instances, path)
+        records = serialize.RecordFile(path)
+        self.assertEqual(len(records), len(self.instances))
+        self.assert_same_tensors(self.instances[2], records[2])
+        self.assert_same_tensors(self.instances[0], records[0])
+        # Indexers aren't encoded per record, but shared through the file's templates
+        self.assertIs(records[0].fields["input1"]._token_indexers, records[1].fields["input1"]._token_indexers)
+
+    def test_copied_indexers_share_a_template(self):
+        # As when instances are indexed in worker processes: each brings its own copy of the indexers
+        copies = [pickle.loads(pickle.dumps(instance)) for instance in self.instances]
+        encoder = serialize._RecordEncoder()
+        for instance in copies:
+            encoder.encode(instance)
+        text_templates = [t for t in encoder.templates if "_token_indexers" in t]
+        self.assertEqual(len(text_templates), 1)
+        self.assertLessEqual(len(encoder._value_keys), serialize._MAX_MEMOIZED_VALUES)
+
+    def test_shared_indexers_are_pickled_once(self):
+        encoder = serialize._RecordEncoder()
+        with mock.patch.object(serialize, "pkl", mock.Mock(wraps=serialize.pkl)) as pkl:
+            encoder.encode(self.instances[0])
+            nb_first_record_pickles = pkl.dumps.call_count
+            for instance in self.instances[1:]:
+                encoder.encode(instance)
+        self.assertGreater(nb_first_record_pickles, 0)
+        self.assertEqual(pkl.dumps.call_count, nb_first_record_pickles)
+
+    def test_fraction_is_repeatable(self):
+        path = os.path.join(self.temp_dir, "records")
+        serialize.write_records(self.instances * 10, path)
+        iterator = serialize.read_records(path, repeatable=True, fraction=0.5)
+        first = [instance.fields["idx"].metadata["idx"] for instance in iterator]
+        second = [instance.fields["idx"].metadata["idx"] for instance in iterator]
+        self.assertEqual(first, second)
+        self.assertEqual(iterator.get_counter(), 2)
+
+    def test_convert_legacy(self):
+        path = os.path.join(self.temp_dir, "task__train_data_wordstokenized")
+        serialize.write_records(self.instances, path, binary=False)
+        self.assertFalse(serialize.is_binary_record_file(path))
+        legacy = list(serialize.read_records(path))
+        self.assertTrue(serialize.convert_records(path))
+        self.assertTrue(serialize.is_binary_record_file(path))
+        self.assertFalse(serialize.convert_records(path))
+        for expected, actual in zip(legacy, serialize.read_records(path)):
+            self.assert_same_tensors(expected, actual)
+
+    def test_fraction_matches_record_hashes(self):
+        path = os.path.join(self.temp_dir, "records")
+        serialize.write_records(self.instances * 10, path)
+        records = serialize.RecordFile(path)
+        expected = [
+            index
+            for index in range(len(records))
+            if serialize.bytes_to_float(records.get_payload(index)) <= 0.5
+        ]
+        selected = serialize.read_records(path, repeatable=True, fraction=0.5)
+        self.assertEqual(len(selected), len(expected))
+        self.assertEqual(
+            [instance.fields["idx"].metadata["idx"] for instance in selected],
+            [index % len(self.instances) for index in expected],
+        )
+
+
+class TestRecordIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.examples = [{"idx": i, "text": "example %d" % i} for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_slicing(self):
+        for binary in (True, False):
+            path = os.path.join(self.temp_dir, "records_%s" % binary)
+            serialize.write_records(self.examples, path, binary=binary)
+            self.assertTrue(os.path.exists(path + serialize.INDEX_SUFFIX))
+            records = serialize.read_records(path, repeatable=True)
+            self.assertEqual(len(records), len(self.examples))
+            self.assertEqual(list(records[5:8]), self.examples[5:8])
+            self.assertEqual(list(serialize.slice_records(records, 15)), self.examples[15:])
+            self.assertEqual(list(serialize.slice_records(self.examples, 2, 4)), self.examples[2:4])
+
+    def test_index_is_rebuilt(self):
+        path = os.path.join(self.temp_dir, "records")
+        serialize.write_records(self.examples, path, binary=False)
+        os.remove(path + serialize.INDEX_SUFFIX)
+        self.assertEqual(list(serialize.read_records(path)), self.examples)
+        self.assertTrue(os.path.exists(path + serialize.INDEX_SUFFIX))
+        # A record file rewritten without its index makes the old index out of date
+        with open(path + serialize.INDEX_SUFFIX, "rb") as fd:
+            old_index = fd.read()
+        serialize.write_records(self.examples[:3], path, binary=False)
+        with open(path + serialize.INDEX_SUFFIX, "wb") as fd:
+            fd.write(old_index)
+        self.assertEqual(list(serialize.read_records(path)), self.examples[:3])
@@ -7,20 +7,26 @@ import re
 from operator import itemgetter
 
 import math
+import inspect
 
 from allennlp.data import Vocabulary
 from allennlp.models import Model
 import torch
 import torch.nn as nn
-from torch import tensor
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers import AlbertModel, AlbertForMaskedLM
 
 from config import FLAGS, get_my_tokenizer
 from constants import TYPE_VOCAB_SIZE
-from my_utils.model_utils import contrastive_loss, apply_sequence_mask, process_targets_for_loss, get_activation, \
-    sizeof_fmt, sz
+from my_utils.model_utils import contrastive_loss, apply_sequence_mask, get_activation, \
+    sizeof_fmt, sz, NegativesMemoryBank
 import logging as log
 
+# Non-reentrant checkpointing (torch >= 1.11) also gives gradients to the parameters of a segment whose inputs don't
+# require grad, e.g. the combo predictors on top of a frozen main model
+NON_REENTRANT_CHECKPOINTING = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
 log.basicConfig(
     format="%(asctime)s: %(message)s", datefmt="%m/%d %I:%M:%S %p", level=log.INFO
 )  # noqa
@@ -58,8 +64,9 @@ class DIRTLMHead(Model):
             self.shared_from_left_predictor = SelfPredictorBlock()
             self.shared_from_right_predictor = SelfPredictorBlock()
             self.learn_phase = True
+            self.self_predictors_trainable = True
+            self.negatives_memory_bank = NegativesMemoryBank(FLAGS.nb_memory_bank_negatives)
         self.lm_head = LMHead()
-        self.metrics_dict = {}
         self.finetune_stage = finetune_stage
         self.dropout = MyDropout()
 
@@ -120,9 +127,6 @@ class DIRTLMHead(Model):
                     f'Unexpected mismatch in loading state dict: {u} in pretrained but not in current model.')
         log.info(f"Loaded pretrained weights from {FLAGS.hf_model_handle}")
 
-    def get_metrics(self, **kwargs):
-        return self.metrics_dict.copy()  # copy needed to avoid overlapping train and validation metrics
-
     def forward(self, input_ids, padding_mask, masked_lm_labels=None, token_type_ids=None):
 
         # ENCODING
@@ -134,50 +138,153 @@ class DIRTLMHead(Model):
                 self.learn_phase = not self.learn_phase
             elif FLAGS.replace_self_predictions == 'always':
                 self.learn_phase = False
+            if not clean:
+                self.set_self_predictors_trainable(self.learn_phase)
         else:
             normalizer = FLAGS.nb_encoder_layers
-        if clean:
-            encoder = MySequential(*[self.shared_encoder_block for _ in range(FLAGS.nb_encoder_layers)], clean=clean)
-        else:
-
-            encoder = MySequential(*[self.shared_encoder_block for _ in range(FLAGS.nb_encoder_layers)],
-                                   top_down=self.shared_top_down_predictor,
-                                   from_left=self.shared_from_left_predictor,
-                                   from_right=self.shared_from_right_predictor,
-                                   combiner=self.combiner,
-                                   clean=clean,
-                                   learn_phase=self.learn_phase)
         embedded_inputs = self.embedder(input_ids, token_type_ids)
-        encoded, _, cum_layer_loss, layer_loss_list = encoder(embedded_inputs, padding_mask)
+        attention_mask = get_additive_attention_mask(padding_mask, embedded_inputs.dtype)  # Once for all layers
+        # The position bias only depends on the parameters, so it is computed once and shared by all layers
+        position_bias = self.shared_encoder_block.multihead_attention.select_pos_embeddings(
+            input_ids.shape[1], input_ids.shape[1]) if FLAGS.pos_embeddings == 'relative' else None
+        encoded, layer_loss_list = self.encode(embedded_inputs, attention_mask, position_bias, clean)
 
-        cum_layer_loss = cum_layer_loss / normalizer  # Normalize layer loss by number of times it is calculated
+        cum_layer_loss = sum(layer_loss_list) / normalizer  # Normalize layer loss by number of times it is calculated
         result_dict = {}
         result_dict['encoded_activations'] = encoded
 
-        vocab_scores = self.lm_head(encoded)
+        # With sparse prediction, only the positions that have a label go through the LM head during training. Full
+        # scores are still computed when evaluating, for callers that look at predictions everywhere.
+        sparse_prediction = FLAGS.sparse_prediction and self.training and masked_lm_labels is not None
+        if sparse_prediction:
+            is_target = masked_lm_labels != -100
+            vocab_scores = None
+            target_vocab_scores = self.lm_head(encoded[is_target])  # [nb_targets, vocab_size]
+            targets = masked_lm_labels[is_target]
+            result_dict['target_vocab_scores'] = target_vocab_scores
+        else:
+            vocab_scores = self.lm_head(encoded)
+            target_vocab_scores = vocab_scores.reshape(-1, vocab_scores.shape[-1])
+            targets = masked_lm_labels.reshape(-1) if masked_lm_labels is not None else None
 
         if masked_lm_labels is not None:
-            targets = process_targets_for_loss(masked_lm_labels)
-            vocab_scores_contiguous = vocab_scores.contiguous().view(-1, get_my_tokenizer().vocab_size)
-            MLM_loss = nn.CrossEntropyLoss()(vocab_scores_contiguous,
-                                             targets)
+            MLM_loss = F.cross_entropy(target_vocab_scores, targets)
             result_dict['loss'] = FLAGS.DIR_loss_fraction * cum_layer_loss + (
                     1 - FLAGS.DIR_loss_fraction) * MLM_loss if FLAGS.DIR else MLM_loss
 
-            self.metrics_dict['crossentropy_loss'] = MLM_loss.item()
-            self.metrics_dict['perplexity'] = torch.exp(MLM_loss).item()
-
+            # Returned rather than stored on the module, so the forward pass has no side effects and can be traced or
+            # compiled. Kept as tensors: only converted to numbers when the metrics are asked for, to not sync with the
+            # GPU here
+            metrics = {'crossentropy_loss': MLM_loss.detach(), 'perplexity': torch.exp(MLM_loss.detach())}
             if FLAGS.DIR:
-                self.metrics_dict['DIR_loss'] = cum_layer_loss.item() if isinstance(cum_layer_loss,
-                                                                                    torch.Tensor) else cum_layer_loss
+                metrics['DIR_loss'] = cum_layer_loss.detach() if isinstance(cum_layer_loss,
+                                                                            torch.Tensor) else cum_layer_loss
                 for layer, loss in enumerate(layer_loss_list):
-                    self.metrics_dict[f'DIR_loss_layer_{layer}'] = loss.item() if isinstance(loss,
-                                                                                             torch.Tensor) else loss
+                    metrics[f'DIR_loss_layer_{layer}'] = loss.detach()
+            result_dict['metrics'] = metrics
 
-        result_dict['vocab_scores'] = vocab_scores
+        if vocab_scores is not None:
+            result_dict['vocab_scores'] = vocab_scores
 
         return result_dict  # Dictionary format for AllenNLP trainer loop
 
+    def set_self_predictors_trainable(self, trainable):
+        """Only loops over the self-predicting parameters when switching between learning and applying them"""
+        if trainable != self.self_predictors_trainable:
+            for m in [self.shared_top_down_predictor, self.shared_from_left_predictor,
+                      self.shared_from_right_predictor, self.combiner]:
+                for p in m.parameters():
+                    p.requires_grad = trainable
+            self.self_predictors_trainable = trainable
+
+    def encode(self, in_activations, attention_mask, position_bias, clean):
+        """
+        Applies the shared encoder block FLAGS.nb_encoder_layers times, with the given :position_bias: (None unless
+        relative position embeddings are used) in every layer.
+        If not :clean:, combo DIR self-predictions are made (and applied, if not self.learn_phase) at every layer that
+        has FLAGS.top_down_distance layers above it.
+        Returns the encoded activations and a list with the DIR losses of the layers that have one.
+        """
+        nb_layers = FLAGS.nb_encoder_layers
+        # Checkpointing only pays off if there is a backward pass to keep activations around for
+        checkpointing = FLAGS.checkpoint_every_k_layers > 0 and torch.is_grad_enabled()
+        segment_size = FLAGS.checkpoint_every_k_layers if checkpointing else nb_layers
+        # Memory bank negatives are read once before and stored after the whole pass, and passed to the segments as
+        # arguments, so that recomputing a segment during backward sees the same negatives as the forward pass did
+        use_memory_bank = FLAGS.DIR == 'combo' and FLAGS.nb_memory_bank_negatives > 0 and not clean
+        bank_states = {} if use_memory_bank else None
+        bank_negatives = None
+        if use_memory_bank:
+            bank_negatives = {layer_idx: self.negatives_memory_bank.get(layer_idx, in_activations)
+                              for layer_idx in range(nb_layers - FLAGS.top_down_distance)}
+        layer_loss_list = []
+        for start in range(0, nb_layers, segment_size):
+            end = min(start + segment_size, nb_layers)
+            # Reentrant checkpointing gives no gradients at all if the input doesn't require grad
+            if checkpointing and (NON_REENTRANT_CHECKPOINTING or in_activations.requires_grad):
+                # Only the input of the segment is kept, the rest is recomputed during backward
+                checkpoint_kwargs = {'use_reentrant': False} if NON_REENTRANT_CHECKPOINTING else {}
+                in_activations, *segment_losses = checkpoint(self.run_segment, in_activations, attention_mask,
+                                                             position_bias, start, end, clean, bank_negatives,
+                                                             bank_states, **checkpoint_kwargs)
+            else:
+                in_activations, *segment_losses = self.run_segment(in_activations, attention_mask, position_bias,
+                                                                   start, end, clean, bank_negatives, bank_states)
+            layer_loss_list += segment_losses
+        if use_memory_bank:
+            for layer_idx, state in bank_states.items():
+                self.negatives_memory_bank.push(layer_idx, state)
+        return in_activations, layer_loss_list
+
+    def run_segment(self, in_activations, attention_mask, position_bias, start, end, clean, bank_negatives=None,
+                    bank_states=None):
+        """
+        Runs layers :start: up to :end:. Returns the resulting activations, followed by the DIR losses of the layers
+        that have one.
+        :bank_negatives: if not None, the memory bank negatives per layer (None for layers that have none yet), read
+        before the pass. The segment never reads the memory bank itself, as it may have been updated by the time the
+        segment is recomputed during backward.
+        :bank_states: if not None, the states of this batch are added to it per layer, to be pushed to the memory bank
+        after the pass.
+        """
+        layer_loss_list = []
+        for layer_idx in range(start, end):  # TODO fix heavy mem overhead
+            if FLAGS.DIR == 'combo' and (layer_idx + FLAGS.top_down_distance < FLAGS.nb_encoder_layers) and (not clean):
+                # if not FLAGS.slicewise: #TODO
+                masked_inputs, DIRT_mask = apply_sequence_mask(in_activations)
+                top_down_inputs = masked_inputs
+                for _ in range(FLAGS.top_down_distance):  # Contextualize cleanly
+                    top_down_inputs = self.shared_encoder_block(top_down_inputs, attention_mask, position_bias)[0]
+                left_adjacent_inputs = in_activations.roll(shifts=1, dims=1)
+                right_adjacent_inputs = in_activations.roll(shifts=-1, dims=1)
+                top_down_prediction = self.shared_top_down_predictor(
+                    top_down_inputs)
+                from_left_prediction = self.shared_from_left_predictor(left_adjacent_inputs)
+                from_right_prediction = self.shared_from_right_predictor(right_adjacent_inputs)
+                combined_prediction = self.combiner(
+                    torch.cat((top_down_prediction, from_left_prediction, from_right_prediction),
+                              dim=-1))
+                # The first and last sequence elements don't have proper left resp. right inputs.
+                # Don't consider these in calculating the loss
+                edge_mask = torch.zeros_like(DIRT_mask)
+                edge_mask[0] = True
+                edge_mask[-1] = True
+                DIRT_mask = DIRT_mask | edge_mask
+
+                extra_negatives = bank_negatives[layer_idx] if bank_negatives is not None else None
+                if bank_states is not None:
+                    bank_states[layer_idx] = in_activations.detach()
+                layer_loss = contrastive_loss(in_activations, combined_prediction, DIRT_mask, extra_negatives)
+                layer_loss_list.append(layer_loss)
+                if not self.learn_phase:  # Wipe some internal states and replace them with predictions
+                    in_activations = torch.where(DIRT_mask[None, :, None], in_activations, combined_prediction)
+
+            in_activations, _, layer_loss, _ = self.shared_encoder_block(in_activations, attention_mask,
+                                                                         position_bias)
+            if isinstance(layer_loss, torch.Tensor):  # Only top_down and from_projection DIR have a loss per block
+                layer_loss_list.append(layer_loss)
+        return (in_activations,) + tuple(layer_loss_list)
+
     def decode(self, output_dict):
         '''
         Overrides the AllenNLP decode method.
@@ -187,6 +294,21 @@ class DIRTLMHead(Model):
         return {'prediction': prediction}
 
 
+def get_additive_attention_mask(padding_mask, dtype):
+    """
+    Turns a padding mask that is True (or 1) where attending is allowed, of shape [d_batch, value_length] or
+    [d_batch, query_length, value_length], into a mask to add to attention weights before the softmax: 0 where
+    attending is allowed and -inf elsewhere. The result broadcasts against [d_batch, nb_heads, query_length,
+    value_length] attention weights.
+    """
+    if padding_mask is None:
+        return None
+    if padding_mask.dim() == 2:  # Same mask for every replacee
+        padding_mask = padding_mask[:, None, :]
+    additive_mask = torch.zeros(padding_mask.shape, dtype=dtype, device=padding_mask.device)
+    return additive_mask.masked_fill(~padding_mask.bool(), -float('inf'))[:, None]
+
+
 def layer_normalize(param):
     mean = torch.mean(param, -1)
     mean_expanded = mean.unsqueeze(-1).expand(*(mean.shape + (param.shape[-1],)))
@@ -248,11 +370,11 @@ class EncoderBlock(nn.Module):
             )
             # self.top_down_regressor = nn.Sequential()
 
-    def forward(self, in_state, padding_mask,
+    def forward(self, in_state, attention_mask, position_bias=None,
                 cum_layer_loss=0, layer_loss_list=None):
         if layer_loss_list == None:
             layer_loss_list = []
-        attention_output_dict = self.multihead_attention(in_state, in_state, padding_mask)
+        attention_output_dict = self.multihead_attention(in_state, in_state, attention_mask, position_bias)
         att_out = attention_output_dict['activations']
         out_state = self.feedforward(att_out)
 
@@ -260,7 +382,8 @@ class EncoderBlock(nn.Module):
         if not self.finetune_stage:  # TODO make sure it doesn't use all the extra mem here
             if FLAGS.DIR == 'top_down':
                 masked_in_state, mask = apply_sequence_mask(in_state)
-                masked_att_out = self.multihead_attention(masked_in_state, in_state, padding_mask)['activations']
+                masked_att_out = self.multihead_attention(masked_in_state, in_state, attention_mask,
+                                                          position_bias)['activations']
                 masked_out_state = self.feedforward(
                     masked_att_out)  # TODO should add activation? And should add sometimes-not-masking?
                 predicted_in_state = self.top_down_regressor(masked_out_state)
@@ -272,69 +395,7 @@ class EncoderBlock(nn.Module):
         else:
             layer_loss = 0
         layer_loss_list.append(layer_loss)
-        return out_state, padding_mask, layer_loss + cum_layer_loss, layer_loss_list
-
-
-class MySequential(nn.Sequential):  # TODO move this to a for loop in enclosing module
-    '''
-    Allows Sequential to pass on multiple in- and outputs
-    '''
-
-    def __init__(self, *args, top_down=None, from_left=None, from_right=None, combiner=None, clean=True,
-                 learn_phase=True):
-        super().__init__(*args)
-        self.clean = clean
-        self.learn_phase = learn_phase
-        if not self.clean:
-            self.top_down_predictor = top_down
-            self.from_left_predictor = from_left
-            self.from_right_predictor = from_right
-            self.combiner = combiner
-            for m in [self.top_down_predictor, self.from_left_predictor, self.from_right_predictor,
-                      self.combiner]:
-                for p in m.parameters():
-                    p.requires_grad = learn_phase
-
-    def forward(self, *inputs):
-        layers = self[:FLAGS.nb_encoder_layers]
-        cum_layer_loss = 0
-        layer_loss_list = []
-        for layer_idx, module in enumerate(layers):  # TODO fix heavy mem overhead
-            if FLAGS.DIR == 'combo' and (layer_idx + FLAGS.top_down_distance < len(layers)) and (not self.clean):
-                in_activations, padding_mask = inputs[:2]
-                # if not FLAGS.slicewise: #TODO
-                masked_inputs, DIRT_mask = apply_sequence_mask(in_activations)
-                contextualizer = layers[layer_idx:layer_idx + FLAGS.top_down_distance]  # Clean true by default
-                top_down_inputs, _, _, _ = contextualizer(masked_inputs, padding_mask)
-                left_adjacent_inputs = in_activations.roll(shifts=1, dims=1)
-                right_adjacent_inputs = in_activations.roll(shifts=-1, dims=1)
-                top_down_prediction = self.top_down_predictor(
-                    top_down_inputs)
-                from_left_prediction = self.from_left_predictor(left_adjacent_inputs)
-                from_right_prediction = self.from_right_predictor(right_adjacent_inputs)
-                combined_prediction = self.combiner(
-                    torch.cat((top_down_prediction, from_left_prediction, from_right_prediction),
-                              dim=-1))
-                # The first and last sequence elements don't have proper left resp. right inputs.
-                # Don't consider these in calculating the loss
-                edge_mask = torch.zeros_like(DIRT_mask)
-                edge_mask[0] = True
-                edge_mask[-1] = True
-                DIRT_mask = DIRT_mask | edge_mask
-
-                layer_loss = contrastive_loss(in_activations, combined_prediction, DIRT_mask)
-                cum_layer_loss += layer_loss
-                layer_loss_list.append(layer_loss)
-                if not self.learn_phase:  # Wipe some internal states and replace them with predictions
-                    inputs = (torch.where(DIRT_mask[None, :, None], inputs[0], combined_prediction),) + inputs[1:]
-
-            if type(inputs) == tuple:
-                inputs = module(*inputs)
-            else:
-                inputs = module(inputs)
-        if (not self.clean) and FLAGS.DIR == 'combo':
-            inputs = inputs[:2] + (cum_layer_loss,) + (layer_loss_list,)
-        return inputs
+        return out_state, attention_mask, layer_loss + cum_layer_loss, layer_loss_list
 
 
 class Anticipation(nn.Module):
@@ -385,29 +446,23 @@ class MultiHeadAttention(nn.Module):
         self.dropout = MyDropout()
         if FLAGS.DIR == 'from_projection':
             self.anticipation = Anticipation()
+        if FLAGS.attention_backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            raise ValueError(f'attention_backend sdpa needs torch >= 2.0, this is torch {torch.__version__}')
 
-    def get_attention_mask(self, padding_mask, d_batch, query_length, value_length):
-        """
-        Produces a mask that indicates which replacers not to pay attention to.
-        Combines a causal mask (if any) and a padding mask (if any)
-        """
-        model_device = self.project_k.weight.device
-        if self.use_causal_mask:
-            causal_mask = tensor([[[0 if value_index <= query_index else -float('inf') for value_index in
-                                    range(value_length)] for query_index in range(query_length)]] * (
-                                         d_batch * FLAGS.nb_heads)).cuda(model_device)
-        if padding_mask is None:
-            padding_mask = torch.zeros(d_batch, value_length).cuda(model_device)
-        else:
-            padding_mask = torch.log(padding_mask.type(
-                torch.float))  # Because we are masking before pushing through softmax: we need -inf to have ) after softmax, and 0 to have 1 after softmax
-        reshaped_padding_mask = padding_mask[:, None, :].repeat(1, query_length, FLAGS.nb_heads).view(-1, query_length,
-                                                                                                      value_length)
-        attention_mask = reshaped_padding_mask + causal_mask if self.use_causal_mask else reshaped_padding_mask
-        return attention_mask  # [d_batch*FLAGS.num_heads, query_length, value_length]
+    causal_masks = {}  # Per (query_length, value_length, dtype, device), shared by all instances
+
+    @staticmethod
+    def get_causal_mask(query_length, value_length, dtype, device):
+        """Additive [query_length, value_length] mask that stops replacees from attending to later replacers"""
+        key = (query_length, value_length, dtype, device)
+        if key not in MultiHeadAttention.causal_masks:
+            MultiHeadAttention.causal_masks[key] = torch.full((query_length, value_length), -float('inf'),
+                                                              dtype=dtype, device=device).triu(1)
+        return MultiHeadAttention.causal_masks[key]
 
     def forward(self, replacees, replacers,
-                padding_mask=None):  # Padding mask to make sure we don't attend to padded positions
+                attention_mask=None,  # Additive mask (see get_additive_attention_mask) to not attend to padding
+                position_bias=None):  # From select_pos_embeddings, computed here if not given
         '''
         Performs multi-headed attention: replacing each of the replacees by a weighted combination of all of the (learned value projections of) replacers.
         The weights are determined by a combination of 1) relative distance between replacer and replacee
@@ -419,9 +474,31 @@ class MultiHeadAttention(nn.Module):
         k = self.project_k(replacers)
         v = self.project_v(replacers)
         assert FLAGS.d_hidden % FLAGS.nb_heads == 0
+        if position_bias is None and FLAGS.pos_embeddings == 'relative':
+            position_bias = self.select_pos_embeddings(replacees.shape[1], replacers.shape[1])
+        if FLAGS.attention_backend == 'sdpa':
+            att_output = self.attend_fused(q, k, v, attention_mask, position_bias)
+        else:
+            att_output = self.attend(q, k, v, attention_mask, position_bias)
+        att_output = self.project_o(att_output)  # Ok THIS I did better than HF :D
+        result_dict['activations'] = self.LayerNorm(self.dropout(att_output) + replacees)  # Include skip-connection
+
+        if FLAGS.DIR == 'from_projection' and (not self.finetune_stage):
+            assert torch.equal(replacees, replacers), 'from_projection DIR only works with self-attention.'
+            batch_pos_embeddings = position_bias.repeat(d_batch, 1, 1)
+            result_dict['layer_loss'] = self.anticipation(q, k, v, batch_pos_embeddings, replacees)
+
+        return result_dict
+
+    def attend(self, q, k, v, attention_mask, position_bias=None):
+        """
+        Attention with explicit matrix multiplications and softmax. Returns the attention output of all heads,
+        concatenated to shape [d_batch, query_length, d_hidden].
+        """
+        d_batch = q.shape[0]
         d_head_hidden = FLAGS.d_hidden // FLAGS.nb_heads
-        query_length = replacees.shape[1]
-        value_length = replacers.shape[1]
+        query_length = q.shape[1]
+        value_length = k.shape[1]
 
         # This reshaping slices the last dimension and stacks those slices along the first dimension
         # In the resulting first dimension, first come all slices from the first batch, then from the second, and so on
@@ -437,14 +514,16 @@ class MultiHeadAttention(nn.Module):
         att_weights = torch.bmm(q_multi_parts,
                                 k_multi_parts.transpose(1, 2))  # shape [d_batch x nb_heads, query_length, value_length]
         att_weights /= math.sqrt(d_head_hidden)  # Scaling to be in line with Albert (even if t5 didn't do this)
-        if FLAGS.pos_embeddings == 'relative':
-            pos_embeddings = self.select_pos_embeddings(query_length, value_length)
-            batch_pos_embeddings = pos_embeddings.repeat(d_batch, 1, 1)
-
-            att_weights += batch_pos_embeddings
-
-        att_weights += self.get_attention_mask(padding_mask, d_batch, query_length,
-                                               value_length)  # adding attention mask
+        # Masks and position bias are broadcast over a [d_batch, nb_heads, query_length, value_length] view, and added
+        # in place, so no mask needs to be expanded to the full size of the attention weights
+        att_weights_per_head = att_weights.view(d_batch, FLAGS.nb_heads, query_length, value_length)
+        if position_bias is not None:
+            att_weights_per_head += position_bias
+        if self.use_causal_mask:
+            att_weights_per_head += MultiHeadAttention.get_causal_mask(query_length, value_length, att_weights.dtype,
+                                                                       att_weights.device)
+        if attention_mask is not None:
+            att_weights_per_head += attention_mask
 
         att_weights = nn.Softmax(dim=-1)(att_weights)
         att_weights = self.dropout(att_weights)
@@ -454,23 +533,52 @@ class MultiHeadAttention(nn.Module):
         att_output = att_output_multi_parts.transpose(1, 2).contiguous().view(d_batch, FLAGS.d_hidden,
                                                                               query_length).transpose(1,
                                                                                                       2).contiguous()  # Last contiguous to make sure mem calculations add up :P
-        att_output = self.project_o(att_output)  # Ok THIS I did better than HF :D
-        result_dict['activations'] = self.LayerNorm(self.dropout(att_output) + replacees)  # Include skip-connection
-
-        if FLAGS.DIR == 'from_projection' and (not self.finetune_stage):
-            assert torch.equal(replacees, replacers), 'from_projection DIR only works with self-attention.'
-            result_dict['layer_loss'] = self.anticipation(q, k, v, batch_pos_embeddings, replacees)
+        return att_output
 
-        return result_dict
+    def attend_fused(self, q, k, v, attention_mask, position_bias=None):
+        """
+        Same as attend, with torch's fused scaled_dot_product_attention, which picks a flash or memory-efficient
+        kernel when it can, and doesn't keep the attention weights around for the backward pass.
+        The position bias and causal mask are passed as part of the additive mask.
+        """
+        d_batch, query_length, value_length = q.shape[0], q.shape[1], k.shape[1]
+        d_head_hidden = FLAGS.d_hidden // FLAGS.nb_heads
+        # [d_batch, nb_heads, length, d_head_hidden], with the same slicing into heads as in attend
+        q_heads, k_heads, v_heads = [t.view(d_batch, t.shape[1], FLAGS.nb_heads, d_head_hidden).transpose(1, 2)
+                                     for t in [q, k, v]]
+        additive_mask = attention_mask
+        if position_bias is not None:
+            additive_mask = position_bias if additive_mask is None else additive_mask + position_bias
+        if self.use_causal_mask:
+            causal_mask = MultiHeadAttention.get_causal_mask(query_length, value_length, q.dtype, q.device)
+            additive_mask = causal_mask if additive_mask is None else additive_mask + causal_mask
+        if additive_mask is not None:
+            additive_mask = additive_mask.to(q.dtype)
+        att_output = F.scaled_dot_product_attention(q_heads, k_heads, v_heads, attn_mask=additive_mask,
+                                                    dropout_p=self.dropout.p if self.training else 0.)
+        return att_output.transpose(1, 2).reshape(d_batch, query_length, FLAGS.d_hidden)
 
     def select_pos_embeddings(self, query_length, value_length):
-        rel_pos_indices = tensor(
-            [[q_idx - k_idx for k_idx in range(value_length)] for q_idx in
-             range(query_length)])  # shape [nb_heads, query_length, value_length]
-        bucket_idxs = MultiHeadAttention._relative_position_bucket(rel_pos_indices).cuda(
-            self.relative_attention_bias.weight.device)
-        pos_embeddings = self.relative_attention_bias(bucket_idxs).permute(2, 0, 1)
-        return pos_embeddings
+        """
+        Returns the [nb_heads, query_length, value_length] relative position bias. This only changes when the parameters
+        do, so DIRTLMHead computes it once per forward pass and passes it to every layer.
+        """
+        weight = self.relative_attention_bias.weight
+        bucket_idxs = MultiHeadAttention.get_relative_position_buckets(query_length, value_length, weight.device)
+        return self.relative_attention_bias(bucket_idxs).permute(2, 0, 1)
+
+    relative_position_buckets = {}  # Per (query_length, value_length, device), shared by all instances
+
+    @staticmethod
+    def get_relative_position_buckets(query_length, value_length, device):
+        """Returns the [query_length, value_length] bucket indices of the relative positions, built once per device"""
+        key = (query_length, value_length, device)
+        if key not in MultiHeadAttention.relative_position_buckets:
+            rel_pos_indices = torch.arange(query_length, device=device)[:, None] - \
+                              torch.arange(value_length, device=device)[None, :]
+            MultiHeadAttention.relative_position_buckets[key] = MultiHeadAttention._relative_position_bucket(
+                rel_pos_indices)
+        return MultiHeadAttention.relative_position_buckets[key]
 
     # Adapted from https://github.com/huggingface/transformers/blob/master/src/transformers/modeling_t5.py
     # Allow for position embeddings to be able to deal with longer distances
@@ -526,11 +634,15 @@ class MultiHeadAttention(nn.Module):
         return bucket_indices
 
 
+FP16_MIN_LAYERNORM_EPS = 1e-5  # Smaller values round to zero in fp16
+
+
 class InternalLayerNorm(torch.nn.LayerNorm):
     # To be in accordance with HF Albert
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.eps = FLAGS.layernorm_eps
+        self.eps = max(FLAGS.layernorm_eps, FP16_MIN_LAYERNORM_EPS) if FLAGS.precision == 'fp16' \
+            else FLAGS.layernorm_eps
 
 
 class AlbertEmbedder(nn.Module):
@@ -7,6 +7,8 @@ from typing import Dict, List
 from allennlp.data import TokenIndexer, Token, Vocabulary
 
 from config import FLAGS, OBJECTIVE_MAPPING, get_my_tokenizer
+from my_utils.model_utils import get_document_mask
+from my_utils.sharded_checkpoint import load_state
 from transformers import AlbertForMaskedLM
 
 
@@ -17,12 +19,13 @@ class MLMModelWrapper(Model):
         self.model = model(finetune_stage)
         self.objective = OBJECTIVE_MAPPING[FLAGS.objective]
         self.token_indexer = get_my_tokenizer()
+        self.metrics_dict = {}
 
         if FLAGS.selfpretrained_weights_path:
             self.load_selfpretrained_weights()
 
     def load_selfpretrained_weights(self):
-        target_state_dict = torch.load(FLAGS.selfpretrained_weights_path, map_location='cpu')
+        target_state_dict = load_state(FLAGS.selfpretrained_weights_path, map_location='cpu')
         if FLAGS.retrain_self_predictor:
             self_prediction_parameters = [
                 'top_down_regressor',
@@ -39,22 +42,31 @@ class MLMModelWrapper(Model):
 
     def forward(self, input_ids,token_type_ids=None):  # for now ignore ids-offsets and word-level padding mask: just use bpe-level tokens
         new_input_dict = {}
-        new_input_dict['padding_mask'] = input_ids != self.token_indexer.pad_token_id
+        if FLAGS.pack_sequences and not self.finetune_stage:  # Don't attend across the texts packed in a row
+            new_input_dict['padding_mask'] = get_document_mask(input_ids, self.token_indexer)
+        else:
+            new_input_dict['padding_mask'] = input_ids != self.token_indexer.pad_token_id
         if (not self.finetune_stage):
-            masked_ids = self.objective(input_ids, self.token_indexer)
+            masked_ids, target_mask = self.objective(input_ids, self.token_indexer)
             new_input_dict['input_ids'] = masked_ids
         else:
             new_input_dict['input_ids'] = input_ids
-        new_input_dict['masked_lm_labels'] = torch.where(
-            new_input_dict['input_ids'] == self.token_indexer.mask_token_id, input_ids,
-            torch.ones_like(input_ids) * (-100))
+            target_mask = input_ids == self.token_indexer.mask_token_id
+        new_input_dict['masked_lm_labels'] = torch.where(target_mask, input_ids, torch.full_like(input_ids, -100))
         new_input_dict['token_type_ids'] = token_type_ids
         result_dict = self.model(**new_input_dict)
-        result_dict['mask'] = (new_input_dict['input_ids'] == self.token_indexer.mask_token_id)
+        # Models that return their metrics (to keep their forward free of side effects) have them kept here
+        if 'metrics' in result_dict:
+            self.metrics_dict = result_dict.pop('metrics')
+        result_dict['mask'] = target_mask
         return result_dict
 
     def get_metrics(self, **kwargs):
-        return self.model.get_metrics()
+        # New dict needed to avoid overlapping train and validation metrics. Metrics are kept as tensors until here, to
+        # not sync with the GPU in every forward pass
+        metrics = self.model.get_metrics()
+        metrics.update({k: v.item() if isinstance(v, torch.Tensor) else v for k, v in self.metrics_dict.items()})
+        return metrics
 
 
 
@@ -1,5 +1,8 @@
+import copy
 import itertools
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
 import torch
@@ -7,14 +10,41 @@ from allennlp.training.trainer import *
 from allennlp.training import GradientDescentTrainer
 from allennlp.nn import util as nn_util
 from config import FLAGS
+from my_utils.model_utils import autocast
+from my_utils.sharded_checkpoint import ShardedStateWriter, ShardPlan, link_file, link_state, load_state, \
+    remove_state, replace_path
 import logging as log
 
 logger = log.getLogger()
 
 
+def restore_data_position(dataset, training_state):
+    """
+    Restores the position of :dataset: in the current epoch from a training state. Returns False if the training state
+    has no position to restore, in which case the epoch restarts from its start.
+    Older checkpoints pickled the whole data loader instead. Its dataset lacks the attributes the current dataset code
+    needs, so it is dropped and the current, fresh data loader is kept.
+    """
+    if "data_state" in training_state and hasattr(dataset, 'load_state_dict'):
+        dataset.load_state_dict(training_state["data_state"])
+        return True
+    if "data_loader" in training_state:
+        log.warning("The checkpoint stores its position in the data in an old format that can't be restored: "
+                    "restarting its epoch from the start")
+    return False
+
+
 class MyTrainer(GradientDescentTrainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if FLAGS.precision == 'fp16' and self.cuda_device < 0:
+            raise ValueError('fp16 precision needs a GPU, use bf16 on CPU')
+        # Only fp16 needs loss scaling to keep small gradients from underflowing, bf16 has the range of fp32
+        self._grad_scaler = None
+        if FLAGS.precision == 'fp16':
+            if not hasattr(torch.cuda, 'amp') or not hasattr(torch.cuda.amp, 'GradScaler'):
+                raise ValueError(f'fp16 precision needs torch >= 1.6, this is torch {torch.__version__}')
+            self._grad_scaler = torch.cuda.amp.GradScaler()
 
     def batch_loss(self, batch, for_training):
         """
@@ -22,10 +52,11 @@ class MyTrainer(GradientDescentTrainer):
         If `for_training` is `True` also applies regularization penalty.
         """
         batch = nn_util.move_to_device(batch, self.cuda_device)
-        if isinstance(batch, torch.Tensor):
-            output_dict = self._pytorch_model(batch)
-        else:
-            output_dict = self._pytorch_model(**batch)
+        with autocast(self.cuda_device):
+            if isinstance(batch, torch.Tensor):
+                output_dict = self._pytorch_model(batch)
+            else:
+                output_dict = self._pytorch_model(**batch)
 
         try:
             loss = output_dict["loss"]
@@ -41,6 +72,14 @@ class MyTrainer(GradientDescentTrainer):
 
         return loss
 
+    def optimizer_step(self):
+        """With fp16 loss scaling, skips the step if gradients overflowed, and adapts the scale"""
+        if self._grad_scaler is None:
+            self.optimizer.step()
+            return
+        self._grad_scaler.step(self.optimizer)
+        self._grad_scaler.update()
+
     def _train_epoch(self, epoch: int) -> Dict[str, float]:
         """
         Trains one epoch and returns metrics.
@@ -58,6 +97,8 @@ class MyTrainer(GradientDescentTrainer):
         self._pytorch_model.train()
 
         # Get tqdm for the training batches
+        if hasattr(self.data_loader.dataset, 'set_epoch'):
+            self.data_loader.dataset.set_epoch(epoch)
         batch_generator = iter(self.data_loader)
         batch_group_generator = common_util.lazy_groups_of(
             batch_generator, self._num_gradient_accumulation_steps
@@ -70,12 +111,11 @@ class MyTrainer(GradientDescentTrainer):
         )
 
         # Starting batch (nonzero if restarting mid-way an epoch
-        if self.data_loader.dataset.current_permuted_indices is None:
-            starting_batch = 0
+        if hasattr(self.data_loader.dataset, 'get_nb_batches_done'):
+            starting_batch = math.ceil(self.data_loader.dataset.get_nb_batches_done()
+                                       / self._num_gradient_accumulation_steps)
         else:
-            batches_per_row = len(self.data_loader) / len(self.data_loader.dataset.current_permuted_indices)
-            batches_per_row /= self._num_gradient_accumulation_steps
-            starting_batch = math.ceil(batches_per_row * self.data_loader.dataset.row_index)
+            starting_batch = 0
 
         # Having multiple tqdm bars in case of distributed training will be a mess. Hence only the master's
         # progress is shown
@@ -131,10 +171,16 @@ class MyTrainer(GradientDescentTrainer):
                 if self._opt_level is not None:
                     with amp.scale_loss(loss, self.optimizer) as scaled_loss:
                         scaled_loss.backward()
+                elif self._grad_scaler is not None:
+                    # The same scale for every batch in the group, so the accumulated gradients are scaled once
+                    self._grad_scaler.scale(loss).backward()
                 else:
                     loss.backward()
                 train_loss += loss.item()
 
+            # Gradients are unscaled before clipping and logging, so those see the actual values
+            if self._grad_scaler is not None:
+                self._grad_scaler.unscale_(self.optimizer)
             batch_grad_norm = self.rescale_gradients()
 
             # This does nothing if batch_num_total is None or you are using a
@@ -152,7 +198,7 @@ class MyTrainer(GradientDescentTrainer):
                     name: param.detach().cpu().clone()
                     for name, param in self.model.named_parameters()
                 }
-                self.optimizer.step()
+                self.optimizer_step()
                 for name, param in self.model.named_parameters():
                     param_updates[name].sub_(param.detach().cpu())
                     update_norm = torch.norm(param_updates[name].view(-1))
@@ -162,7 +208,7 @@ class MyTrainer(GradientDescentTrainer):
                         update_norm / (param_norm + nn_util.tiny_value_of_dtype(param_norm.dtype)),
                     )
             else:
-                self.optimizer.step()
+                self.optimizer_step()
 
             # Update moving averages
             if self._moving_average is not None:
@@ -308,6 +354,7 @@ class MyTrainer(GradientDescentTrainer):
 
                     if self._metric_tracker.should_stop_early():
                         logger.info("Ran out of patience.  Stopping training and removing intra-epoch checkpoints.")
+                        self._checkpointer.wait()
                         self._checkpointer.remove_intra_epoch_checkpoints()
                         break
 
@@ -379,7 +426,7 @@ class MyTrainer(GradientDescentTrainer):
 
         return metrics
 
-    # Adapted to also save information about the dataloader, to be able to do a restart mid-epoch
+    # Adapted to also save the position in the data, to be able to do a restart mid-epoch
     def _save_checkpoint(self, epoch: Union[int, str]) -> None:
         """
         Saves a checkpoint of the model to self._serialization_dir.
@@ -391,6 +438,7 @@ class MyTrainer(GradientDescentTrainer):
             The epoch of training.  If the checkpoint is saved in the middle
             of an epoch, the parameter is a string with the epoch and timestamp.
         """
+        stall_start_time = time.time()
         # If moving averages are used for parameters, we save
         # the moving average values into checkpoint, instead of the current values.
         if self._moving_average is not None:
@@ -401,8 +449,13 @@ class MyTrainer(GradientDescentTrainer):
             "metric_tracker": self._metric_tracker.state_dict(),
             "optimizer": self.optimizer.state_dict(),
             "batch_num_total": self._batch_num_total,
-            "data_loader": self.data_loader
         }
+        if self._grad_scaler is not None:
+            training_states["grad_scaler"] = self._grad_scaler.state_dict()
+
+        # Only the position in the data is stored, not the data loader itself
+        if hasattr(self.data_loader.dataset, 'state_dict'):
+            training_states["data_state"] = self.data_loader.dataset.state_dict()
 
         # If we have a learning rate or momentum scheduler, we should persist them too.
         if self._learning_rate_scheduler is not None:
@@ -420,8 +473,9 @@ class MyTrainer(GradientDescentTrainer):
         # Restore the original values for parameters so that training will not be affected.
         if self._moving_average is not None:
             self._moving_average.restore()
+        logger.info(f"Checkpointing epoch {epoch} stalled training for {time.time() - stall_start_time:.2f} seconds")
 
-    # Adapted to also save information about the dataloader, to be able to do a restart mid-epoch
+    # Adapted to also restore the position in the data, to be able to do a restart mid-epoch
     def _restore_checkpoint(self) -> int:
         """
         Restores the model and training state from the last saved checkpoint.
@@ -456,6 +510,8 @@ class MyTrainer(GradientDescentTrainer):
         if self._momentum_scheduler is not None and "momentum_scheduler" in training_state:
             self._momentum_scheduler.load_state_dict(training_state["momentum_scheduler"])
         training_util.move_optimizer_to_cuda(self.optimizer)
+        if self._grad_scaler is not None and "grad_scaler" in training_state:
+            self._grad_scaler.load_state_dict(training_state["grad_scaler"])
 
         # Currently the `training_state` contains a serialized `MetricTracker`.
         if "metric_tracker" in training_state:
@@ -467,9 +523,9 @@ class MyTrainer(GradientDescentTrainer):
         # And before that we didn't track anything.
         else:
             self._metric_tracker.clear()
-        self.data_loader = training_state['data_loader']
+        restore_data_position(self.data_loader.dataset, training_state)
         # To deal with restarts from intra-epoch stops
-        if self.data_loader.dataset.chunk_paths or self.data_loader.dataset.current_chunk_path: # This indicates that we didn't finish with all chunks in the epoch that the training state was in
+        if not isinstance(training_state["epoch"], int): # This indicates that we didn't finish with all chunks in the epoch that the training state was in
             epochs_to_add = 0
         else:
             epochs_to_add = 1
@@ -495,6 +551,56 @@ class MyCheckpointer(Checkpointer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # self._num_temp_serialized_models_to_keep = num_temp_serialized_models_to_keep
+        # A single writer thread, with at most one write in flight: checkpoints are written in order, and the CPU
+        # buffers of a snapshot can be reused for the next one once its write is done
+        self._writer = ThreadPoolExecutor(max_workers=1) if FLAGS.async_checkpointing else None
+        self._pending_write = None
+        self._cpu_buffers = []
+        self._sharded_writer = ShardedStateWriter() if FLAGS.sharded_checkpoints else None
+
+    def wait(self):
+        """Blocks until the checkpoint that is being written (if any) is on disk, and raises any error writing it"""
+        if self._pending_write is not None:
+            wait_start_time = time.time()
+            pending_write, self._pending_write = self._pending_write, None
+            pending_write.result()
+            waited = time.time() - wait_start_time
+            if waited > 1:
+                logger.info(f"Waited {waited:.2f} seconds for the previous checkpoint to be written")
+
+    def snapshot(self, state):
+        """
+        Returns a copy of :state: that training can't change anymore. Tensors are copied to CPU memory (pinned when
+        coming from the GPU, so the copies don't block), reusing the buffers of the previous snapshot where they fit.
+        Other objects are deep-copied.
+        """
+        old_buffers = iter(self._cpu_buffers)
+        new_buffers = []
+
+        def copy_to_cpu(obj):
+            if isinstance(obj, torch.Tensor):
+                buffer = next(old_buffers, None)
+                if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                    buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                buffer.copy_(obj.detach(), non_blocking=True)
+                new_buffers.append(buffer)
+                return buffer
+            if isinstance(obj, dict):
+                result = type(obj)((k, copy_to_cpu(v)) for k, v in obj.items())
+                if hasattr(obj, '_metadata'):  # Used by load_state_dict
+                    result._metadata = copy.deepcopy(obj._metadata)
+                return result
+            if type(obj) in (list, tuple):
+                return type(obj)(copy_to_cpu(v) for v in obj)
+            if isinstance(obj, tuple) and hasattr(obj, '_fields'):  # Namedtuples, like ShardPlans
+                return type(obj)(*(copy_to_cpu(v) for v in obj))
+            return copy.deepcopy(obj)
+
+        result = copy_to_cpu(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # Make sure the non-blocking copies are done before the writer reads them
+        self._cpu_buffers = new_buffers
+        return result
 
     def save_checkpoint(
             self,
@@ -503,22 +609,70 @@ class MyCheckpointer(Checkpointer):
             training_states: Dict[str, Any],
             is_best_so_far: bool,
     ) -> None:
+        if self._serialization_dir is None:
+            return
+        self.wait()
+        training_states = {**training_states, "epoch": epoch}
+        if self._sharded_writer is not None:
+            # Planned on the live tensors, to know which ones are tied
+            model_state, training_states = self._sharded_writer.plan(
+                [(model_state, self.get_model_path(epoch)), (training_states, self.get_training_path(epoch))])
+        if self._writer is None:
+            self.write_checkpoint(epoch, model_state, training_states, is_best_so_far)
+        else:
+            model_state, training_states = self.snapshot((model_state, training_states))
+            self._pending_write = self._writer.submit(self.write_checkpoint, epoch, model_state, training_states,
+                                                      is_best_so_far)
+
+    def atomic_save(self, obj, path):
+        """Writes to a temporary file first, so that a crash mid-write never leaves a partial checkpoint at :path:"""
+        # The temporary name must not look like a checkpoint, or find_latest_checkpoint would pick it up
+        handle, tmp_path = tempfile.mkstemp(dir=self._serialization_dir, prefix=".tmp_")
+        os.close(handle)
+        try:
+            torch.save(obj, tmp_path)
+            replace_path(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_model_path(self, epoch):
+        return os.path.join(self._serialization_dir, "model_state_epoch_{}.th".format(epoch))
+
+    def get_training_path(self, epoch):
+        return os.path.join(self._serialization_dir, "training_state_epoch_{}.th".format(epoch))
+
+    def save_state(self, state, path):
+        if isinstance(state, ShardPlan):
+            self._sharded_writer.write(state)
+        else:
+            self.atomic_save(state, path)
+
+    def write_checkpoint(
+            self,
+            epoch: Union[int, str],
+            model_state: Dict[str, Any],
+            training_states: Dict[str, Any],
+            is_best_so_far: bool,
+    ) -> None:
+        write_start_time = time.time()
         is_intra_epoch_checkpoint = re.search(".*\..*", str(epoch)) is not None
         if self._serialization_dir is not None:
-            model_path = os.path.join(
-                self._serialization_dir, "model_state_epoch_{}.th".format(epoch)
-            )
-            torch.save(model_state, model_path)
-            training_path = os.path.join(
-                self._serialization_dir, "training_state_epoch_{}.th".format(epoch)
-            )
-            torch.save({**training_states, "epoch": epoch}, training_path)
+            model_path = self.get_model_path(epoch)
+            self.save_state(model_state, model_path)
+            training_path = self.get_training_path(epoch)
+            self.save_state(training_states, training_path)
 
             if is_best_so_far and not is_intra_epoch_checkpoint:
+                best_path = os.path.join(self._serialization_dir, "best.th")
                 logger.info(
-                    f"Best validation performance so far. Copying weights from epoch {str(epoch)} to '{self._serialization_dir}/best.th'."
+                    f"Best validation performance so far. Linking weights from epoch {str(epoch)} to '{best_path}'."
                 )
-                shutil.copyfile(model_path, os.path.join(self._serialization_dir, "best.th"))
+                # The model state was just written: no need to serialize it again
+                if isinstance(model_state, ShardPlan):
+                    link_state(model_path, best_path)
+                else:
+                    link_file(model_path, best_path)
 
             # Clear out this epoch's intra-epoch-checkpoints
             if not is_intra_epoch_checkpoint:
@@ -550,12 +704,32 @@ class MyCheckpointer(Checkpointer):
                             self._last_permanent_saved_checkpoint_time = save_time
                     if remove_path:
                         for fname in paths_to_remove[1:]:
-                            if os.path.isfile(fname):
-                                os.remove(fname)
+                            remove_state(fname)
+        logger.info(f"Wrote checkpoint for epoch {epoch} in {time.time() - write_start_time:.2f} seconds")
+
+    # Reading checkpoints waits for the one being written, so it is never missed or read half-written
+    def find_latest_checkpoint(self):
+        self.wait()
+        return super().find_latest_checkpoint()
+
+    # Both read with load_state, so that sharded checkpoints (directories) can be restored as well
+    def restore_checkpoint(self):
+        latest_checkpoint = self.find_latest_checkpoint()
+        if latest_checkpoint is None:
+            return {}, {}
+        model_path, training_state_path = latest_checkpoint
+        return load_state(model_path, map_location='cpu'), load_state(training_state_path, map_location='cpu')
+
+    def best_model_state(self):
+        self.wait()
+        if self._serialization_dir:
+            logger.info("loading best weights")
+            return load_state(os.path.join(self._serialization_dir, "best.th"))
+        logger.info("cannot load best weights without `serialization_dir`, so you're just getting the last weights")
+        return {}
 
     def remove_intra_epoch_checkpoints(self):
         for i, _ in enumerate(self._serialized_paths):
             paths_to_remove = self._serialized_paths.pop(i)
             for fname in paths_to_remove[1:]:
-                if os.path.isfile(fname):
-                    os.remove(fname)
+                remove_state(fname)
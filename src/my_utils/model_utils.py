@@ -1,21 +1,52 @@
+import contextlib
+
 import torch
 from torch import nn
 
 from config import FLAGS
 
 
+PRECISION_TO_DTYPE = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device):
+    """
+    Context in which operations on :device: (a torch.device, or a cuda index with -1 for CPU) that are safe to run in
+    lower precision run in FLAGS.precision. Does nothing for fp32.
+    """
+    if FLAGS.precision == 'fp32':
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise ValueError(f'{FLAGS.precision} precision needs torch >= 1.10, this is torch {torch.__version__}')
+    if not isinstance(device, torch.device):
+        device = torch.device('cpu') if device < 0 else torch.device(f'cuda:{device}')
+    return torch.autocast(device_type=device.type, dtype=PRECISION_TO_DTYPE[FLAGS.precision])
+
+
 def apply_sequence_mask(given):
     """Replaces each slice of the given tensor ALONG THE SEQUENCE DIMENSION (ASSUMED 1) with zeroes with a probability FLAGS.masking_fraction
     Also returns the mask
     """
 
-    mask = (torch.rand(given.shape[1]) > FLAGS.masking_fraction).cuda(
-        given.device)  # Same mask for items in batch
+    mask = torch.rand(given.shape[1], device=given.device) > FLAGS.masking_fraction  # Same mask for items in batch
     broadcast_ready_mask = mask[None, :, None]
     masked_in_state = given * broadcast_ready_mask
     return masked_in_state, mask
 
 
+def get_document_mask(input_ids, token_indexer):
+    """
+    For rows that pack several texts separated by [SEP] tokens: returns a [d_batch, seq_length, seq_length] mask that
+    is True where a query position can attend to a value position, namely the non-padding positions of the same text.
+    Padding positions can attend to all non-padding positions, as with a 2D padding mask.
+    """
+    is_sep = input_ids == token_indexer.sep_token_id
+    document_ids = torch.cumsum(is_sep, dim=1) - is_sep.long()  # A [SEP] belongs to the text it ends
+    is_real = input_ids != token_indexer.pad_token_id
+    same_document = document_ids[:, :, None] == document_ids[:, None, :]
+    return (same_document | ~is_real[:, :, None]) & is_real[:, None, :]
+
+
 def masked_MSE_loss(target, predicted, mask):
     '''
     Returns a mean-square-error loss that only considers sequence elements (along the 2nd dimension) for which the mask is zero
@@ -34,26 +65,98 @@ def masked_cosine_critic(target, predicted, mask):
     return (1 + mean_cosine_similarity)/2 # Squeeze between 0 and 1
 
 
-def contrastive_loss(in_state, predicted_in_state, mask):
-    if FLAGS.d_batch <= 1:
+def summed_masked_MSE_over_pairs(target, predicted, mask):
+    '''
+    Same as sum([masked_MSE_loss(t[None], predicted, mask) for t in target]), so the squared distance of every
+    prediction to every target, but computed from sums over the batch instead of from a copy of the predictions per
+    target: sum_a,b |t_a - p_b|^2 = n_p * sum_a |t_a|^2 + n_t * sum_b |p_b|^2 - 2 (sum_a t_a).(sum_b p_b)
+    With as many targets as predictions, this is the sum of masked_MSE_loss over all rolls of the target.
+    '''
+    nb_targets, nb_predicted = target.shape[0], predicted.shape[0]
+    masked_target, masked_predicted = target[:, ~mask, :], predicted[:, ~mask, :]
+    summed_squared_distances = nb_predicted * masked_target.pow(2).sum() + nb_targets * masked_predicted.pow(2).sum() \
+                               - 2 * (masked_target.sum(dim=0) * masked_predicted.sum(dim=0)).sum()
+    return summed_squared_distances / predicted.numel()
+
+
+def masked_cosine_similarities(target, predicted, mask, eps=1e-8):
+    '''
+    Returns a [nb_targets, d_batch] matrix with at [a, b] the cosine similarity between target a and prediction b,
+    averaged over the sequence elements for which the mask is zero. Computed as one batched matrix product per element.
+    '''
+    masked_target = target[:, ~mask, :].transpose(0, 1)  # [nb_masked, nb_targets, d_hidden]
+    masked_predicted = predicted[:, ~mask, :].transpose(0, 1)
+    normalized_target = masked_target / masked_target.norm(dim=-1, keepdim=True).clamp(min=eps)
+    normalized_predicted = masked_predicted / masked_predicted.norm(dim=-1, keepdim=True).clamp(min=eps)
+    return torch.bmm(normalized_target, normalized_predicted.transpose(1, 2)).mean(dim=0)
+
+
+def contrastive_loss(in_state, predicted_in_state, mask, extra_negatives=None):
+    '''
+    Contrasts the prediction of every batch element with its own in_state (positive) and with the in_states of the
+    batch elements it is shifted against (negatives), for the sequence elements for which the mask is zero.
+    The negatives for all shifts are computed at once, without rolled copies of in_state.
+    :extra_negatives: optional [nb_extra, seq_length, d_hidden] states (e.g. from a NegativesMemoryBank) that every
+    prediction is contrasted with as well.
+    '''
+    nb_extra = 0 if extra_negatives is None else extra_negatives.shape[0]
+    if FLAGS.d_batch + nb_extra <= 1:
         raise ValueError('Using DIR requires batch size bigger than 1 to contrast with')
     d_batch = in_state.shape[0]
+    targets = in_state if nb_extra == 0 else torch.cat((in_state, extra_negatives.to(in_state.dtype)))
+    nb_targets = targets.shape[0]
     if FLAGS.contrastive_loss == 'MSE':
-        negative_loss = sum([masked_MSE_loss(in_state.roll(shifts=i, dims=0), predicted_in_state, mask) for i in
-                             range(
-                                 d_batch)]) / d_batch if d_batch > 1 else torch.tensor(
-            1.)
+        negative_loss = summed_masked_MSE_over_pairs(targets, predicted_in_state, mask) / nb_targets \
+            if nb_targets > 1 else torch.tensor(1.)
         # Positive loss: distance to corresponding batch element
         positive_loss = masked_MSE_loss(in_state, predicted_in_state, mask)
         layer_loss = positive_loss / negative_loss
     elif FLAGS.contrastive_loss == 'CE':
-        positive_similarity = torch.log(masked_cosine_critic(in_state, predicted_in_state, mask))
-        negatives_dissimilarity = sum([torch.log(1-masked_cosine_critic(in_state.roll(shifts=i, dims=0), predicted_in_state, mask))
-            for i in range(d_batch - 1)])
+        # Critics are cosine similarities squeezed between 0 and 1, as in masked_cosine_critic
+        critics = (1 + masked_cosine_similarities(targets, predicted_in_state, mask)) / 2
+        positive_similarity = torch.log(critics[:d_batch].diagonal().mean())
+        # Rolling in_state by a shift puts target (b - shift) % d_batch next to prediction b
+        shifts = torch.arange(d_batch - 1, device=in_state.device)
+        predicted_indices = torch.arange(d_batch, device=in_state.device)
+        target_indices = (predicted_indices[None, :] - shifts[:, None]) % d_batch
+        negatives_dissimilarity = torch.log(1 - critics[target_indices, predicted_indices[None, :]].mean(dim=1)).sum()
+        # Every extra negative is contrasted with all predictions, like one more shift
+        negatives_dissimilarity = negatives_dissimilarity + torch.log(1 - critics[d_batch:].mean(dim=1)).sum()
         layer_loss = - (positive_similarity + negatives_dissimilarity)
     return layer_loss
 
 
+class NegativesMemoryBank:
+    '''
+    Keeps, per layer, the (detached) states of the last :size: batch elements that passed through that layer, to serve
+    as extra negatives for contrastive_loss in later batches. States of a different sequence length than the current
+    batch can't be contrasted with position by position, so they are dropped once a batch of a new length comes in.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.states = {}
+
+    def get(self, layer_idx, in_state):
+        '''Returns the stored negatives for :layer_idx: that match the shape of :in_state:, or None'''
+        negatives = self.states.get(layer_idx)
+        if negatives is None or negatives.shape[1:] != in_state.shape[1:]:
+            return None
+        return negatives
+
+    def push(self, layer_idx, in_state):
+        if self.size == 0:
+            return
+        in_state = in_state.detach()
+        negatives = self.get(layer_idx, in_state)
+        if negatives is not None:
+            in_state = torch.cat((in_state, negatives))
+        self.states[layer_idx] = in_state[:self.size]
+
+    def clear(self):
+        self.states = {}
+
+
 def process_targets_for_loss(target_tokens):
     max_target_seq_length = target_tokens.shape[-1]  # Longest length if no adjacent masks
     current_target_seq_length = target_tokens.shape[1]
@@ -0,0 +1,202 @@
+import ctypes
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import torch
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+SKELETON_NAME = 'skeleton.pt'
+SHARD_KEY = '__shard__'
+
+ShardPlan = namedtuple('ShardPlan', ['path', 'skeleton', 'file_of_key', 'tensors', 'slot'])
+
+
+def get_digest(tensor):
+    """Hash of the dtype, shape and contents of :tensor:"""
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.blake2b(f'{tensor.dtype}{tuple(tensor.shape)}'.encode(), digest_size=16)
+    nb_bytes = tensor.numel() * tensor.element_size()
+    if nb_bytes:
+        digest.update((ctypes.c_char * nb_bytes).from_address(tensor.data_ptr()))
+    return digest.hexdigest()
+
+
+class ShardedStateWriter:
+    """
+    Writes (nested) state dicts as a directory with one file per tensor:
+        <path>/manifest.json: json with the file of every tensor, by its key (the path to it in the state, '/'-joined),
+            and the digest of the contents of every file
+        <path>/skeleton.pt: the state with every tensor replaced by {SHARD_KEY: <key>}
+        <path>/<i>.pt: one per distinct tensor. Tied tensors (same memory) are stored once.
+    Tensors whose contents haven't changed since the previous save (e.g. frozen parameters) aren't written again, but
+    hard-linked to their file in the previous checkpoint. Whether they changed is decided by a hash of their contents,
+    not by their memory or version counter, which in-place updates through .data views don't show in.
+    Saving is split in plan(), which needs the live tensors to find tied ones, and write(), which can run on a snapshot
+    of the tensors in another thread.
+    """
+
+    def __init__(self):
+        # (slot, key) -> (file, digest) of the tensors in the last written state of every slot
+        self.saved = {}
+
+    @staticmethod
+    def get_signature(tensor):
+        return tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor.dtype, tensor.device
+
+    def plan(self, states_and_paths):
+        """
+        Returns a ShardPlan for every (state, path) in :states_and_paths:. The position of a state in the list is its
+        slot: tensors are only compared to those saved in the same slot before.
+        """
+        plans = []
+        for slot, (state, path) in enumerate(states_and_paths):
+            skeleton, tensors = split_tensors(state)
+            file_of_key, tensor_of_file, file_of_signature = {}, {}, {}
+            for key, tensor in tensors.items():
+                signature = self.get_signature(tensor)
+                if signature not in file_of_signature:
+                    file = f'{len(file_of_signature)}.pt'
+                    file_of_signature[signature] = file
+                    tensor_of_file[file] = tensor
+                file_of_key[key] = file_of_signature[signature]
+            plans.append(ShardPlan(path, skeleton, file_of_key, tensor_of_file, slot))
+        return plans
+
+    def write(self, plan):
+        """Writes into a temporary directory that is renamed to plan.path at the end, so partial writes never show"""
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(plan.path), prefix='.tmp_')
+        first_key_of_file = {}
+        for key, file in plan.file_of_key.items():
+            first_key_of_file.setdefault(file, key)
+        saved, digests, linked = {}, {}, []
+        for file, tensor in plan.tensors.items():
+            digest = get_digest(tensor)
+            previous = self.saved.get((plan.slot, first_key_of_file[file]))
+            if previous is not None and previous[1] == digest and os.path.exists(previous[0]):
+                link_or_copy(previous[0], os.path.join(tmp_path, file))
+                linked.append(file)
+            else:
+                torch.save(tensor, os.path.join(tmp_path, file))
+            saved[(plan.slot, first_key_of_file[file])] = (os.path.join(plan.path, file), digest)
+            digests[file] = digest
+        torch.save(plan.skeleton, os.path.join(tmp_path, SKELETON_NAME))
+        with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+            json.dump({'format_version': FORMAT_VERSION,
+                       'tensors': plan.file_of_key,
+                       'digests': digests,
+                       'linked': sorted(linked)}, f)
+        replace_path(tmp_path, plan.path)
+        self.saved = {k: v for k, v in self.saved.items() if k[0] != plan.slot}
+        self.saved.update(saved)
+
+
+def split_tensors(state, key=''):
+    """Returns a copy of :state: with every tensor replaced by {SHARD_KEY: <key>}, and a dict of the tensors by key"""
+    if isinstance(state, torch.Tensor):
+        return {SHARD_KEY: key}, {key: state.detach()}
+    tensors = {}
+    if isinstance(state, dict):
+        skeleton = type(state)()
+        for k, v in state.items():
+            skeleton[k], sub_tensors = split_tensors(v, f'{key}/{k}' if key else str(k))
+            tensors.update(sub_tensors)
+        if hasattr(state, '_metadata'):  # Used by load_state_dict
+            skeleton._metadata = state._metadata
+        return skeleton, tensors
+    if type(state) in (list, tuple):
+        skeleton = []
+        for i, v in enumerate(state):
+            sub_skeleton, sub_tensors = split_tensors(v, f'{key}/{i}' if key else str(i))
+            skeleton.append(sub_skeleton)
+            tensors.update(sub_tensors)
+        return type(state)(skeleton), tensors
+    return state, {}
+
+
+def fill_tensors(skeleton, load_tensor):
+    if isinstance(skeleton, dict):
+        if set(skeleton.keys()) == {SHARD_KEY}:
+            return load_tensor(skeleton[SHARD_KEY])
+        result = type(skeleton)((k, fill_tensors(v, load_tensor)) for k, v in skeleton.items())
+        if hasattr(skeleton, '_metadata'):
+            result._metadata = skeleton._metadata
+        return result
+    if type(skeleton) in (list, tuple):
+        return type(skeleton)(fill_tensors(v, load_tensor) for v in skeleton)
+    return skeleton
+
+
+def is_sharded(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def load_state(path, map_location=None):
+    """Loads a state saved with ShardedStateWriter, or with plain torch.save"""
+    if not is_sharded(path):
+        return torch.load(path, map_location=map_location)
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        file_of_key = json.load(f)['tensors']
+    loaded = {}  # Tied tensors are loaded once, and stay tied
+
+    def load_tensor(key):
+        file = file_of_key[key]
+        if file not in loaded:
+            loaded[file] = torch.load(os.path.join(path, file), map_location=map_location)
+        return loaded[file]
+
+    return fill_tensors(torch.load(os.path.join(path, SKELETON_NAME), map_location=map_location), load_tensor)
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:  # E.g. a file system without hard links
+        shutil.copyfile(source, destination)
+
+
+def link_state(source, destination):
+    """Makes :destination: hold the same state as :source: without copying any data, if both are sharded"""
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(destination), prefix='.tmp_')
+    for file in os.listdir(source):
+        link_or_copy(os.path.join(source, file), os.path.join(tmp_path, file))
+    replace_path(tmp_path, destination)
+
+
+def link_file(source, destination):
+    """Makes :destination: a hard link to the file :source: (a copy where linking isn't possible), replacing whatever is
+    there. A copy goes through a temporary file, so :destination: is never partially written."""
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination), prefix='.tmp_')
+    os.close(handle)
+    os.remove(tmp_path)  # os.link needs a free name
+    try:
+        link_or_copy(source, tmp_path)
+        replace_path(tmp_path, destination)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def replace_path(source, destination):
+    """Moves the file or directory :source: to :destination:, replacing whatever is there"""
+    if os.path.isdir(destination):
+        # A directory can't be replaced in one rename: move it out of the way first
+        old_path = tempfile.mkdtemp(dir=os.path.dirname(destination), prefix='.tmp_')
+        os.rename(destination, os.path.join(old_path, 'old'))
+        os.rename(source, destination)
+        shutil.rmtree(old_path)
+    else:
+        if os.path.isdir(source) and os.path.exists(destination):  # A directory can't replace a file in one rename
+            os.remove(destination)
+        os.replace(source, destination)
+
+
+def remove_state(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
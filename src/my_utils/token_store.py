@@ -0,0 +1,181 @@
+import bisect
+import json
+import os
+
+import numpy as np
+
+OFFSET_DTYPE = np.dtype(np.int64)
+
+
+def smallest_id_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+
+
+class FlatTokenStore:
+    """
+    Read-only view on rows of token ids that are stored back-to-back in one flat file on disk.
+    Files making up a store at <path>:
+        <path>.tokens: all token ids, unpadded, as a raw uint16 or int32 array
+        <path>.offsets: raw int64 array of nb_rows + 1 positions in <path>.tokens where rows start (last one is the end)
+        <path>.meta: json with the dtype of the tokens. Written last, so only complete stores have one.
+    Both arrays are memory-mapped, so opening a store is near-instant and only the rows that are read end up in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}.meta') as f:
+            self.meta = json.load(f)
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.offsets = np.memmap(f'{path}.offsets', dtype=OFFSET_DTYPE, mode='r')
+        if self.offsets[-1] > 0:
+            self.tokens = np.memmap(f'{path}.tokens', dtype=self.dtype, mode='r')
+        else:  # np.memmap can't map empty files
+            self.tokens = np.zeros(0, dtype=self.dtype)
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(f'{path}{suffix}') for suffix in ['.tokens', '.offsets', '.meta'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nb_tokens(self):
+        return int(self.offsets[-1])
+
+    def lengths(self, start=0, end=None):
+        return np.diff(self.offsets[start:(len(self) if end is None else end) + 1])
+
+    def row(self, index):
+        """Zero-copy view on the unpadded ids of row :index:"""
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def padded_row(self, index, length, pad_id):
+        return pad_row(self.row(index), length, pad_id)
+
+
+class TokenStoreView:
+    """
+    Presents row ranges of one or more FlatTokenStores as one sequence of rows, without copying anything.
+    :segments: list of (store, first_row, end_row)
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.segment_starts = [0]
+        for _, first_row, end_row in segments:
+            self.segment_starts.append(self.segment_starts[-1] + end_row - first_row)
+
+    def __len__(self):
+        return self.segment_starts[-1]
+
+    @property
+    def nb_tokens(self):
+        return sum(int(store.offsets[end_row] - store.offsets[first_row]) for store, first_row, end_row in self.segments)
+
+    def locate(self, index):
+        """Returns the store that row :index: of the view is in, and its index in that store"""
+        segment = bisect.bisect_right(self.segment_starts, index) - 1
+        store, first_row, _ = self.segments[segment]
+        return store, first_row + index - self.segment_starts[segment]
+
+    def lengths(self, start=0, end=None):
+        end = len(self) if end is None else end
+        result = []
+        for segment, (store, first_row, end_row) in enumerate(self.segments):
+            segment_start = self.segment_starts[segment]
+            overlap_start, overlap_end = max(start, segment_start), min(end, self.segment_starts[segment + 1])
+            if overlap_start < overlap_end:
+                result.append(store.lengths(first_row + overlap_start - segment_start,
+                                            first_row + overlap_end - segment_start))
+        return np.concatenate(result) if result else np.zeros(0, dtype=OFFSET_DTYPE)
+
+    def row(self, index):
+        store, store_index = self.locate(index)
+        return store.row(store_index)
+
+    def padded_row(self, index, length, pad_id):
+        return pad_row(self.row(index), length, pad_id)
+
+
+def pad_row(row, length, pad_id):
+    row = row[:length]
+    result = np.full(length, pad_id, dtype=np.int64)
+    result[:len(row)] = row
+    return result
+
+
+class FlatTokenStoreWriter:
+    """
+    Appends rows of token ids to a FlatTokenStore at :path:. Rows are stripped of trailing padding before being
+    written. The meta file is only written on close, so a store that FlatTokenStore.exists is complete.
+    :resume_from: (nb_rows, nb_tokens) as returned by flush() of an earlier, interrupted writer to the same path.
+        Anything that was written to the files after that flush is discarded.
+    """
+
+    def __init__(self, path, dtype, pad_id, resume_from=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.pad_id = pad_id
+        if os.path.exists(f'{path}.meta'):  # Invalidate any previous store at this path
+            os.remove(f'{path}.meta')
+        if resume_from is None:
+            self.nb_rows, self.nb_tokens = 0, 0
+            self.tokens_file = open(f'{path}.tokens', 'wb')
+            self.offsets_file = open(f'{path}.offsets', 'wb')
+            self.offsets_file.write(np.zeros(1, dtype=OFFSET_DTYPE).tobytes())
+        else:
+            self.nb_rows, self.nb_tokens = resume_from
+            self.tokens_file = open(f'{path}.tokens', 'r+b')
+            self.tokens_file.truncate(self.nb_tokens * self.dtype.itemsize)
+            self.tokens_file.seek(0, os.SEEK_END)
+            self.offsets_file = open(f'{path}.offsets', 'r+b')
+            self.offsets_file.truncate((self.nb_rows + 1) * OFFSET_DTYPE.itemsize)
+            self.offsets_file.seek(0, os.SEEK_END)
+
+    def _write(self, tokens, lengths):
+        self.tokens_file.write(np.asarray(tokens).astype(self.dtype).tobytes())
+        self.offsets_file.write((self.nb_tokens + np.cumsum(lengths, dtype=OFFSET_DTYPE)).tobytes())
+        self.nb_rows += len(lengths)
+        self.nb_tokens += int(np.sum(lengths))
+
+    def append_rows(self, rows):
+        """Appends a 2D array of padded rows in one write"""
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return
+        is_real = rows != self.pad_id
+        # Only trailing padding is stripped: the length is up to and including the last non-pad id
+        lengths = np.where(is_real.any(axis=1), rows.shape[1] - np.argmax(is_real[:, ::-1], axis=1), 0)
+        keep = np.arange(rows.shape[1])[None, :] < lengths[:, None]
+        self._write(rows[keep], lengths)
+
+    def __len__(self):
+        return self.nb_rows
+
+    def flush(self):
+        """Makes sure everything appended so far is on disk, and returns the position to resume from after this"""
+        for f in [self.tokens_file, self.offsets_file]:
+            f.flush()
+            os.fsync(f.fileno())
+        return self.nb_rows, self.nb_tokens
+
+    def close(self):
+        self.flush()
+        self.tokens_file.close()
+        self.offsets_file.close()
+        tmp_path = f'{self.path}.meta.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'dtype': self.dtype.name}, f)
+        os.replace(tmp_path, f'{self.path}.meta')
+        return FlatTokenStore(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.tokens_file.close()
+            self.offsets_file.close()
@@ -7,6 +7,7 @@ from torch import distributed as dist
 
 from config import FLAGS, MODEL_RELEVANT_FLAGS
 from wrappers import MLMModelWrapper, MODEL_MAPPING
+from my_utils.sharded_checkpoint import load_state
 import logging as log
 
 
@@ -45,7 +46,7 @@ def load_pretrained_model_for_SG():
     wrapped_model = MLMModelWrapper(MODEL_MAPPING[FLAGS.model],finetune_stage=True)
 
     # A hack because I renamed one of the models modules :P
-    old_state_dict = torch.load(model_path, map_location=torch.device(FLAGS.device_idxs[0]))
+    old_state_dict = load_state(model_path, map_location=torch.device(FLAGS.device_idxs[0]))
     updated_state_dict = OrderedDict(
         (k.replace("model.predictor", "model.lm_head"), v) for k, v in old_state_dict.items())
 
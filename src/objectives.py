@@ -1,49 +1,124 @@
-from copy import deepcopy
-import itertools
-import random
-
 import torch
-from allennlp.data import Token
+import torch.nn.functional as F
 
 from config import FLAGS
-from constants import MASKING_TOKEN, TO_BE_DELETED_TOKEN, EOS_TOKEN, BPE_INDEXER_SUFFIX
 
 
-def t5_denoise_spans_objective(
-        tokens):  # Based on objective in t5 paper: https://arxiv.org/abs/1910.10683 #TODO update this to work with tensors instead of lists
+TOKEN_TABLES = {}  # Per device, lookup tables from token id to properties of that token
+
+
+def get_token_tables(token_indexer, device):
+    """
+    Returns boolean tensors of shape [vocab_size] on :device: that indicate per id whether it is a special token,
+    and whether it starts a word (a sentencepiece token starting with '▁', or a special token).
+    Built once per device, so masking a batch doesn't need to leave the device.
+    """
+    if device not in TOKEN_TABLES:
+        vocab_size = token_indexer.vocab_size
+        is_special = torch.zeros(vocab_size, dtype=torch.bool)
+        is_special[[i for i in token_indexer.all_special_ids if i < vocab_size]] = True
+        is_word_start = torch.tensor([token.startswith('▁') for token in
+                                      token_indexer.convert_ids_to_tokens(list(range(vocab_size)))]) | is_special
+        TOKEN_TABLES[device] = is_special.to(device), is_word_start.to(device)
+    return TOKEN_TABLES[device]
+
+
+def BERT_MLM_objective(target_ids, token_indexer):
     '''
-    Produces inputs and targets.
-    Inputs correspond to the original tokens, with a certain fraction of tokens replaced by a MASK-token.
-    Contiguous tokens that happen to get masked get replaced by a single MASK token.
-    There is no switching with random words, ... ( “MASS-style” objective )
-    Targets look like: [mask_0, *<first word that was masked, possibly multiple if contiguous>, mask_1, <same>, ... , mask_eos, padding, padding, ... >
+    Selects FLAGS.masking_fraction of the (non-special) tokens in :target_ids: to be predicted, and returns
+    (the ids with the selected tokens corrupted, a boolean mask of the selected tokens).
+    If FLAGS.whole_word_masking, all tokens of a word are selected together.
+    Selected tokens are replaced by a mask id, or if FLAGS.mask_replacement_80_10_10, as in BERT: 80% by a mask id,
+    10% by a random id and 10% are kept as is.
     '''
-    masked_indices = sorted(random.sample(range(len(tokens)), int(len(tokens) * FLAGS.masking_fraction)))  #
+    is_special_table, is_word_start_table = get_token_tables(token_indexer, target_ids.device)
+    is_special = is_special_table[target_ids]
+    selection_scores = torch.rand(target_ids.shape, device=target_ids.device)
+    if FLAGS.whole_word_masking:
+        # Every token takes the score of the first token of its word
+        positions = torch.arange(target_ids.shape[1], device=target_ids.device).expand_as(target_ids)
+        word_start_positions = torch.where(is_word_start_table[target_ids], positions, torch.zeros_like(positions))
+        selection_scores = selection_scores.gather(1, torch.cummax(word_start_positions, dim=1)[0])
+    target_mask = (selection_scores < FLAGS.masking_fraction) & ~is_special
 
-    given = [t if (i not in masked_indices) else MASKING_TOKEN for i, t in enumerate(tokens)]
-    masked_given = [i for i, j in zip(given[1:], given[:-1]) if not (i == MASKING_TOKEN and i == j)]
-    mask_counter = itertools.count()
-    unique_masked_given = [Token(f'{i}_{next(mask_counter)}') if i == MASKING_TOKEN else i for i in masked_given]
+    replacement_ids = torch.full_like(target_ids, token_indexer.mask_token_id)
+    if FLAGS.mask_replacement_80_10_10:
+        replacement_scores = torch.rand(target_ids.shape, device=target_ids.device)
+        random_ids = torch.randint_like(target_ids, token_indexer.vocab_size)
+        replacement_ids = torch.where(replacement_scores < .8, replacement_ids,
+                                      torch.where(replacement_scores < .9, random_ids, target_ids))
+    masked_ids = torch.where(target_mask, replacement_ids, target_ids)
+    return masked_ids, target_mask
 
-    target = [tokens[i] for i in masked_indices]
-    include_mask = [True] + [((i - j) != 1) for i, j in zip(masked_indices[1:], masked_indices[:-1])]
-    masks = [MASKING_TOKEN if x else TO_BE_DELETED_TOKEN for x in include_mask]
-    masked_target = [i for j in zip(masks, target) for i in j if i != TO_BE_DELETED_TOKEN]
-    mask_counter = itertools.count()  # Restart count
-    unique_masked_target = [Token(f'{i}_{next(mask_counter)}') if i == MASKING_TOKEN else i for i in masked_target] + [
-        Token(EOS_TOKEN)]
-    return unique_masked_given, unique_masked_target
 
+def get_span_mask(target_ids, token_indexer):
+    '''
+    Selects spans of FLAGS.mean_span_length (rounded) tokens, starting at random positions such that about
+    FLAGS.masking_fraction of the tokens is selected. Overlapping and adjacent spans merge. Special tokens are never
+    selected. Returns a boolean mask of the selected tokens.
+    '''
+    is_special = get_token_tables(token_indexer, target_ids.device)[0][target_ids]
+    span_length = max(int(round(FLAGS.mean_span_length)), 1)
+    is_start = torch.rand(target_ids.shape, device=target_ids.device) < FLAGS.masking_fraction / span_length
+    # A token is selected if a span started at most span_length - 1 positions before it
+    nb_starts = torch.cumsum(is_start, dim=1)
+    nb_starts_span_length_before = F.pad(nb_starts, (span_length, 0))[:, :-span_length]
+    return (nb_starts > nb_starts_span_length_before) & ~is_special
 
-def BERT_MLM_objective(target_ids, token_indexer):
+
+def t5_span_MLM_objective(target_ids, token_indexer):
+    '''
+    Span masking for encoder-only models: the tokens of spans selected as for t5_denoise_spans_objective are each
+    replaced by a mask id, so the sequence length doesn't change. Returns (masked ids, mask of selected tokens).
     '''
-    Produces a tensor of the same shape as masked_lm_labels, but with FLAGS.masking_fraction of the tokens replaces by a mask id
+    target_mask = get_span_mask(target_ids, token_indexer)
+    masked_ids = torch.where(target_mask, torch.full_like(target_ids, token_indexer.mask_token_id), target_ids)
+    return masked_ids, target_mask
+
+
+def get_sentinel_ids(token_indexer, nb_sentinels, device):
+    '''
+    Ids for the first :nb_sentinels: sentinels: the tokenizer's additional special tokens (<extra_id_i> for T5
+    tokenizers), with the last one repeated if there are too few. ALBERT's vocabulary has none, so then all sentinels are
+    the mask id.
     '''
-    masking_id = token_indexer.mask_token_id
-    is_special_token = deepcopy(target_ids).cpu().apply_(lambda x: x in token_indexer.all_special_ids).cuda(target_ids.device).to(torch.bool)
-    condition = (torch.rand(target_ids.shape).cuda(target_ids.device) > FLAGS.masking_fraction) | \
-                (is_special_token)
-    masked_ids = torch.where(condition,
-                             target_ids,
-                             masking_id * torch.ones_like(target_ids))
-    return masked_ids
\ No newline at end of file
+    additional_ids = token_indexer.additional_special_tokens_ids or [token_indexer.mask_token_id]
+    sentinel_ids = additional_ids[:nb_sentinels] + [additional_ids[-1]] * max(nb_sentinels - len(additional_ids), 0)
+    return torch.tensor(sentinel_ids, device=device)
+
+
+def compact(ids, keep, pad_id):
+    '''Moves the :ids: where :keep: is True to the start of their row (in order), and pads the rest'''
+    d_batch, seq_length = ids.shape
+    # Ids that aren't kept are all written to an extra last column, which is then dropped
+    new_positions = torch.where(keep, torch.cumsum(keep, dim=1) - 1, torch.full_like(ids, seq_length))
+    result = torch.full((d_batch, seq_length + 1), pad_id, dtype=ids.dtype, device=ids.device)
+    result.scatter_(1, new_positions, ids)
+    return result[:, :int(keep.sum(dim=1).max())]
+
+
+def t5_denoise_spans_objective(target_ids, token_indexer):
+    '''
+    Span corruption as in T5 (https://arxiv.org/abs/1910.10683), for a [d_batch, seq_length] batch of ids, on the
+    device of the batch. Returns (input ids, target ids) for an encoder-decoder model, both right-padded:
+    Inputs are :target_ids: with every span of selected tokens replaced by a single sentinel.
+    Targets look like: [sentinel_0, <tokens of span 0>, sentinel_1, <tokens of span 1>, ..., sentinel_n, eos]
+    '''
+    d_batch, seq_length = target_ids.shape
+    pad_id = token_indexer.pad_token_id
+    eos_id = token_indexer.eos_token_id if token_indexer.eos_token_id is not None else token_indexer.sep_token_id
+    span_mask = get_span_mask(target_ids, token_indexer)
+    is_span_start = span_mask & ~F.pad(span_mask[:, :-1], (1, 0), value=False)
+    nb_spans_so_far = torch.cumsum(is_span_start, dim=1)
+    sentinel_table = get_sentinel_ids(token_indexer, seq_length + 1, target_ids.device)
+    span_sentinels = sentinel_table[(nb_spans_so_far - 1).clamp(min=0)]
+
+    input_ids = compact(torch.where(is_span_start, span_sentinels, target_ids), ~span_mask | is_span_start, pad_id)
+
+    # Every position has two slots in the targets: one for the sentinel if a span starts there, one for its own token
+    target_slots = torch.stack((span_sentinels, target_ids), dim=2).view(d_batch, 2 * seq_length)
+    keep_slots = torch.stack((is_span_start, span_mask), dim=2).view(d_batch, 2 * seq_length)
+    ending = torch.stack((sentinel_table[nb_spans_so_far[:, -1]], torch.full_like(target_ids[:, 0], eos_id)), dim=1)
+    output_ids = compact(torch.cat((target_slots, ending), dim=1),
+                         torch.cat((keep_slots, torch.ones_like(ending, dtype=torch.bool)), dim=1), pad_id)
+    return input_ids, output_ids
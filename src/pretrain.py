@@ -31,8 +31,12 @@ log.basicConfig(
 )  # noqa
 
 def get_loader(dataset):
+    # Workers load and collate batches in the background, and each get a disjoint part of the data
+    # Datasets that bucket rows by length already yield whole batches
     return DataLoader(dataset,
-                        batch_size=FLAGS.d_batch,)
+                        batch_size=None if getattr(dataset, 'yields_batches', False) else FLAGS.d_batch,
+                        num_workers=FLAGS.nb_loader_workers,
+                        pin_memory=torch.cuda.is_available())
 
 
 def main(_):
@@ -72,7 +76,9 @@ def main(_):
                                                        ('train', 'test', 'val'))
     model = MLMModelWrapper(MODEL_MAPPING[FLAGS.model])
     distributed_wrapper(train,model, run_dir, train_dataset, val_dataset)
-    model.cuda(FLAGS.device_idxs[0])
+    cuda_id = FLAGS.device_idxs[0] if FLAGS.device_idxs else -1  # -1 for CPU, as in train
+    if cuda_id >= 0:
+        model.cuda(cuda_id)
 
     log.info("Evaluating pretraining performance on test split")
     test_loader = get_loader(test_dataset)
@@ -83,7 +89,7 @@ def main(_):
     total_metrics = {}
     with torch.no_grad():
         for i, batch in enumerate(batch_generator):
-            batch = move_to_device(batch, FLAGS.device_idxs[0])
+            batch = move_to_device(batch, cuda_id)
             if isinstance(batch, torch.Tensor):
                 model(batch)
             else:
@@ -109,9 +115,19 @@ def train(rank,world_size,model, run_dir, train_dataset, val_dataset):
     distributed = (world_size > 1)
     if distributed:
         setup(rank, world_size)
-    cuda_id = FLAGS.device_idxs[rank]
-    log.info(f"Using GPU {cuda_id} from GPUs {FLAGS.device_idxs}")
-    model.cuda(cuda_id)
+    # -1 is AllenNLP's cuda_device for CPU, which is e.g. where bf16 precision can be tried out without a GPU
+    cuda_id = FLAGS.device_idxs[rank] if FLAGS.device_idxs else -1
+    if cuda_id >= 0:
+        log.info(f"Using GPU {cuda_id} from GPUs {FLAGS.device_idxs}")
+        model.cuda(cuda_id)
+    else:
+        log.info("No GPUs available, training on CPU")
+    log.info(f"Training in {FLAGS.precision} precision")
+    if FLAGS.compile_model:
+        if not hasattr(torch, 'compile'):
+            raise ValueError(f'compile_model needs torch >= 2.0, this is torch {torch.__version__}')
+        # Compiling the forward method rather than the module keeps the parameter names in checkpoints unchanged
+        model.model.forward = torch.compile(model.model.forward)
     optimizer = optim.Adam(model.parameters(), lr=FLAGS.learning_rate)
     loader = get_loader(train_dataset)
     val_loader = get_loader(val_dataset)
@@ -128,7 +144,8 @@ def train(rank,world_size,model, run_dir, train_dataset, val_dataset):
                                      checkpointer=checkpointer,
                                      distributed=distributed,
                                      world_size=len(FLAGS.device_idxs),
-                                     cuda_device=cuda_id)
+                                     cuda_device=cuda_id,
+                                     num_gradient_accumulation_steps=FLAGS.nb_accumulation_steps)
     trainer.train()
 
     if distributed:
@@ -0,0 +1,67 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from config import FLAGS
+from model import MultiHeadAttention, get_additive_attention_mask
+
+
+@unittest.skipUnless(hasattr(F, 'scaled_dot_product_attention'), 'attention_backend sdpa needs torch >= 2.0')
+class TestAttentionBackends(unittest.TestCase):
+    """The sdpa backend should give the same outputs and gradients as the explicit one (with dropout off)"""
+
+    def setUp(self):
+        FLAGS.unparse_flags()
+        FLAGS(['test', '--d_hidden=32', '--nb_heads=4', '--max_seq_length=12', '--d_batch=3'])
+        torch.manual_seed(0)
+        length = FLAGS.max_seq_length
+        self.replacees = torch.randn(FLAGS.d_batch, length, FLAGS.d_hidden)
+        # Rows padded to different lengths
+        row_lengths = torch.tensor([length, length - 3, length // 2])
+        padding_mask = torch.arange(length)[None, :] < row_lengths[:, None]
+        self.attention_mask = get_additive_attention_mask(padding_mask, self.replacees.dtype)
+
+    def run_attention(self, attention_module, backend):
+        """Returns the output with the given backend, and the gradients to the input and to the module's parameters"""
+        FLAGS.attention_backend = backend
+        attention_module.zero_grad()
+        replacees = self.replacees.clone().requires_grad_()
+        output = attention_module(replacees, replacees, self.attention_mask)['activations']
+        output.sum().backward()
+        parameter_grads = {name: p.grad.clone() for name, p in attention_module.named_parameters()
+                           if p.grad is not None}
+        return output.detach(), replacees.grad, parameter_grads
+
+    def assert_backends_agree(self):
+        attention_module = MultiHeadAttention()
+        attention_module.eval()
+        explicit_output, explicit_grad, explicit_parameter_grads = self.run_attention(attention_module, 'explicit')
+        fused_output, fused_grad, fused_parameter_grads = self.run_attention(attention_module, 'sdpa')
+        torch.testing.assert_close(fused_output, explicit_output, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(fused_grad, explicit_grad, rtol=1e-4, atol=1e-5)
+        self.assertEqual(fused_parameter_grads.keys(), explicit_parameter_grads.keys())
+        for name, grad in explicit_parameter_grads.items():
+            torch.testing.assert_close(fused_parameter_grads[name], grad, rtol=1e-4, atol=1e-5, msg=name)
+        return explicit_parameter_grads
+
+    def test_padding_mask(self):
+        FLAGS.pos_embeddings = 'absolute'
+        self.assert_backends_agree()
+
+    def test_relative_position_bias(self):
+        FLAGS.pos_embeddings = 'relative'
+        parameter_grads = self.assert_backends_agree()
+        self.assertIn('relative_attention_bias.weight', parameter_grads)
+
+    def test_causal_mask(self):
+        FLAGS.pos_embeddings = 'relative'
+        attention_module = MultiHeadAttention(use_causal_mask=True)
+        attention_module.eval()
+        explicit_output = self.run_attention(attention_module, 'explicit')[0]
+        fused_output = self.run_attention(attention_module, 'sdpa')[0]
+        torch.testing.assert_close(fused_output, explicit_output, rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from config import FLAGS
+from model import DIRTLMHead
+
+VOCAB_SIZE = 50
+
+
+class TestModelTrace(unittest.TestCase):
+    """The forward pass of DIRTLMHead should have no side effects, so a traced or compiled model gives the same outputs"""
+
+    def setUp(self):
+        FLAGS.unparse_flags()
+        FLAGS(['test', '--d_hidden=32', '--nb_heads=4', '--d_emb=16', '--d_ff=64', '--nb_encoder_layers=3',
+               '--max_seq_length=12', '--d_batch=3', '--pos_embeddings=relative'])
+        torch.manual_seed(0)
+        # Only the vocabulary size of the tokenizer is needed, no need to load one
+        with mock.patch('model.get_my_tokenizer', return_value=mock.Mock(vocab_size=VOCAB_SIZE)):
+            self.model = DIRTLMHead()
+        self.model.eval()
+
+    def make_inputs(self):
+        length = FLAGS.max_seq_length
+        input_ids = torch.randint(VOCAB_SIZE, (FLAGS.d_batch, length))
+        # Rows padded to different lengths
+        row_lengths = torch.tensor([length, length - 3, length // 2])
+        padding_mask = torch.arange(length)[None, :] < row_lengths[:, None]
+        masked_lm_labels = torch.where(torch.rand(input_ids.shape) < 0.3, input_ids, torch.full_like(input_ids, -100))
+        return input_ids, padding_mask, masked_lm_labels
+
+    def assert_same_outputs(self, run_model):
+        for _ in range(2):  # A second call shouldn't see anything left behind by the first
+            inputs = self.make_inputs()
+            expected = self.model(*inputs)
+            actual = run_model(*inputs)
+            for name in ['encoded_activations', 'vocab_scores', 'loss']:
+                torch.testing.assert_close(actual[name], expected[name], msg=name)
+            self.assertEqual(actual['metrics'].keys(), expected['metrics'].keys())
+            for name, value in expected['metrics'].items():
+                torch.testing.assert_close(actual['metrics'][name], value, msg=name)
+
+    def test_returns_metrics(self):
+        output = self.model(*self.make_inputs())
+        torch.testing.assert_close(output['metrics']['perplexity'], torch.exp(output['loss'].detach()))
+        self.assertEqual(self.model.get_metrics(), {})
+
+    def test_trace(self):
+        traced_model = torch.jit.trace(self.model, self.make_inputs(), strict=False)
+        self.assert_same_outputs(traced_model)
+
+    @unittest.skipUnless(hasattr(torch, 'compile'), 'torch.compile needs torch >= 2.0')
+    def test_compile(self):
+        # The eager backend checks that the forward pass can be captured, without needing a compiler toolchain
+        compiled_forward = torch.compile(self.model.forward, backend='eager')
+        self.assert_same_outputs(compiled_forward)
+
+
+if __name__ == '__main__':
+    unittest.main()
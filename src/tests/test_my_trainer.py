@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+from torch.utils.data import DataLoader
+
+from config import FLAGS
+from my_trainer import restore_data_position
+from text_input_pipeline import CombinedSplitDataset
+
+
+class TestRestoreDataPosition(unittest.TestCase):
+    def setUp(self):
+        FLAGS.unparse_flags()
+        FLAGS(['test'])
+        # The position in the data doesn't depend on the tokenizer, no need to load one
+        with mock.patch('text_input_pipeline.get_my_tokenizer'):
+            self.dataset = CombinedSplitDataset('train')
+
+    def make_legacy_loader(self):
+        """A data loader as older checkpoints pickled it: its dataset predates the position attributes"""
+        legacy_dataset = CombinedSplitDataset.__new__(CombinedSplitDataset)
+        legacy_dataset.__dict__.update(split_name='train', token_indexer=None, current_permuted_indices={})
+        return DataLoader(legacy_dataset, batch_size=None)
+
+    def test_restores_data_state(self):
+        self.dataset.epoch, self.dataset.chunk_cursor, self.dataset.item_index = 3, 2, 5
+        self.dataset.cursor_shard = (0, 1)
+        with mock.patch('text_input_pipeline.get_my_tokenizer'):
+            restored = CombinedSplitDataset('train')
+        self.assertTrue(restore_data_position(restored, {'data_state': self.dataset.state_dict()}))
+        self.assertEqual(restored.state_dict(), self.dataset.state_dict())
+
+    def test_legacy_data_loader_restarts_epoch(self):
+        training_state = {'epoch': '2.1600000000', 'data_loader': self.make_legacy_loader()}
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(restore_data_position(self.dataset, training_state))
+        # The fresh dataset is kept, and starts the resumed epoch from its start
+        self.dataset.set_epoch(2)
+        self.assertEqual(self.dataset.get_nb_batches_done(), 0)
+        self.assertEqual(self.dataset.state_dict()['epoch'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
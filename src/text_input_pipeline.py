@@ -1,3 +1,7 @@
+import collections
+import functools
+import json
+import multiprocessing as mp
 import numpy as np
 import pickle
 import time
@@ -5,12 +9,14 @@ import torch
 from allennlp.data import Vocabulary
 import glob
 from pathlib2 import Path
-from torch.utils.data import Dataset
+from torch import distributed as dist
+from torch.utils.data import Dataset, get_worker_info
 from torch.utils.data.dataset import IterableDataset
 
 from constants import DECODER_START_TOKEN, READ_ONLY_ROOT
 import os
 from config import FLAGS, get_my_tokenizer
+from my_utils.token_store import FlatTokenStore, FlatTokenStoreWriter, TokenStoreView, pad_row, smallest_id_dtype
 from tqdm import tqdm
 import logging as log
 import pandas as pd
@@ -20,6 +26,13 @@ corpus_to_data = {
     'bookcorpus': "/cw/working-arwen/damien/libs/VL-BERT/data/en_corpus/bc1g.doc",
     'gutenberg': "/cw/working-arwen/nathan/phd/data/pretraining/Gutenberg/*/*.txt"
 }
+CHARACTERS_PER_JOB = 2 ** 20  # Texts are sent to tokenization workers in groups of at least this many characters
+JOBS_IN_FLIGHT_PER_WORKER = 4
+ROWS_PER_WRITE = 2 ** 14
+ROWS_PER_PROGRESS = 2 ** 16  # Number of rows after which the position in the corpus is stored, to be able to resume
+REBUILT_STORES = set()  # To only rebuild each store once per run when FLAGS.fresh_data is set
+CHUNK_SIZE_MIB = 500  # Size of the chunks within which rows are shuffled, in MiB of padded int64 rows
+BATCH_LENGTH_MULTIPLE = 8  # Length-bucketed batches are padded to a multiple of this, which suits tensor cores better
 
 
 def add_custom_tokens(vocab):
@@ -33,94 +46,237 @@ def add_custom_tokens(vocab):
 class SingleDataset():
 
     def __init__(self, corpus_name, split_name):
-        self.id_tensor_path = Path(FLAGS.blob_folder, f'{corpus_name}_{split_name}_ids_tensor').as_posix()
-        self.text_path = corpus_to_data[corpus_name]
         self.split_name = split_name
+        self.actual_split = split_name.split("_")[1]
+        assert self.actual_split in ['train', 'test', 'val']
+        # All splits of a corpus are row ranges of one store holding all of its rows
+        all_splits_name = split_name.replace(self.actual_split, 'all')
+        store_name = f'{corpus_name}_{all_splits_name}_packed_ids' if FLAGS.pack_sequences \
+            else f'{corpus_name}_{all_splits_name}_ids'
+        self.store_path = Path(FLAGS.blob_folder, store_name).as_posix()
+        self.progress_path = f'{self.store_path}.progress'
+        self.text_path = corpus_to_data[corpus_name]
         self.corpus = corpus_name
         self.token_indexer = get_my_tokenizer()
 
-    def get_data(self):
-        actual_split = self.split_name.split("_")[1]
-        assert actual_split in ['train', 'test', 'val']
-
-        split_names = [self.split_name.replace(actual_split, s) for s in ['train', 'test', 'val']]
-        split_paths = [Path(FLAGS.blob_folder, f'{self.corpus}_{sn}_ids_tensor').as_posix()
-                       for sn in split_names]
-        assert self.id_tensor_path in split_paths, f"{self.id_tensor_path} is not path of {split_paths}, check spelling"
-        if all([os.path.exists(p) for p in split_paths]) and not FLAGS.fresh_data:
-            start = time.time()
-            print(f'Loading {self.id_tensor_path} ')
-            result = torch.load(self.id_tensor_path,map_location='cpu')
-            print(f'Loaded {self.id_tensor_path} in {time.time() - start:.2} seconds')
+    def get_data(self, fresh_data=None):
+        """
+        :fresh_data: whether to rebuild the store from the text files. Defaults to FLAGS.fresh_data, but a store is
+        only rebuilt once per run.
+        """
+        fresh_data = (FLAGS.fresh_data if fresh_data is None else fresh_data) and self.store_path not in REBUILT_STORES
+        split_names = [self.split_name.replace(self.actual_split, s) for s in ['train', 'test', 'val']]
+        legacy_tensor_paths = [Path(FLAGS.blob_folder, f'{self.corpus}_{sn}_ids_tensor').as_posix()
+                               for sn in split_names]
+        if FlatTokenStore.exists(self.store_path) and not fresh_data:
+            log.info(f'Opening {self.store_path}')
+        elif all([os.path.exists(p) for p in legacy_tensor_paths]) and not fresh_data and not FLAGS.pack_sequences:
+            self.convert_legacy_tensors(legacy_tensor_paths)
         else:
-            result = self._read_data(split_names, split_paths)
-        return result
-
-    def _read_data(self,split_names, split_paths):
-        log.info(f"Creating and storing splits for {self.corpus}")
-        full_tensor = self.get_full_tensor()
-        train, val, test = full_tensor[:int(.9 * len(full_tensor))], \
-                           full_tensor[int(.9 * len(full_tensor)):int(.95 * len(full_tensor))], \
-                           full_tensor[int(.95 * len(full_tensor)):]
-
-        path_to_split = dict(zip(split_paths, [train, test, val]))
-        name_to_split = dict(zip(split_names, [train, test, val]))
-        for path, split in path_to_split.items():
-            torch.save(split, path)
-        split_tensor = name_to_split[self.split_name]
-
-        return split_tensor
-
-    def get_full_tensor(self):
+            self.build_store(resume=not fresh_data)
+            REBUILT_STORES.add(self.store_path)
+        store = FlatTokenStore(self.store_path)
+        nb_rows = len(store)
+        log.info(f"{self.corpus}: {nb_rows} rows, of which a fraction {get_padding_fraction(store):.3f} is padding")
+        split_bounds = {'train': (0, int(.9 * nb_rows)),
+                        'val': (int(.9 * nb_rows), int(.95 * nb_rows)),
+                        'test': (int(.95 * nb_rows), nb_rows)}
+        return TokenStoreView([(store,) + split_bounds[self.actual_split]])
+
+    def get_store_writer(self, resume_from=None):
+        return FlatTokenStoreWriter(self.store_path, smallest_id_dtype(self.token_indexer.vocab_size),
+                                    self.token_indexer.pad_token_id, resume_from=resume_from)
+
+    def convert_legacy_tensors(self, legacy_tensor_paths):
+        log.info(f'Converting torch.save\'d id tensors of {self.corpus} to a flat token store')
+        train_path, test_path, val_path = legacy_tensor_paths
+        with self.get_store_writer() as writer:
+            for path in [train_path, val_path, test_path]:  # The order in which the splits were sliced
+                id_tensor = torch.load(path, map_location='cpu')
+                for i in range(0, len(id_tensor), ROWS_PER_WRITE):
+                    writer.append_rows(id_tensor[i:i + ROWS_PER_WRITE].numpy())
+                del id_tensor
+
+    def build_store(self, resume=True):
+        """
+        Streams the text files of the corpus through tokenization into rows of FLAGS.max_seq_length, which are
+        appended to the store as they come, so memory use doesn't depend on the size of the corpus.
+        Texts are tokenized in a pool of FLAGS.nb_tokenization_workers processes if that is bigger than 1, with results
+        written in text order, so the store is the same as when tokenizing serially.
+        Every ROWS_PER_PROGRESS rows, the position in the corpus is stored next to the store. If :resume:, a build that
+        was interrupted continues from the last stored position.
+        """
         log.info(f"Loading a fraction {FLAGS.pretrain_data_fraction} of {self.corpus} text data from {self.text_path}.")
-        tensor_list = []
+        text_files = self.get_text_files()
+        if os.path.exists(self.progress_path) and resume:
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            log.info(f"Resuming tokenization of {self.corpus} from file {progress['file_index']} "
+                     f"out of {len(text_files)}, text {progress['text_index']}")
+        else:
+            progress = None
+        start_position = (progress['file_index'], progress['text_index']) if progress else (0, 0)
+        resume_from = (progress['nb_rows'], progress['nb_tokens']) if progress else None
+        # Number of rows and tokens the texts would have taken without packing, to report how much padding it saves
+        nb_unpacked_rows, nb_unpacked_tokens = progress.get('unpacked', (0, 0)) if progress else (0, 0)
+
+        start = time.time()
+        with self.get_store_writer(resume_from) as writer:
+            rows_at_last_progress = len(writer)
+            jobs = self.get_tokenization_jobs(text_files, start_position)
+            tokenize = functools.partial(texts_to_rows, pack=FLAGS.pack_sequences)
+            for (file_index, text_index), (rows, (job_unpacked_rows, job_unpacked_tokens)) in tqdm(ordered_map(
+                    tokenize, jobs, FLAGS.nb_tokenization_workers)):
+                writer.append_rows(rows)
+                nb_unpacked_rows += job_unpacked_rows
+                nb_unpacked_tokens += job_unpacked_tokens
+                if len(writer) - rows_at_last_progress >= ROWS_PER_PROGRESS:
+                    nb_rows, nb_tokens = writer.flush()
+                    self.save_progress({'file_index': file_index, 'text_index': text_index,
+                                        'nb_rows': nb_rows, 'nb_tokens': nb_tokens,
+                                        'unpacked': (nb_unpacked_rows, nb_unpacked_tokens)})
+                    rows_at_last_progress = nb_rows
+            nb_rows, nb_tokens = len(writer), writer.nb_tokens
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        log.info(f"Tokenized {self.corpus} in {time.time() - start:.2f} seconds")
+        if FLAGS.pack_sequences and nb_rows > 0:
+            log.info(f"Packing put {self.corpus} in {nb_rows} instead of {nb_unpacked_rows} rows: padding fraction "
+                     f"went from {1 - nb_unpacked_tokens / (nb_unpacked_rows * FLAGS.max_seq_length):.3f} "
+                     f"to {1 - nb_tokens / (nb_rows * FLAGS.max_seq_length):.3f}")
+
+    def save_progress(self, progress):
+        tmp_path = f'{self.progress_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def get_text_files(self):
         all_text_files = glob.glob(corpus_to_data[self.corpus])
-        for i, path in tqdm(enumerate(all_text_files)):
-            if self.corpus in ['wiki','gutenberg']:
-                if i > len(all_text_files)*FLAGS.pretrain_data_fraction:
-                    break
-            tensor_list += self.text_to_tensor_rows(path)
-        full_tensor = torch.cat(tensor_list)
-
-        return full_tensor
-
-    def text_to_tensor_rows(self, path):
-        token_ids_units = []
-        log.disable(log.WARNING)
+        if self.corpus in ['wiki', 'gutenberg']:
+            all_text_files = [path for i, path in enumerate(all_text_files)
+                              if not i > len(all_text_files) * FLAGS.pretrain_data_fraction]
+        return all_text_files
+
+    def get_tokenization_jobs(self, text_files, start_position):
+        """
+        Yields (position after the job, list of texts), with jobs of at least CHARACTERS_PER_JOB characters (except
+        at the end of a file). Positions are (file index, index of the text in that file).
+        """
+        start_file, start_text = start_position
+        for file_index in range(start_file, len(text_files)):
+            texts, nb_characters = [], 0
+            for text_index, text in enumerate(self.read_texts(text_files[file_index])):
+                if file_index == start_file and text_index < start_text:
+                    continue
+                texts.append(text)
+                nb_characters += len(text)
+                if nb_characters >= CHARACTERS_PER_JOB:
+                    yield (file_index, text_index + 1), texts
+                    texts, nb_characters = [], 0
+            if texts:
+                yield (file_index, text_index + 1), texts
+
+    def read_texts(self, path):
+        """Yields the units of text in a file that are tokenized separately: rows never span two of these"""
         if self.corpus == 'wiki':
             df = pd.read_json(path, lines=True)
-            unflattened_ids = [self.token_indexer.encode(text, add_special_tokens=False) for text in df['text']]
-            token_ids_units += unflattened_ids
+            yield from df['text']
         elif self.corpus == 'bookcorpus':
             paragraph = ""
-            full_file = open(path).read().splitlines()
-            full_length = len(full_file)
-            for i, line in tqdm(enumerate(full_file)):
+            full_length = sum(1 for _ in iter_lines(path))
+            for i, line in enumerate(iter_lines(path)):
                 if i > full_length * FLAGS.pretrain_data_fraction:
                     break
                 line = " ".join(line.strip().split())
                 paragraph += line + " "
                 if line == "":
-                    token_ids_units += [self.token_indexer.encode(paragraph, add_special_tokens=False)]
+                    yield paragraph
                     paragraph = ""
 
         elif self.corpus == 'gutenberg':
             with open(path, 'r', encoding='utf-8', errors='ignore') as f:
                 whole_book = f.read()
-            token_ids_units += [self.token_indexer.encode(whole_book, add_special_tokens=False)]
-        log.disable(log.NOTSET)
+            yield whole_book
 
-        max_raw_seq_length = FLAGS.max_seq_length - 2  # Exclusing bos and eos tokens
-        tensor_list = []
-        for token_ids in token_ids_units:
-            for i in range(0, len(token_ids), max_raw_seq_length):
-                current_sequence = self.token_indexer.prepare_for_model(token_ids[i:i + max_raw_seq_length],
-                                                                        truncation_strategy='do_not_truncate',
-                                                                        pad_to_max_length=True)['input_ids']
-                tensor_list.append(torch.tensor(current_sequence).unsqueeze(
-                    0))
-        return [torch.cat(tensor_list).to(torch.int32)]
 
+def iter_lines(path):
+    """Same lines as open(path).read().splitlines(), without reading the whole file into memory"""
+    with open(path) as f:
+        for line in f:
+            yield from line.splitlines()
+
+
+def texts_to_rows(texts, pack=False):
+    """
+    Returns a [nb_rows, FLAGS.max_seq_length] array with the padded rows of token ids of all :texts:, and the
+    (number of rows, number of non-padding tokens) the texts take without packing.
+    Without :pack:, each row holds (a piece of) one text: [CLS] ids [SEP] padding.
+    With :pack:, texts follow each other in rows as [CLS] ids of text 1 [SEP] ids of text 2 [SEP] ..., and texts that
+    don't fit in a row continue in the next. Only the last row is padded.
+    """
+    token_indexer = get_my_tokenizer()
+    max_raw_seq_length = FLAGS.max_seq_length - 2  # Exclusing bos and eos tokens
+    rows = []
+    text_ids = []
+    log.disable(log.WARNING)
+    for text in texts:
+        token_ids = token_indexer.encode(text, add_special_tokens=False)
+        if pack:
+            if token_ids:
+                text_ids.append(token_ids + [token_indexer.sep_token_id])
+            continue
+        for i in range(0, len(token_ids), max_raw_seq_length):
+            rows.append(token_indexer.prepare_for_model(token_ids[i:i + max_raw_seq_length],
+                                                        truncation_strategy='do_not_truncate',
+                                                        pad_to_max_length=True)['input_ids'])
+    log.disable(log.NOTSET)
+    if not pack:
+        rows = np.array(rows, dtype=np.int32).reshape(-1, FLAGS.max_seq_length)
+        return rows, (len(rows), int(np.sum(rows != token_indexer.pad_token_id)))
+
+    nb_raw_ids = [len(ids) - 1 for ids in text_ids]
+    nb_unpacked_rows = sum(-(-n // max_raw_seq_length) for n in nb_raw_ids)
+    stream = np.array([i for ids in text_ids for i in ids], dtype=np.int32)
+    row_capacity = FLAGS.max_seq_length - 1  # Every row starts with [CLS]
+    nb_rows = -(-len(stream) // row_capacity)
+    row_bodies = np.full(nb_rows * row_capacity, token_indexer.pad_token_id, dtype=np.int32)
+    row_bodies[:len(stream)] = stream
+    packed = np.concatenate((np.full((nb_rows, 1), token_indexer.cls_token_id, dtype=np.int32),
+                             row_bodies.reshape(nb_rows, row_capacity)), axis=1)
+    return packed, (nb_unpacked_rows, sum(nb_raw_ids) + 2 * nb_unpacked_rows)
+
+
+def get_batch_length(max_row_length):
+    """Length that a length-bucketed batch with rows of at most :max_row_length: tokens is padded to"""
+    return int(min(-(-max_row_length // BATCH_LENGTH_MULTIPLE) * BATCH_LENGTH_MULTIPLE, FLAGS.max_seq_length))
+
+
+def get_padding_fraction(store):
+    """Fraction of the padded rows of :store: that is padding"""
+    nb_positions = len(store) * FLAGS.max_seq_length
+    return 1 - store.nb_tokens / nb_positions if nb_positions else 0.
+
+
+def ordered_map(function, jobs, nb_workers):
+    """
+    Yields (position, function(job_input)) for every (position, job_input) in :jobs:, in order. If nb_workers > 1,
+    this is computed in a pool of processes, keeping at most JOBS_IN_FLIGHT_PER_WORKER jobs per worker in memory.
+    """
+    if nb_workers <= 1:
+        for position, job_input in jobs:
+            yield position, function(job_input)
+        return
+    with mp.get_context('fork').Pool(nb_workers) as pool:
+        in_flight = collections.deque()
+        for position, job_input in jobs:
+            in_flight.append((position, pool.apply_async(function, (job_input,))))
+            if len(in_flight) >= nb_workers * JOBS_IN_FLIGHT_PER_WORKER:
+                position, result = in_flight.popleft()
+                yield position, result.get()
+        while in_flight:
+            position, result = in_flight.popleft()
+            yield position, result.get()
 
 
 class CombinedSplitDataset(IterableDataset):
@@ -128,78 +284,219 @@ class CombinedSplitDataset(IterableDataset):
         super().__init__()
         self.token_indexer = get_my_tokenizer()
         self.split_name = split
-        self.split_chunks_folder = Path(FLAGS.blob_folder,f'{split}')
-        self.chunk_paths = None
-        self.pop_indices = None
-        self.row_index = None
-        self.current_permuted_indices = None
-        self.current_chunk_path = None
-
-    def make_chunks(self):
-        total_data_tensor = self.get_data()
-        split_into_chunks(self.split_name,total_data_tensor)
-
-    def __iter__(self): #TODO make sure this supports multi-GPU loading with worker_info = torch.utils.data.get_worker_info(): https://pytorch.org/docs/stable/data.html#torch.utils.data.IterableDataset
-        if not self.split_chunks_folder.is_dir():
-            self.make_chunks()
-
-        if (not self.current_chunk_path) and ((not self.chunk_paths) or (not self.pop_indices)): # Storing this to be able to pick up runs intra-epoch between restarts
-            self.chunk_paths = list(self.split_chunks_folder.glob('*.pt'))
-            length = len(self.chunk_paths)
-            self.pop_indices = []
-            while length > 0:
-                self.pop_indices.append(random.randrange(length))
-                length -= 1
-            assert self.chunk_paths , f"{self.split_chunks_folder} is empty!"
-
-
-        while self.chunk_paths or self.current_chunk_path :
-            assert len(self.pop_indices) == len(self.chunk_paths)# Needs to be torch.long for downstream, but storing as int32 because uses less space
-            if (self.current_chunk_path is None) or (self.current_permuted_indices is None):
-                pop_idx = self.pop_indices.pop(0)
-                self.current_chunk_path = self.chunk_paths.pop(pop_idx)
-                chunk_data = torch.load(self.current_chunk_path.as_posix()).to(torch.int64)
-                self.current_permuted_indices = torch.randperm(len(chunk_data))
+        self.store = None
+        self.stores_ready = False  # Once True, copies of this dataset in other processes don't rebuild the stores
+        # Chunk order and row order only depend on the seed and the epoch, so that all DataLoader workers and all
+        # distributed ranks agree on them and can each take a disjoint part
+        self.seed = FLAGS.manual_seed if FLAGS.manual_seed else random.randrange(2 ** 31)
+        self.epoch = 0
+        # Storing these to be able to pick up runs intra-epoch between restarts. Only tracked when iterating in the
+        # main process, as DataLoader workers iterate over their own copy of the dataset
+        self.chunk_cursor = None
+        self.item_index = None  # Index of the next row, or batch if self.yields_batches, within the current chunk
+        self.cursor_shard = None
+        self.nb_batches_per_chunk = None
+
+    def __getstate__(self):
+        # The memory-mapped stores are reopened after unpickling (in DataLoader workers or when restoring a checkpoint)
+        state = self.__dict__.copy()
+        state['store'] = None
+        return state
+
+    def state_dict(self):
+        """
+        Position in the data, in a few numbers: the chunk order and the order within each chunk follow from the seed
+        and the epoch, so resuming seeks straight to the stored chunk and item, without going over earlier chunks
+        """
+        return {'seed': self.seed,
+                'epoch': self.epoch,
+                'chunk_cursor': self.chunk_cursor,
+                'item_index': self.item_index,
+                'cursor_shard': self.cursor_shard}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.chunk_cursor = state_dict['chunk_cursor']
+        self.item_index = state_dict['item_index']
+        self.cursor_shard = state_dict['cursor_shard']
+
+    def set_epoch(self, epoch):
+        """Equivalent of DistributedSampler.set_epoch: should be called at the start of each epoch to reshuffle"""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.chunk_cursor = None
+            self.item_index = None
+
+    def get_chunk_bounds(self):
+        """
+        Rows are shuffled within chunks of (up to) CHUNK_SIZE_MIB worth of padded rows, and the chunks are visited in
+        random order. Returns a list of (first_row, end_row) per chunk.
+        """
+        B_per_MiB = 2 ** 20
+        B_per_row = np.dtype(np.int64).itemsize * FLAGS.max_seq_length
+        rows_per_chunk = int(CHUNK_SIZE_MIB * B_per_MiB / B_per_row)
+        nb_rows = len(self.get_data())
+        return [(i, min(i + rows_per_chunk, nb_rows)) for i in range(0, nb_rows, rows_per_chunk)]
+
+    @staticmethod
+    def get_shard():
+        """
+        Returns (shard index, number of shards) for the process this is called in. Every DataLoader worker of every
+        distributed rank is a separate shard.
+        """
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        worker_info = get_worker_info()
+        worker_id, nb_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return rank * nb_workers + worker_id, world_size * nb_workers
+
+    def get_shard_chunk_ids(self, nb_chunks, shard, nb_shards):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        chunk_order = torch.randperm(nb_chunks, generator=generator).tolist()
+        return chunk_order[shard::nb_shards]
+
+    def get_chunk_generator(self, chunk_id):
+        return torch.Generator().manual_seed(hash((self.seed, self.epoch, chunk_id)) % 2 ** 63)
+
+    def get_permuted_indices(self, chunk_id, nb_rows):
+        return torch.randperm(nb_rows, generator=self.get_chunk_generator(chunk_id))
+
+    @property
+    def yields_batches(self):
+        """If True, iterating gives whole batches of rows bucketed by length, so the DataLoader shouldn't batch"""
+        return FLAGS.max_tokens_per_batch > 0
+
+    def get_length_batches(self, chunk_id, first_row, end_row):
+        """
+        Returns the batches of a chunk, in random order, as arrays of row indices relative to :first_row:.
+        Rows are sorted by their (non-padding) length, and every batch takes as many consecutive rows as fit in
+        FLAGS.max_tokens_per_batch when padded to the longest of them. If DIR is used, batches have at least two rows
+        to contrast with.
+        """
+        min_batch_size = 2 if FLAGS.DIR else 1
+        generator = self.get_chunk_generator(chunk_id)
+        permuted_indices = torch.randperm(end_row - first_row, generator=generator).numpy()
+        lengths = self.get_data().lengths(first_row, end_row)[permuted_indices]
+        by_length = np.argsort(lengths, kind='stable')  # Ties stay in random order
+        sorted_indices, sorted_lengths = permuted_indices[by_length], lengths[by_length]
+        batches, batch_start = [], 0
+        for i, length in enumerate(sorted_lengths):
+            # Rows come in increasing length, so the current row is the longest of the batch it would join
+            if (i - batch_start + 1) * get_batch_length(length) > FLAGS.max_tokens_per_batch \
+                    and i - batch_start >= min_batch_size:
+                batches.append(sorted_indices[batch_start:i])
+                batch_start = i
+        if batch_start < len(sorted_indices):
+            batches.append(sorted_indices[batch_start:])
+        if len(batches) > 1 and len(batches[-1]) < min_batch_size:
+            shortfall = min_batch_size - len(batches[-1])
+            if len(batches[-2]) - shortfall >= min_batch_size:
+                # Topped up with the longest rows of the previous batch, which then still fits the budget
+                batches[-2:] = [batches[-2][:-shortfall], np.concatenate([batches[-2][-shortfall:], batches[-1]])]
+            else:
+                batches[-2:] = [np.concatenate(batches[-2:])]
+        if batches and len(batches[-1]) < min_batch_size:
+            log.warning(f"Dropping chunk {chunk_id} of {self.split_name}: its {end_row - first_row} rows "
+                        f"are fewer than the {min_batch_size} rows a batch needs")
+            batches = []
+        assert all(len(batch) >= min_batch_size for batch in batches)
+        return [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+    def get_nb_batches_per_chunk(self):
+        """Only depends on the lengths of the rows in each chunk, so it is computed once"""
+        if self.nb_batches_per_chunk is None:
+            self.nb_batches_per_chunk = [len(self.get_length_batches(chunk_id, first_row, end_row))
+                                         for chunk_id, (first_row, end_row) in enumerate(self.get_chunk_bounds())]
+        return self.nb_batches_per_chunk
+
+    def get_chunk_items(self, chunk_id, first_row, end_row):
+        """The row indices (relative to :first_row:) or batches of row indices that a chunk is iterated as"""
+        if self.yields_batches:
+            return self.get_length_batches(chunk_id, first_row, end_row)
+        return self.get_permuted_indices(chunk_id, end_row - first_row).tolist()
+
+    def get_row(self, index):
+        return torch.from_numpy(self.get_data().padded_row(index, FLAGS.max_seq_length,
+                                                           self.token_indexer.pad_token_id))
+
+    def get_batch(self, indices):
+        """Returns the rows at :indices: as a [len(indices), L] tensor, with L just enough for the longest row"""
+        rows = [self.get_data().row(i) for i in indices]
+        length = get_batch_length(max(len(row) for row in rows))
+        return torch.from_numpy(np.stack([pad_row(row, length, self.token_indexer.pad_token_id) for row in rows]))
+
+    def __iter__(self):
+        chunk_bounds = self.get_chunk_bounds()
+        assert chunk_bounds, f"{self.split_name} is empty!"
+        shard, nb_shards = self.get_shard()
+        if len(chunk_bounds) < nb_shards:
+            log.warning(f"Only {len(chunk_bounds)} chunks for {nb_shards} loading processes: "
+                        f"some ranks or workers will not get any data")
+        shard_chunk_ids = self.get_shard_chunk_ids(len(chunk_bounds), shard, nb_shards)
+        in_main_process = get_worker_info() is None
+
+        chunk_cursor, item_index = 0, 0
+        if self.chunk_cursor is not None:
+            if self.cursor_shard == (shard, nb_shards):
+                chunk_cursor, item_index = self.chunk_cursor, self.item_index or 0
             else:
-                chunk_data = torch.load(self.current_chunk_path.as_posix()).to(torch.int64)
-            chunk_data = chunk_data[self.current_permuted_indices]
-            if not self.row_index:
-                self.row_index = 0
-            while self.row_index < len(chunk_data):
-                yield chunk_data[self.row_index]
-                self.row_index += 1
-            self.current_permuted_indices = None
-            self.current_chunk_path = None
-            self.row_index = None
+                log.warning(f"Data position was stored for shard {self.cursor_shard}, can't resume it as shard "
+                            f"{(shard, nb_shards)}: restarting epoch {self.epoch} from its start")
+
+        while chunk_cursor < len(shard_chunk_ids):
+            chunk_id = shard_chunk_ids[chunk_cursor]
+            first_row, end_row = chunk_bounds[chunk_id]
+            chunk_items = self.get_chunk_items(chunk_id, first_row, end_row)
+            while item_index < len(chunk_items):
+                if in_main_process:  # Position of the next item, as the generator pauses at the yield
+                    self.chunk_cursor, self.item_index, self.cursor_shard = chunk_cursor, item_index + 1, (shard,
+                                                                                                           nb_shards)
+                if self.yields_batches:
+                    yield self.get_batch(first_row + chunk_items[item_index])
+                else:
+                    yield self.get_row(first_row + chunk_items[item_index])
+                item_index += 1
+            chunk_cursor += 1
+            item_index = 0
+        if in_main_process:
+            self.chunk_cursor, self.item_index, self.cursor_shard = None, None, None
+
+    def get_nb_batches_done(self):
+        """Number of batches this shard already yielded in the current epoch, according to the stored position"""
+        if self.chunk_cursor is None:
+            return 0
+        chunk_bounds = self.get_chunk_bounds()
+        shard, nb_shards = self.cursor_shard
+        done_chunk_ids = self.get_shard_chunk_ids(len(chunk_bounds), shard, nb_shards)[:self.chunk_cursor]
+        if self.yields_batches:
+            return sum(self.get_nb_batches_per_chunk()[i] for i in done_chunk_ids) + (self.item_index or 0)
+        nb_rows_done = sum(chunk_bounds[i][1] - chunk_bounds[i][0] for i in done_chunk_ids) + (self.item_index or 0)
+        return nb_rows_done / FLAGS.d_batch
 
     def __len__(self):
-        length_blob_path = Path(FLAGS.blob_folder, f'{self.split_name}_tensor_combined_length').as_posix()
-        if os.path.exists(length_blob_path) and not FLAGS.fresh_data:
-            length = torch.load(length_blob_path,map_location='cpu')
-        else:
-            length = len(self.get_data())
-            torch.save(length, length_blob_path)
-        return int(length / FLAGS.d_batch)
-
+        """Number of batches per rank"""
+        world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if self.yields_batches:
+            return int(sum(self.get_nb_batches_per_chunk()) / world_size)
+        return int(len(self.get_data()) / (FLAGS.d_batch * world_size))
 
     def get_data(self):
-        blob_path = Path(FLAGS.blob_folder, f'{self.split_name}_tensor_combined').as_posix()
-        if os.path.exists(blob_path) and not FLAGS.fresh_data:
-            log.info(f'Loading {blob_path} ...')
-            start = time.time()
-            result = torch.load(blob_path,map_location='cpu')
-            log.info(f'Loaded {blob_path} in {time.time() - start:.2} seconds')
-        else:
-            result = self.combine_data()
-            torch.save(result, blob_path)
-        return result
-
-
-    def combine_data(self):
-        corpus_names = ['wiki', 'gutenberg', 'bookcorpus']
-        return torch.cat(
-            [SingleDataset(corpus_name=corpus_name, split_name=self.split_name).get_data()
-             for corpus_name in corpus_names])
+        """
+        Returns a TokenStoreView on the rows of this split of all corpora. This doesn't copy any data: the view reads
+        from the store of each corpus.
+        """
+        if self.store is None:
+            corpus_names = ['wiki', 'gutenberg', 'bookcorpus']
+            fresh_data = FLAGS.fresh_data and not self.stores_ready
+            self.store = TokenStoreView([segment for corpus_name in corpus_names
+                                         for segment in SingleDataset(corpus_name=corpus_name,
+                                                                      split_name=self.split_name
+                                                                      ).get_data(fresh_data).segments])
+            self.stores_ready = True
+        return self.store
 
 
 def get_data_dict():
@@ -212,6 +509,9 @@ def get_data_dict():
 
     train_dataset, test_dataset, val_dataset = [CombinedSplitDataset(f'{FLAGS.pretrain_data_fraction}_{split}_{FLAGS.max_seq_length}')
                                                 for split in ['train','test','val']]
+    # Build any missing stores now, before the datasets are copied to other processes
+    for dataset in [train_dataset, test_dataset, val_dataset]:
+        dataset.get_data()
     return {"train": train_dataset,
             "test": test_dataset,
             "val": val_dataset}
@@ -304,18 +604,3 @@ def get_data_dict_old():
     return {"train": train_dataset,
             "test": test_dataset,
             "val": val_dataset}
-
-def split_into_chunks(split_name,split_tensor):
-    chunk_size_MiB = 500 # Size of chunks to load into memory at once, in MiB
-    B_per_el = split_tensor.element_size()
-    nb_cols = split_tensor.shape[-1]
-    B_per_MiB = 2 ** 20
-    els_per_chunk = ((chunk_size_MiB * B_per_MiB) / B_per_el)
-    rows_per_chunk = int(els_per_chunk / nb_cols)
-    split_dir = Path(FLAGS.blob_folder, split_name)
-    Path.mkdir(split_dir)
-    for i in range(0,len(split_tensor),rows_per_chunk):
-        chunk = split_tensor[i:i + rows_per_chunk].clone()
-        path = Path(split_dir, f'{i}.pt').as_posix()
-        torch.save(chunk, path)
-        del chunk